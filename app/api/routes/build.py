@@ -0,0 +1,87 @@
+from app.apis import mongo, builder
+from time import perf_counter
+from app.models import DResponse
+from fastapi import Response, APIRouter
+
+
+router = APIRouter(
+    prefix="/build",
+    tags=["internals"],
+)
+
+
+@router.get("/status", response_model=dict, status_code=200)
+def build_status() -> dict:
+    """Returns the state and progress of the current or last metadata build"""
+    init_time = perf_counter()
+
+    result = builder.__json__()
+    result["last_build_stats"] = mongo.get_last_build_stats()
+    return DResponse(
+        200, "Build status successfully retrieved.", True, result, init_time
+    ).__json__()
+
+
+@router.get("/cancel", response_model=dict, status_code=200)
+def build_cancel(response: Response, secret_key: str = "") -> dict:
+    """Terminates the running metadata build"""
+    init_time = perf_counter()
+
+    if mongo.config["app"].get("secret_key", "") != secret_key:
+        response.status_code = 401
+        return DResponse(
+            401, "The secret key was incorrect.", False, None, init_time
+        ).__json__()
+    if not builder.cancel():
+        response.status_code = 409
+        return DResponse(
+            409, "No metadata build is running.", False, None, init_time
+        ).__json__()
+    return DResponse(
+        200, "Metadata build successfully cancelled.", True, None, init_time
+    ).__json__()
+
+
+@router.get("/refresh", response_model=dict, status_code=200)
+async def build_refresh(response: Response, secret_key: str = "") -> dict:
+    """Updates the items that changed on TMDB since the last refresh"""
+    init_time = perf_counter()
+
+    if mongo.config["app"].get("secret_key", "") != secret_key:
+        response.status_code = 401
+        return DResponse(
+            401, "The secret key was incorrect.", False, None, init_time
+        ).__json__()
+    if not builder.start(refresh=True):
+        response.status_code = 409
+        return DResponse(
+            409, "A metadata build is already running.", False, None, init_time
+        ).__json__()
+    return DResponse(
+        200, "Metadata refresh task started in background.", True, None, init_time
+    ).__json__()
+
+
+@router.get("/rollback", response_model=dict, status_code=200)
+def build_rollback(response: Response, secret_key: str = "") -> dict:
+    """Swaps the live catalog with the one from the previous build"""
+    init_time = perf_counter()
+
+    if mongo.config["app"].get("secret_key", "") != secret_key:
+        response.status_code = 401
+        return DResponse(
+            401, "The secret key was incorrect.", False, None, init_time
+        ).__json__()
+    if builder.is_running():
+        response.status_code = 409
+        return DResponse(
+            409, "A metadata build is running.", False, None, init_time
+        ).__json__()
+    if not mongo.rollback_catalog():
+        response.status_code = 404
+        return DResponse(
+            404, "No previous catalog is available.", False, None, init_time
+        ).__json__()
+    return DResponse(
+        200, "Catalog successfully rolled back.", True, None, init_time
+    ).__json__()
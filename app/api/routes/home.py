@@ -31,6 +31,8 @@ unwanted_keys = {
     "revenue": 0,
     "tagline": 0,
     "imdb_id": 0,
+    "fingerprint": 0,
+    "refresh_at": 0,
 }
 
 
@@ -0,0 +1,102 @@
+from app.apis import mongo
+from typing import Optional
+from time import perf_counter
+from app.models import DResponse
+from fastapi import Request, Response, APIRouter
+from app.core.identification_cache import IdentificationCache
+
+
+router = APIRouter(
+    prefix="/identification",
+    tags=["internals"],
+)
+
+id_cache = IdentificationCache(mongo.identification_cache_col)
+
+
+def entry_key(data: dict) -> str:
+    return id_cache.key(
+        data["title"],
+        data.get("media_type", "movies"),
+        data.get("year"),
+        data.get("language", "en"),
+        data.get("adult", False),
+    )
+
+
+@router.get("", response_model=dict, status_code=200)
+def identification_list(
+    response: Response,
+    secret_key: str = "",
+    query: str = "",
+    negative: bool = False,
+    limit: int = 50,
+) -> dict:
+    """Lists cached identifications, optionally only the negative ones"""
+    init_time = perf_counter()
+
+    if mongo.config["app"].get("secret_key", "") != secret_key:
+        response.status_code = 401
+        return DResponse(
+            401, "The secret key was incorrect.", False, None, init_time
+        ).__json__()
+    result = id_cache.find(query, negative, limit)
+    return DResponse(
+        200, "Results found: %s." % len(result), True, result, init_time
+    ).__json__()
+
+
+@router.post("/override", response_model=dict, status_code=200)
+async def identification_override(
+    request: Request, response: Response, secret_key: str = ""
+) -> dict:
+    """Pins a title to a TMDB ID, a null ``tmdb_id`` marks it as unidentifiable"""
+    init_time = perf_counter()
+
+    if mongo.config["app"].get("secret_key", "") != secret_key:
+        response.status_code = 401
+        return DResponse(
+            401, "The secret key was incorrect.", False, None, init_time
+        ).__json__()
+    data: dict = await request.json()
+    if not data.get("title"):
+        response.status_code = 400
+        return DResponse(
+            400, "No title was provided.", False, None, init_time
+        ).__json__()
+    tmdb_id: Optional[int] = data.get("tmdb_id")
+    key = entry_key(data)
+    id_cache.override(key, int(tmdb_id) if tmdb_id is not None else None)
+    return DResponse(
+        200,
+        "Identification of '%s' successfully overridden." % key,
+        True,
+        key,
+        init_time,
+    ).__json__()
+
+
+@router.post("/invalidate", response_model=dict, status_code=200)
+async def identification_invalidate(
+    request: Request, response: Response, secret_key: str = ""
+) -> dict:
+    """Deletes the entry of a title, or every (negative) entry when no title is given, keeping overrides unless asked"""
+    init_time = perf_counter()
+
+    if mongo.config["app"].get("secret_key", "") != secret_key:
+        response.status_code = 401
+        return DResponse(
+            401, "The secret key was incorrect.", False, None, init_time
+        ).__json__()
+    data: dict = await request.json()
+    key = entry_key(data) if data.get("title") else None
+    result = id_cache.invalidate(
+        key, data.get("negative", False), data.get("overrides", False)
+    )
+    return DResponse(
+        200,
+        "%s identifications successfully invalidated." % result,
+        True,
+        result,
+        init_time,
+    ).__json__()
@@ -0,0 +1,25 @@
+from time import perf_counter
+from app.apis import supervisor
+from app.models import DResponse
+from fastapi import Response, APIRouter
+
+
+router = APIRouter(
+    prefix="/rclone",
+    tags=["internals"],
+)
+
+
+@router.get("/health", response_model=dict, status_code=200)
+def rclone_health(response: Response) -> dict:
+    """Returns whether the rclone rcd is serving, with its probe latency and restarts"""
+    init_time = perf_counter()
+
+    if not supervisor.ready:
+        response.status_code = 503
+        return DResponse(
+            503, "rclone is not ready.", False, supervisor.__json__(), init_time
+        ).__json__()
+    return DResponse(
+        200, "rclone is ready.", True, supervisor.__json__(), init_time
+    ).__json__()
@@ -1,7 +1,7 @@
 from time import perf_counter
+from app.apis import builder
 from app.models import DResponse
-from app.core.cron import fetch_metadata
-from fastapi import APIRouter, BackgroundTasks
+from fastapi import Response, APIRouter
 
 
 router = APIRouter(
@@ -11,10 +11,14 @@ router = APIRouter(
 
 
 @router.get("", response_model=dict, status_code=200)
-async def rebuild(background_tasks: BackgroundTasks) -> dict:
+async def rebuild(response: Response, full: bool = False) -> dict:
     init_time = perf_counter()
-    background_tasks.add_task(fetch_metadata)
 
+    if not builder.start(incremental=False if full else None, resume=not full):
+        response.status_code = 409
+        return DResponse(
+            409, "A metadata build is already running.", False, None, init_time
+        ).__json__()
     return DResponse(
         200, "Metadata building task started in background.", True, None, init_time
     ).__json__()
@@ -30,6 +30,8 @@ unwanted_keys = {
     "revenue": 0,
     "tagline": 0,
     "imdb_id": 0,
+    "fingerprint": 0,
+    "refresh_at": 0,
     "genres": 0,
 }
 
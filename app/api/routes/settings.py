@@ -1,8 +1,7 @@
-from app.apis import mongo
+from app.apis import mongo, builder
 from time import perf_counter
 from app.models import DResponse
-from app.core.cron import fetch_metadata
-from fastapi import Request, Response, APIRouter, BackgroundTasks
+from fastapi import Request, Response, APIRouter
 
 
 router = APIRouter(
@@ -30,7 +29,6 @@ def settings_get(secret_key: str = "") -> dict:
 async def settings_post(
     request: Request,
     response: Response,
-    background_tasks: BackgroundTasks,
     secret_key: str = "",
 ) -> dict:
     init_time = perf_counter()
@@ -48,7 +46,14 @@ async def settings_post(
                 200, "Config successfully uploaded to database.", True, None, init_time
             ).__json__()
         elif condition == 2:
-            background_tasks.add_task(fetch_metadata)
+            if not builder.start():
+                return DResponse(
+                    200,
+                    "Config successfully uploaded to database. A metadata build is already running.",
+                    True,
+                    None,
+                    init_time,
+                ).__json__()
             return DResponse(
                 200,
                 "Config successfully uploaded to database. Metadata generation started.",
@@ -1,4 +1,3 @@
-import requests
 from app.apis import rclone
 from httpx import AsyncClient
 from time import perf_counter
@@ -24,12 +23,14 @@ excluded_headers = [
 
 
 @router.get("/info/{rclone_index}/{id}", status_code=200)
-def info(rclone_index: int, id: str):
+async def info(rclone_index: int, id: str):
     init_time = perf_counter()
 
     rc = rclone[rclone_index]
+    # The config holds the token rclone last refreshed
+    rc.fs_conf = await rc.rc_conf_async()
     qualities = {"37": "1080p HD", "22": "720p HD", "59": "480p SD", "18": "360p SD"}
-    transcoded_request = requests.get(
+    transcoded_request = await stream_client.get(
         "https://drive.google.com/get_video_info?docid=%s" % (id),
         headers={"Authorization": "Bearer %s" % (rc.fs_conf["token"]["access_token"])},
     )
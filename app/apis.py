@@ -2,9 +2,13 @@ from typing import Dict
 from app.settings import settings
 from app.core.mongodb import MongoDB
 from app.core.rclone import RCloneAPI
+from app.core.builder import BuildExecutor
+from app.core.supervisor import RCloneSupervisor
 
 
 mongo = MongoDB(
     settings.MONGODB_DOMAIN, settings.MONGODB_USERNAME, settings.MONGODB_PASSWORD
 )
 rclone: Dict[int, RCloneAPI] = {}
+builder = BuildExecutor()
+supervisor = RCloneSupervisor(settings.RCLONE_LISTEN_PORT)
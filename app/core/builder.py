@@ -0,0 +1,163 @@
+import signal
+import asyncio
+import logging
+import multiprocessing
+from queue import Empty
+from typing import Optional
+from datetime import datetime, timezone
+
+
+logger = logging.getLogger(__name__)
+
+
+def run_build(
+    queue: multiprocessing.Queue, incremental: Optional[bool], resume: bool = True
+):
+    """Entrypoint of the build worker process"""
+    from app.apis import mongo, rclone
+    from app.core.rclone import RCloneAPI
+    from app.core.cron import fetch_metadata
+    from app.core.progress import build_progress
+
+    def terminate(signum, frame):
+        # Takes the category workers down with the build
+        for child in multiprocessing.active_children():
+            child.terminate()
+        raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+    build_progress.sink = queue.put
+    try:
+        for index, category in enumerate(mongo.get_categories()):
+            rclone[index] = RCloneAPI(category, index)
+        stats = fetch_metadata(incremental, resume, queue)
+    except BaseException as e:
+        queue.put({"state": "failed", "error": repr(e)})
+        raise
+    queue.put({"state": "finished", "stats": stats})
+
+
+def run_refresh(queue: multiprocessing.Queue):
+    """Entrypoint of the worker process of a changes feed refresh"""
+    from app.core.cron import refresh_metadata
+    from app.core.progress import build_progress
+
+    build_progress.sink = queue.put
+    try:
+        stats = refresh_metadata()
+    except BaseException as e:
+        queue.put({"state": "failed", "error": repr(e)})
+        raise
+    queue.put({"state": "finished", "stats": stats})
+
+
+class BuildExecutor:
+    """Runs metadata builds in a dedicated worker process, one at a time"""
+
+    def __init__(self):
+        # MongoClient instances are not fork-safe
+        self.context = multiprocessing.get_context("spawn")
+        self.process: Optional[multiprocessing.Process] = None
+        self.queue: Optional[multiprocessing.Queue] = None
+        self.status: dict = {"state": "idle"}
+
+    def __json__(self) -> dict:
+        return {**self.status, "running": self.is_running()}
+
+    def is_running(self) -> bool:
+        """Checks whether a build worker is alive"""
+        return self.process is not None and self.process.is_alive()
+
+    def start(
+        self,
+        incremental: Optional[bool] = None,
+        resume: bool = True,
+        refresh: bool = False,
+    ) -> bool:
+        """Starts a build in the worker process
+
+        An unfinished build is resumed from its checkpoints unless ``resume`` is False.
+        With ``refresh``, only the items found in the TMDB changes feeds are updated.
+
+        Returns:
+            bool: False if a build is already running
+        """
+        if self.is_running():
+            logger.warning("A metadata build is already running")
+            return False
+        self.queue = self.context.Queue()
+        self.process = self.context.Process(
+            target=run_refresh if refresh else run_build,
+            args=(self.queue,) if refresh else (self.queue, incremental, resume),
+            name="dester-build",
+            # Daemonic processes cannot start the category workers
+            daemon=False,
+        )
+        self.process.start()
+        self.status = {
+            "state": "running",
+            "pid": self.process.pid,
+            "mode": "refresh" if refresh else "build",
+            "incremental": incremental,
+            "started_at": datetime.now(timezone.utc),
+            "finished_at": None,
+            "phase": "starting",
+            "category": "",
+            "done": 0,
+            "total": 0,
+            "resumed": False,
+            "categories": {},
+        }
+        logger.info("Started metadata build in worker process %s", self.process.pid)
+        asyncio.get_event_loop().create_task(self.monitor(self.process, self.queue))
+        return True
+
+    def cancel(self) -> bool:
+        """Terminates the running build
+
+        Returns:
+            bool: False if no build is running
+        """
+        if not self.is_running():
+            return False
+        self.process.terminate()
+        self.status["state"] = "cancelled"
+        logger.info("Cancelled metadata build in worker process %s", self.process.pid)
+        return True
+
+    async def wait(self):
+        """Waits for the running build to exit"""
+        while self.is_running():
+            await asyncio.sleep(1)
+
+    async def monitor(
+        self, process: multiprocessing.Process, queue: multiprocessing.Queue
+    ):
+        """Collects progress reports from the worker process until it exits"""
+        while process.is_alive():
+            self.drain(queue)
+            await asyncio.sleep(0.5)
+        if process is not self.process:
+            # A newer build has already replaced this one
+            return
+        self.drain(queue)
+        if self.status["state"] == "running":
+            self.status["state"] = "failed"
+            self.status["error"] = f"Worker exited with code {process.exitcode}"
+        self.status["finished_at"] = datetime.now(timezone.utc)
+        if self.status["state"] == "failed":
+            logger.error("Metadata build failed: %s", self.status.get("error"))
+        queue.close()
+
+    def drain(self, queue: multiprocessing.Queue):
+        """Applies every pending progress report to the build status"""
+        while True:
+            try:
+                report = queue.get_nowait()
+            except (Empty, OSError, ValueError):
+                return
+            if self.status["state"] == "cancelled":
+                continue
+            if "categories" in report:
+                self.status["categories"].update(report.pop("categories"))
+            self.status.update(report)
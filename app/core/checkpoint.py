@@ -0,0 +1,167 @@
+import asyncio
+from uuid import uuid4
+from hashlib import sha1
+import ujson as json
+from app import logger
+from typing import Dict, List, Optional
+from pymongo import InsertOne
+from pymongo.collection import Collection
+from datetime import datetime, timezone
+
+
+class CategoryCheckpoint:
+    """Checkpoint of a single category within a build
+
+    It holds the listing snapshot, the identified file IDs and the keys of the
+    items already written to the staging catalog.
+    """
+
+    chunk_size: int = 1000
+
+    def __init__(self, col: Collection, build_id: str, rclone_index: int):
+        self.col = col
+        self.build_id = build_id
+        self.rclone_index = rclone_index
+        self.prefix = f"{build_id}:{rclone_index}"
+        self.identified: Dict[str, Optional[int]] = {}
+        self.written: set = set()
+        for document in self.col.find(
+            {"_id": {"$regex": f"^{self.prefix}:identified:"}}
+        ):
+            self.identified.update(document["items"])
+        for document in self.col.find({"_id": {"$regex": f"^{self.prefix}:written:"}}):
+            self.written.update(document["items"])
+
+    def load_listing(self, record: type) -> Optional[list]:
+        """Returns the listing snapshot as records, if one was saved"""
+        chunks = list(
+            self.col.find({"_id": {"$regex": f"^{self.prefix}:listing:"}}).sort(
+                "seq", 1
+            )
+        )
+        if len(chunks) == 0:
+            return None
+        return [
+            record.from_json(item)
+            for chunk in chunks
+            for item in json.loads(chunk["items"])
+        ]
+
+    def save_listing(self, listing: list):
+        """Saves the listing in chunks small enough for MongoDB documents"""
+        operations = [
+            InsertOne(
+                {
+                    "_id": f"{self.prefix}:listing:{seq}",
+                    "seq": seq,
+                    "items": json.dumps(
+                        [item.__json__() for item in listing[x : x + self.chunk_size]]
+                    ),
+                }
+            )
+            for seq, x in enumerate(range(0, len(listing), self.chunk_size))
+        ]
+        if len(operations) > 0:
+            self.col.bulk_write(operations, ordered=False)
+
+    def save_identified(self, identified: Dict[str, Optional[int]]):
+        """Saves the TMDB IDs of identified files, None marking unidentified ones"""
+        self.identified.update(identified)
+        items = list(identified.items())
+        operations = [
+            InsertOne(
+                {
+                    "_id": f"{self.prefix}:identified:{uuid4().hex}",
+                    "items": items[x : x + self.chunk_size],
+                }
+            )
+            for x in range(0, len(items), self.chunk_size)
+        ]
+        if len(operations) > 0:
+            self.col.bulk_write(operations, ordered=False)
+
+    async def save_written(self, keys: List):
+        """Saves the keys of a batch of items written to the staging catalog"""
+        self.written.update(keys)
+        await asyncio.to_thread(
+            self.col.insert_one,
+            {"_id": f"{self.prefix}:written:{uuid4().hex}", "items": keys},
+        )
+
+
+class BuildCheckpoint:
+    """Persists the progress of a build so that it can resume after a restart"""
+
+    def __init__(self, col: Collection):
+        self.col = col
+        self.state: dict = {}
+
+    @staticmethod
+    def config_hash(categories: list) -> str:
+        return sha1(json.dumps(categories, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def resume(self, categories: list) -> bool:
+        """Loads an unfinished build that ran with the same categories
+
+        Returns:
+            bool: True if the build is being resumed
+        """
+        state = self.col.find_one({"_id": "build"})
+        if not state or state["config_hash"] != self.config_hash(categories):
+            return False
+        self.state = state
+        self.col.update_one({"_id": "build"}, {"$inc": {"resumed": 1}})
+        logger.info(
+            "Resuming build %s, %s categories already done",
+            state["build_id"],
+            len(state["categories_done"]),
+        )
+        return True
+
+    def start(self, categories: list, incremental: bool):
+        """Discards any previous checkpoint and starts a fresh build"""
+        self.col.delete_many({})
+        self.state = {
+            "_id": "build",
+            "build_id": uuid4().hex,
+            "config_hash": self.config_hash(categories),
+            "incremental": incremental,
+            "started_at": datetime.now(timezone.utc),
+            "resumed": 0,
+            "categories_done": [],
+            "stats": {},
+        }
+        self.col.insert_one(self.state)
+
+    @property
+    def build_id(self) -> str:
+        return self.state["build_id"]
+
+    @property
+    def incremental(self) -> bool:
+        return self.state["incremental"]
+
+    def is_category_done(self, rclone_index: int) -> bool:
+        return rclone_index in self.state["categories_done"]
+
+    def category_stats(self, rclone_index: int) -> Dict[str, int]:
+        return self.state["stats"].get(str(rclone_index), {})
+
+    def category_done(self, rclone_index: int, stats: Dict[str, int]):
+        """Marks a category as done and drops its item checkpoints"""
+        self.state["categories_done"].append(rclone_index)
+        self.state["stats"][str(rclone_index)] = stats
+        self.col.update_one(
+            {"_id": "build"},
+            {
+                "$push": {"categories_done": rclone_index},
+                "$set": {f"stats.{rclone_index}": stats},
+            },
+        )
+        self.col.delete_many(
+            {"_id": {"$regex": f"^{self.state['build_id']}:{rclone_index}:"}}
+        )
+
+    def finish(self):
+        """Deletes every checkpoint once the build is published"""
+        self.col.delete_many({})
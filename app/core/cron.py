@@ -1,43 +1,579 @@
+import os
+import asyncio
+import multiprocessing
 from app import logger
+from time import perf_counter
+from typing import Dict, List, Tuple, Optional
 from app.core.tmdb import TMDB
+from app.models import Movie, Series
+from app.core.rclone import RCloneAPI
+from app.core.listing_snapshot import ListingSnapshot
+from app.core.listing import MovieFile, SeriesFolder
+from app.core.writer import BulkWriter
+from app.core.tmdb_export import TMDBExport
 from app.apis import mongo, rclone
-from pymongo import TEXT, DESCENDING
-from app.utils import generate_movie_metadata, generate_series_metadata
+from dateutil.parser import isoparse
+from datetime import datetime, timezone, timedelta
+from pymongo import DeleteMany, ReplaceOne, UpdateMany
+from app.core.progress import build_progress
+from concurrent.futures import ProcessPoolExecutor
+from app.utils import build_movies, build_series, is_overridden, identify_movie_files
+from app.core.checkpoint import BuildCheckpoint, CategoryCheckpoint
 
 
-def fetch_metadata():
-    """Generates the metadata for each category"""
+def normalize_time(value) -> datetime:
+    """Returns a naive UTC datetime with the millisecond precision MongoDB stores"""
+    if isinstance(value, str):
+        value = isoparse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
 
-    tmdb = TMDB(api_key=mongo.config["tmdb"]["api_key"])
-    series_metadata = []
-    movies_metadata = []
+
+def new_build_stats() -> Dict[str, int]:
+    return {"added": 0, "changed": 0, "removed": 0, "unchanged": 0, "unidentified": 0}
+
+
+def fetch_metadata(
+    incremental: Optional[bool] = None,
+    resume: bool = True,
+    queue: Optional[multiprocessing.Queue] = None,
+) -> dict:
+    """Generates the metadata for each category
+
+    Args:
+        incremental (bool, optional): Only identify new or changed files.
+            Defaults to the build config, and is ignored until a full build has completed.
+        resume (bool, optional): Resume an unfinished build from its checkpoints.
+            A resumed build keeps its original mode.
+        queue (Queue, optional): Receives the progress of each category worker
+
+    Returns:
+        dict: The number of added, changed, removed and unchanged items,
+            and the timings and failures of each category
+    """
+    return asyncio.run(generate_metadata(incremental, resume, queue))
+
+
+async def generate_metadata(
+    incremental: Optional[bool] = None,
+    resume: bool = True,
+    queue: Optional[multiprocessing.Queue] = None,
+) -> dict:
+    """Async implementation of ``fetch_metadata``
+
+    Categories are built in parallel, each in a worker process of its own
+    that writes to the staging catalog directly. A failed or crashed category
+    keeps its live items and does not abort the others.
+    """
+    if incremental is None:
+        incremental = mongo.config["build"].get("incremental", True)
+    incremental = incremental and mongo.is_metadata_init
+    start_time = datetime.now(timezone.utc)
+
+    categories = mongo.config["categories"]
+    checkpoint = BuildCheckpoint(mongo.build_checkpoints_col)
+    # A build that died while publishing has no staging catalog left to resume
+    if resume and mongo.is_catalog_staged() and checkpoint.resume(categories):
+        incremental = checkpoint.incremental
+        build_progress.resumed = True
+    else:
+        # Incremental builds apply their changes to a copy of the live catalog
+        mongo.stage_catalog(copy=incremental)
+        checkpoint.start(categories, incremental)
+    TMDBExport("series").sync()
+    TMDBExport("movies").sync()
+
+    stats = new_build_stats()
+    category_stats = []
+    pending = []
     for key, category in rclone.items():
-        logger.info("Generating metadata: %s", category.data.get("name"))
-        if category.data.get("type", "movies") == "series":
-            series_metadata.extend(
-                generate_series_metadata(tmdb, rclone[key].fetch_series(), key)
+        if checkpoint.is_category_done(key):
+            logger.info("Already generated: %s", category.data.get("name"))
+            category_stats.append(
+                {"name": category.data.get("name"), **checkpoint.category_stats(key)}
             )
         else:
-            movies_metadata.extend(
-                generate_movie_metadata(tmdb, rclone[key].fetch_movies(), key)
+            pending.append(key)
+
+    if len(pending) > 0:
+        workers = min(
+            mongo.config["build"].get("workers") or os.cpu_count() or 1, len(pending)
+        )
+        # The TMDB request slots and rate are shared between the workers
+        concurrency = max(1, mongo.config["tmdb"].get("concurrency", 8) // workers)
+        rate = mongo.config["tmdb"].get("rate", 40) / workers
+        logger.info("Building %s categories with %s workers", len(pending), workers)
+        build_progress.start_phase("building", len(pending))
+        slots = asyncio.Semaphore(workers)
+        tasks = [
+            run_in_process(
+                slots,
+                queue,
+                key,
+                checkpoint.build_id,
+                rclone[key].data,
+                concurrency,
+                rate,
             )
-    mongo.movies_col.delete_many({})
-    if len(movies_metadata) > 0:
-        mongo.movies_col.bulk_write(movies_metadata)
-    mongo.movies_col.create_index([("title", TEXT)], background=True, name="title")
-    mongo.series_col.delete_many({})
-    if len(series_metadata) > 0:
-        mongo.series_col.bulk_write(series_metadata)
-    mongo.series_col.create_index([("title", TEXT)], background=True, name="title")
-    mongo.series_col.create_index(
-        [("seasons.episodes.modified_time", DESCENDING)],
-        background=True,
-        name="modified_time",
-    )
+            for key in pending
+        ]
+        for task in asyncio.as_completed(tasks):
+            key, result = await task
+            name = rclone[key].data.get("name")
+            if "error" in result:
+                logger.error(
+                    "Failed to generate %s after %.1fs: %s",
+                    name,
+                    result["elapsed"],
+                    result["error"],
+                )
+                # The category keeps its items from the live catalog
+                mongo.carry_over_category(key)
+            else:
+                logger.info("Generated %s in %.1fs", name, result["elapsed"])
+                checkpoint.category_done(key, result["stats"])
+                build_progress.written += result["written"]
+            category_stats.append({"name": name, **result.pop("stats", {}), **result})
+            build_progress.advance()
+    for category in category_stats:
+        for stat in stats:
+            stats[stat] += category.get(stat, 0)
+
+    # Removes the items of categories that no longer exist
+    stale = {"rclone_index": {"$nin": list(rclone.keys())}}
+    stats["removed"] += mongo.movies_staging_col.delete_many(stale).deleted_count
+    stats["removed"] += mongo.series_staging_col.delete_many(stale).deleted_count
+    stats["categories"] = category_stats
+
+    build_progress.start_phase("publishing")
+    mongo.publish_catalog()
+    checkpoint.finish()
     mongo.set_is_metadata_init(True)
+    mongo.set_last_build_time(start_time)
+    mongo.set_last_build_stats(stats)
+    build_progress.start_phase("done")
+
+    failed = [category["name"] for category in category_stats if "error" in category]
+    logger.info(
+        "METADATA BUILDING COMPLETE! (%s%s) %s added, %s changed, %s removed, %s unchanged, %s unidentified%s.",
+        "incremental" if incremental else "full",
+        ", resumed" if build_progress.resumed else "",
+        stats["added"],
+        stats["changed"],
+        stats["removed"],
+        stats["unchanged"],
+        stats["unidentified"],
+        f", failed: {', '.join(failed)}" if failed else "",
+    )
+    return stats
+
+
+def refresh_metadata() -> Dict[str, int]:
+    """Updates the catalog items that changed on TMDB since the last refresh
+
+    Returns:
+        dict: The number of refreshed movies and series
+    """
+    return asyncio.run(refresh_changed())
+
+
+async def refresh_changed(until: Optional[datetime] = None) -> Dict[str, int]:
+    """Async implementation of ``refresh_metadata``
+
+    The window starts at the end of the last refresh, or at the last build.
+    Only the catalog items found in the TMDB changes feeds are fetched again,
+    and their TMDB fields are updated in place, files and seasons untouched.
+    """
+    until = until or datetime.now(timezone.utc)
+    since = (
+        mongo.get_last_refresh_time()
+        or mongo.get_last_build_time()
+        or until - timedelta(days=1)
+    )
+    tmdb = TMDB(
+        api_key=mongo.config["tmdb"]["api_key"],
+        concurrency=mongo.config["tmdb"].get("concurrency", 8),
+        rate=mongo.config["tmdb"].get("rate", 40),
+    )
+    stats = {}
+    try:
+        await tmdb.start()
+        for data_type, model, cols in (
+            ("movies", Movie, (mongo.movies_col, mongo.movies_staging_col)),
+            ("series", Series, (mongo.series_col, mongo.series_staging_col)),
+        ):
+            catalog = set(await asyncio.to_thread(cols[0].distinct, "tmdb_id"))
+            changed = catalog & await tmdb.get_changes(data_type, since, until)
+            build_progress.start_phase("refreshing", len(changed), category=data_type)
+            # An unfinished build publishes its staging collection later
+            writers = [BulkWriter(col) for col in cols]
+
+            async def fetch(tmdb_id: int):
+                return tmdb_id, await tmdb.get_details(tmdb_id, data_type, fresh=True)
+
+            stats[data_type] = 0
+            for task in asyncio.as_completed([fetch(tmdb_id) for tmdb_id in changed]):
+                tmdb_id, details = await task
+                build_progress.advance()
+                try:
+                    media_info = model.media_info(details)
+                except (KeyError, TypeError, ValueError):
+                    logger.warning("Could not refresh %s %s", data_type, tmdb_id)
+                    continue
+                for writer in writers:
+                    await writer.add(
+                        UpdateMany({"tmdb_id": tmdb_id}, {"$set": media_info})
+                    )
+                stats[data_type] += 1
+            for writer in writers:
+                await writer.flush()
+    finally:
+        tmdb.log_stats()
+        await tmdb.close()
+    mongo.set_last_refresh_time(until)
+    build_progress.start_phase("done")
+    logger.info(
+        "METADATA REFRESH COMPLETE! %s movies and %s series updated since %s.",
+        stats["movies"],
+        stats["series"],
+        since.strftime("%d/%m/%Y, %H:%M:%S"),
+    )
+    return stats
+
+
+async def run_in_process(
+    slots: asyncio.Semaphore,
+    queue: Optional[multiprocessing.Queue],
+    rclone_index: int,
+    *args,
+) -> Tuple[int, dict]:
+    """Runs ``run_category`` in a process of its own, turning a crash into a failure
 
+    A worker that dies abruptly breaks its executor, so every category gets a
+    single worker executor and a crash cannot fail the other categories.
+    """
+    async with slots:
+        start_time = perf_counter()
+        pool = ProcessPoolExecutor(
+            1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_category_worker,
+            initargs=(queue,),
+        )
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                pool, run_category, rclone_index, *args
+            )
+        except Exception as e:
+            result = {"error": repr(e), "elapsed": perf_counter() - start_time}
+        finally:
+            await asyncio.to_thread(pool.shutdown)
+    return rclone_index, result
+
+
+def init_category_worker(queue: Optional[multiprocessing.Queue]):
+    """Initializes a category worker process, which reports its progress per category"""
+    if queue is not None:
+        build_progress.sink = lambda report: queue.put(
+            {"categories": {report["category"]: report}}
+        )
+
+
+def run_category(
+    rclone_index: int, build_id: str, data: dict, concurrency: int, rate: float
+) -> dict:
+    """Builds a single category in a worker process
+
+    Returns:
+        dict: The stats, the elapsed time and the written item count,
+            or the error that stopped the category
+    """
+    start_time = perf_counter()
+    build_progress.written = 0
+    try:
+        rclone[rclone_index] = RCloneAPI(data, rclone_index)
+        stats, requests = asyncio.run(
+            build_isolated_category(rclone_index, build_id, concurrency, rate)
+        )
+    except Exception as e:
+        logger.exception("Failed to generate %s", data.get("name"))
+        return {"error": repr(e), "elapsed": perf_counter() - start_time}
+    return {
+        "stats": stats,
+        "elapsed": perf_counter() - start_time,
+        "written": build_progress.written,
+        "requests": requests,
+    }
+
+
+async def build_isolated_category(
+    rclone_index: int, build_id: str, concurrency: int, rate: float
+) -> Tuple[Dict[str, int], dict]:
+    """Builds a category with a TMDB client of its own
+
+    Returns:
+        tuple: The category stats and the TMDB request counters
+    """
+    tmdb = TMDB(
+        api_key=mongo.config["tmdb"]["api_key"], concurrency=concurrency, rate=rate
+    )
+    try:
+        await tmdb.start()
+        stats = await build_category(
+            tmdb,
+            rclone_index,
+            rclone[rclone_index],
+            CategoryCheckpoint(mongo.build_checkpoints_col, build_id, rclone_index),
+        )
+        return stats, tmdb.__json__()
+    finally:
+        tmdb.log_stats()
+        await tmdb.close()
+        await rclone[rclone_index].rc.aclose()
+
+
+async def build_category(
+    tmdb: TMDB, rclone_index: int, category: RCloneAPI, checkpoint: CategoryCheckpoint
+) -> Dict[str, int]:
+    """Diffs the listing of a category against the staging catalog and applies the changes
+
+    Full builds start from an empty staging catalog, so every item is new.
+    The listing is checkpointed before identification, and every written
+    batch afterwards, so that a restarted build picks up where it stopped.
+    """
+    name = category.data.get("name")
+    logger.info("Generating metadata: %s", name)
+    build_progress.start_phase("listing", category=name)
+    build_progress.written += len(checkpoint.written)
+    language = category.data.get("language", "en")
+    adult = category.data.get("adult", False)
+    batch_size = mongo.config["build"].get("batch_size", 500)
+    is_series = category.data.get("type", "movies") == "series"
+
+    listing = checkpoint.load_listing(SeriesFolder if is_series else MovieFile)
+    if listing is None:
+        build_config = mongo.config["build"]
+        snapshot = None
+        if build_config.get("incremental_listing", True):
+            snapshot = ListingSnapshot(
+                mongo.listing_snapshots_col, rclone_index, category.fs
+            )
+        fetch = (
+            category.fetch_series_async if is_series else category.fetch_movies_async
+        )
+        listing = await fetch(
+            build_config.get("list_concurrency", 8),
+            snapshot,
+            build_config.get("drive_changes", True),
+        )
+        checkpoint.save_listing(listing)
+    if is_series:
+        writer = BulkWriter(
+            mongo.series_staging_col, batch_size, checkpoint.save_written
+        )
+        stats = await diff_series(tmdb, listing, rclone_index, writer, language, adult)
+    else:
+        writer = BulkWriter(
+            mongo.movies_staging_col, batch_size, checkpoint.save_written
+        )
+        stats = await diff_movies(
+            tmdb, listing, rclone_index, writer, checkpoint, language, adult
+        )
+    await writer.flush()
     logger.info(
-        "METADATA BUILDING COMPLETE! %s movies and %s series identified.",
-        len(movies_metadata),
-        len(series_metadata),
+        "%s: %s added, %s changed, %s removed, %s unchanged, %s unidentified",
+        name,
+        stats["added"],
+        stats["changed"],
+        stats["removed"],
+        stats["unchanged"],
+        stats["unidentified"],
     )
+    return stats
+
+
+async def diff_movies(
+    tmdb: TMDB,
+    data: List[MovieFile],
+    rclone_index: int,
+    writer: BulkWriter,
+    checkpoint: Optional[CategoryCheckpoint] = None,
+    language: str = "en",
+    adult: bool = False,
+) -> Dict[str, int]:
+    """Diffs a movie listing against the stored movies by file ID, name and modified time
+
+    Only new, renamed, changed or overridden files are identified, and only the
+    movies whose files were added, changed or removed are regenerated and
+    streamed to the writer.
+    """
+    stats = new_build_stats()
+    stored_files: Dict[str, Tuple[datetime, int, str]] = {}
+    for document in mongo.movies_staging_col.find(
+        {"rclone_index": rclone_index},
+        {"_id": 0, "id": 1, "file_name": 1, "modified_time": 1, "tmdb_id": 1},
+    ):
+        for file_id, file_name, modified_time in zip(
+            document["id"], document["file_name"], document["modified_time"]
+        ):
+            stored_files[file_id] = (
+                normalize_time(modified_time),
+                document["tmdb_id"],
+                file_name,
+            )
+
+    overrides = tmdb.id_cache.overrides()
+    affected = set()
+    pending = []
+    added = []
+    known_ids: Dict[str, int] = {}
+    for drive_meta in data:
+        stored = stored_files.pop(drive_meta.id, None)
+        if stored is None:
+            added.append(drive_meta.id)
+            pending.append(drive_meta)
+        elif (
+            stored[0] != normalize_time(drive_meta.modified_time)
+            or stored[2] != drive_meta.name
+            or is_overridden(
+                overrides, stored[1], drive_meta.name, "movies", language, adult
+            )
+        ):
+            stats["changed"] += 1
+            affected.add(stored[1])
+            pending.append(drive_meta)
+        else:
+            stats["unchanged"] += 1
+            known_ids[drive_meta.id] = stored[1]
+    # Whatever is left was not found in the listing anymore
+    stats["removed"] = len(stored_files)
+    affected.update(stored[1] for stored in stored_files.values())
+
+    identified: Dict[str, int] = {}
+    if checkpoint is not None:
+        # Files searched before a restart, identified or not, are not searched again
+        identified = {
+            drive_meta.id: checkpoint.identified[drive_meta.id]
+            for drive_meta in pending
+            if checkpoint.identified.get(drive_meta.id)
+        }
+        pending = [
+            drive_meta
+            for drive_meta in pending
+            if drive_meta.id not in checkpoint.identified
+        ]
+    build_progress.start_phase("identifying", len(pending))
+    details: Dict[int, asyncio.Task] = {}
+    newly_identified = await identify_movie_files(
+        tmdb, pending, details, language, adult
+    )
+    if checkpoint is not None:
+        checkpoint.save_identified(
+            {
+                drive_meta.id: newly_identified.get(drive_meta.id)
+                for drive_meta in pending
+            }
+        )
+    identified.update(newly_identified)
+    # New files that are not identified are not stored, so they are new again next build
+    stats["added"] = sum(1 for file_id in added if file_id in identified)
+    stats["unidentified"] = len(added) - stats["added"]
+    affected.update(identified.values())
+    known_ids.update(identified)
+    files = [
+        drive_meta for drive_meta in data if known_ids.get(drive_meta.id) in affected
+    ]
+    build_progress.start_phase("fetching", len(files))
+    emptied = set(affected)
+    async for movie in build_movies(tmdb, files, rclone_index, known_ids, details):
+        emptied.discard(movie.tmdb_id)
+        await writer.add(
+            ReplaceOne(
+                {"rclone_index": rclone_index, "tmdb_id": movie.tmdb_id},
+                movie.__json__(),
+                upsert=True,
+            ),
+            movie.tmdb_id,
+        )
+    if emptied:
+        await writer.add(
+            DeleteMany(
+                {"rclone_index": rclone_index, "tmdb_id": {"$in": list(emptied)}}
+            )
+        )
+    return stats
+
+
+async def diff_series(
+    tmdb: TMDB,
+    data: List[SeriesFolder],
+    rclone_index: int,
+    writer: BulkWriter,
+    language: str = "en",
+    adult: bool = False,
+) -> Dict[str, int]:
+    """Diffs a series listing against the stored series by folder ID and fingerprint
+
+    Changed series reuse their stored TMDB ID, so only new, renamed or
+    overridden folders are identified.
+    """
+    stats = new_build_stats()
+    stored_series: Dict[str, dict] = {
+        document["id"]: document
+        for document in mongo.series_staging_col.find(
+            {"rclone_index": rclone_index},
+            {"_id": 0, "id": 1, "file_name": 1, "tmdb_id": 1, "fingerprint": 1},
+        )
+    }
+
+    overrides = tmdb.id_cache.overrides()
+    pending = []
+    added = set()
+    known_ids: Dict[str, int] = {}
+    # Re-identified series that are deleted unless they are identified again
+    unmatched = set()
+    for drive_meta in data:
+        stored = stored_series.pop(drive_meta.id, None)
+        if stored is None:
+            added.add(drive_meta.id)
+            pending.append(drive_meta)
+            continue
+        reidentify = stored.get("file_name") != drive_meta.name or is_overridden(
+            overrides, stored["tmdb_id"], drive_meta.name, "series", language, adult
+        )
+        if reidentify:
+            stats["changed"] += 1
+            unmatched.add(drive_meta.id)
+            pending.append(drive_meta)
+        elif stored.get("fingerprint") != Series.get_fingerprint(drive_meta):
+            stats["changed"] += 1
+            known_ids[drive_meta.id] = stored["tmdb_id"]
+            pending.append(drive_meta)
+        else:
+            stats["unchanged"] += 1
+    stats["removed"] = len(stored_series)
+
+    build_progress.start_phase("identifying", len(pending))
+    async for series in build_series(
+        tmdb, pending, rclone_index, known_ids, language, adult
+    ):
+        await writer.add(
+            ReplaceOne(
+                {"rclone_index": rclone_index, "id": series.id},
+                series.__json__(),
+                upsert=True,
+            ),
+            series.id,
+        )
+        unmatched.discard(series.id)
+        if series.id in added:
+            stats["added"] += 1
+    # Unidentified new folders are counted apart, like unidentified new movie files
+    stats["unidentified"] = len(added) - stats["added"]
+    unmatched.update(stored_series)
+    if len(unmatched) > 0:
+        await writer.add(
+            DeleteMany({"rclone_index": rclone_index, "id": {"$in": list(unmatched)}})
+        )
+    return stats
@@ -0,0 +1,135 @@
+import asyncio
+import regex as re
+from app import logger
+from app.core.parser import clean_file_name
+from typing import Dict, List, Optional
+from pymongo.collection import Collection
+from datetime import datetime, timezone, timedelta
+
+
+class IdentificationCache:
+    """Persistent cache of title searches, including the ones that found nothing
+
+    Entries are keyed on the normalized title, the year, the media type, the
+    language and the adult flag. Negative results expire sooner than matches
+    so that newly added TMDB entries are eventually picked up, while manual
+    overrides never expire.
+    """
+
+    ttl: timedelta = timedelta(days=90)
+    negative_ttl: timedelta = timedelta(days=3)
+
+    def __init__(self, col: Collection):
+        self.col = col
+        self.hits: int = 0
+        self.negative_hits: int = 0
+        self.misses: int = 0
+
+    @staticmethod
+    def normalize_title(title: str) -> str:
+        return re.sub(r"\s+", " ", clean_file_name(title.lower().strip())).strip()
+
+    @classmethod
+    def key(
+        cls,
+        title: str,
+        data_type: str,
+        year: Optional[str] = None,
+        language: str = "en",
+        adult: bool = False,
+    ) -> str:
+        return "|".join(
+            (
+                data_type,
+                cls.normalize_title(title),
+                str(year or ""),
+                language,
+                "adult" if adult else "safe",
+            )
+        )
+
+    async def get(self, key: str) -> Optional[dict]:
+        """Returns a live entry, whose ``tmdb_id`` is None for negative results"""
+        entry = await asyncio.to_thread(self.col.find_one, {"_id": key})
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if entry is None or (entry["expires_at"] and entry["expires_at"] <= now):
+            self.misses += 1
+            return None
+        if entry["tmdb_id"] is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def put(self, key: str, tmdb_id: Optional[int], source: str):
+        """Stores a search result, a None ``tmdb_id`` being a negative result"""
+        await asyncio.to_thread(self.store, key, tmdb_id, source)
+
+    def store(self, key: str, tmdb_id: Optional[int], source: str):
+        now = datetime.now(timezone.utc)
+        if source == "override":
+            expires_at = None
+        elif tmdb_id is None:
+            expires_at = now + self.negative_ttl
+        else:
+            expires_at = now + self.ttl
+        self.col.replace_one(
+            {"_id": key},
+            {
+                "tmdb_id": tmdb_id,
+                "source": source,
+                "expires_at": expires_at,
+                "updated_at": now,
+            },
+            upsert=True,
+        )
+
+    def override(self, key: str, tmdb_id: Optional[int]):
+        """Pins a title to a TMDB ID, or marks it as unidentifiable with None"""
+        self.store(key, tmdb_id, "override")
+
+    def overrides(self) -> Dict[str, Optional[int]]:
+        """Returns the TMDB IDs of every overridden title"""
+        return {
+            entry["_id"]: entry["tmdb_id"]
+            for entry in self.col.find({"source": "override"}, {"tmdb_id": 1})
+        }
+
+    def invalidate(
+        self,
+        key: Optional[str] = None,
+        negative_only: bool = False,
+        overrides: bool = False,
+    ) -> int:
+        """Deletes one entry, or every entry (only the negative ones if asked)
+
+        Overrides are kept when deleting every entry unless ``overrides`` is set.
+        """
+        if key is not None:
+            return self.col.delete_many({"_id": key}).deleted_count
+        query: dict = {}
+        if negative_only:
+            query["tmdb_id"] = None
+        if not overrides:
+            query["source"] = {"$ne": "override"}
+        return self.col.delete_many(query).deleted_count
+
+    def find(
+        self, query: str = "", negative_only: bool = False, limit: int = 50
+    ) -> List[dict]:
+        """Lists entries whose key contains the query"""
+        match: dict = {}
+        if query:
+            match["_id"] = {"$regex": re.escape(query), "$options": "i"}
+        if negative_only:
+            match["tmdb_id"] = None
+        return list(self.col.find(match).limit(limit))
+
+    def log_stats(self):
+        """Logs the hit / miss counters"""
+        logger.info(
+            "Identification cache: %s hits, %s negative hits, %s misses",
+            self.hits,
+            self.negative_hits,
+            self.misses,
+        )
@@ -0,0 +1,373 @@
+import sys
+import codecs
+import regex as re
+from os import path
+from json import JSONDecoder, JSONDecodeError
+from typing import Dict, List, Iterable, Iterator, Optional
+
+
+LIST_START = re.compile(r'"list"\s*:\s*\[')
+SEPARATOR = re.compile(r"[\s,]*")
+
+
+def iter_list(chunks: Iterable[bytes]) -> Iterator[dict]:
+    """Incrementally parses the ``list`` array of an operations/list response
+
+    Items are yielded as soon as they are complete, and only the unparsed
+    tail of the response is kept, so memory does not grow with the response.
+
+    Raises:
+        ValueError: If the response ended before its list did
+    """
+    decoder = JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer, position, started = "", 0, False
+    for chunk in chunks:
+        buffer = buffer[position:] + text.decode(chunk)
+        position = 0
+        if not started:
+            match = LIST_START.search(buffer)
+            if match is None:
+                continue
+            position, started = match.end(), True
+        while True:
+            position = SEPARATOR.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if buffer[position] == "]":
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except JSONDecodeError:
+                # The item continues in the next chunk
+                break
+            yield item
+    raise ValueError("The listing ended before its list did")
+
+
+SEASON_PATTERN = re.compile(r"(?<=Season.|season.|S|s)\d{1,3}|^\d{1,3}$")
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov", ".webm", ".flv")
+SUBTITLE_EXTENSIONS = (".vtt", ".srt", ".ass", ".ssa")
+
+
+class Entry:
+    """A listed folder or subtitle file"""
+
+    __slots__ = ("id", "name", "path")
+
+    def __init__(self, id: str, name: str, path: str):
+        self.id = id
+        self.name = name
+        self.path = path
+
+    def __json__(self) -> dict:
+        return {"id": self.id, "name": self.name, "path": self.path}
+
+    @classmethod
+    def from_json(cls, data: Optional[dict]) -> Optional["Entry"]:
+        return cls(data["id"], data["name"], data["path"]) if data else None
+
+
+class MovieFile:
+    """A listed movie file, with its folder and subtitles"""
+
+    __slots__ = (
+        "id",
+        "name",
+        "path",
+        "parent",
+        "mime_type",
+        "size",
+        "modified_time",
+        "subtitles",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        name: str,
+        path: str,
+        parent: Optional[Entry],
+        mime_type: str,
+        size: int,
+        modified_time: str,
+        subtitles: Optional[List[Entry]] = None,
+    ):
+        self.id = id
+        self.name = name
+        self.path = path
+        self.parent = parent
+        self.mime_type = mime_type
+        self.size = size
+        self.modified_time = modified_time
+        self.subtitles = subtitles or []
+
+    def __json__(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "path": self.path,
+            "parent": self.parent.__json__() if self.parent else None,
+            "mime_type": self.mime_type,
+            "size": self.size,
+            "modified_time": self.modified_time,
+            "subtitles": [subtitle.__json__() for subtitle in self.subtitles],
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "MovieFile":
+        return cls(
+            data["id"],
+            data["name"],
+            data["path"],
+            Entry.from_json(data["parent"]),
+            data["mime_type"],
+            data["size"],
+            data["modified_time"],
+            [Entry.from_json(subtitle) for subtitle in data["subtitles"]],
+        )
+
+
+class EpisodeFile:
+    """A listed episode file, its parent being the ID of its season folder"""
+
+    __slots__ = ("id", "name", "path", "parent", "mime_type", "size", "modified_time")
+
+    def __init__(
+        self,
+        id: str,
+        name: str,
+        path: str,
+        parent: str,
+        mime_type: str,
+        size: int,
+        modified_time: str,
+    ):
+        self.id = id
+        self.name = name
+        self.path = path
+        self.parent = parent
+        self.mime_type = mime_type
+        self.size = size
+        self.modified_time = modified_time
+
+    def __json__(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "EpisodeFile":
+        return cls(*(data[field] for field in cls.__slots__))
+
+
+class SeasonFolder:
+    """A listed season folder, its parent being the ID of its series folder"""
+
+    __slots__ = (
+        "id",
+        "name",
+        "path",
+        "parent",
+        "mime_type",
+        "modified_time",
+        "episodes",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        name: str,
+        path: str,
+        parent: str,
+        mime_type: str,
+        modified_time: str,
+        episodes: Optional[List[EpisodeFile]] = None,
+    ):
+        self.id = id
+        self.name = name
+        self.path = path
+        self.parent = parent
+        self.mime_type = mime_type
+        self.modified_time = modified_time
+        self.episodes = episodes or []
+
+    def __json__(self) -> dict:
+        data = {field: getattr(self, field) for field in self.__slots__[:-1]}
+        data["episodes"] = [episode.__json__() for episode in self.episodes]
+        return data
+
+    @classmethod
+    def from_json(cls, data: dict) -> "SeasonFolder":
+        return cls(
+            *(data[field] for field in cls.__slots__[:-1]),
+            [EpisodeFile.from_json(episode) for episode in data["episodes"]],
+        )
+
+
+class SeriesFolder:
+    """A listed series folder with its season folders by season number"""
+
+    __slots__ = (
+        "id",
+        "name",
+        "path",
+        "parent",
+        "mime_type",
+        "modified_time",
+        "seasons",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        name: str,
+        path: str,
+        parent: Optional[str],
+        mime_type: str,
+        modified_time: str,
+        seasons: Optional[Dict[str, SeasonFolder]] = None,
+    ):
+        self.id = id
+        self.name = name
+        self.path = path
+        self.parent = parent
+        self.mime_type = mime_type
+        self.modified_time = modified_time
+        self.seasons = seasons or {}
+
+    def __json__(self) -> dict:
+        data = {field: getattr(self, field) for field in self.__slots__[:-1]}
+        data["seasons"] = {
+            key: season.__json__() for key, season in self.seasons.items()
+        }
+        return data
+
+    @classmethod
+    def from_json(cls, data: dict) -> "SeriesFolder":
+        return cls(
+            *(data[field] for field in cls.__slots__[:-1]),
+            {
+                key: SeasonFolder.from_json(season)
+                for key, season in data["seasons"].items()
+            },
+        )
+
+
+class MovieTree:
+    """Collects the video files of a movie listing and matches them with their subtitles
+
+    Subtitles are matched by path without extension and language suffix, whether
+    they are listed before or after their video.
+    """
+
+    def __init__(self):
+        self.movies: List[MovieFile] = []
+        self.folders: Dict[str, Entry] = {}
+        self.videos: Dict[str, MovieFile] = {}
+        self.subtitles: Dict[str, List[Entry]] = {}
+
+    def add(self, item: dict):
+        name = item["Name"]
+        item_id = item.get("ID", item["Path"])
+        if item["IsDir"]:
+            self.folders[item["Path"]] = Entry(item_id, name, item["Path"])
+        elif "video" in item["MimeType"] or name.lower().endswith(VIDEO_EXTENSIONS):
+            stem = path.splitext(item["Path"])[0]
+            movie = MovieFile(
+                item_id,
+                name,
+                item["Path"],
+                self.folders.get(item["Path"].rpartition("/")[0]),
+                sys.intern(item["MimeType"]),
+                item["Size"],
+                item["ModTime"],
+                self.subtitles.pop(stem, None),
+            )
+            self.videos[stem] = movie
+            self.movies.append(movie)
+        elif name.endswith(SUBTITLE_EXTENSIONS):
+            stem = path.splitext(item["Path"])[0]
+            # Language suffixes like ".en" or ".eng"
+            if stem[-3:-2] == ".":
+                stem = stem[:-3]
+            elif stem[-4:-3] == ".":
+                stem = stem[:-4]
+            subtitle = Entry(item_id, name, item["Path"])
+            if stem in self.videos:
+                self.videos[stem].subtitles.append(subtitle)
+            else:
+                self.subtitles.setdefault(stem, []).append(subtitle)
+
+    def build(self, items: Iterable[dict]) -> List[MovieFile]:
+        """Adds every item of a listing and returns the movie files"""
+        for item in items:
+            self.add(item)
+        return self.movies
+
+
+class SeriesTree:
+    """Builds the series, season and episode structure of a series listing
+
+    Series and season folders are kept in dicts keyed by their path, so every
+    entry finds its parent record in constant time, and records point to
+    their parent by folder ID only. Folders are listed before their contents.
+    """
+
+    def __init__(self):
+        self.series: List[SeriesFolder] = []
+        self.series_folders: Dict[str, SeriesFolder] = {}
+        self.season_folders: Dict[str, SeasonFolder] = {}
+
+    @staticmethod
+    def season_number(name: str) -> str:
+        season = SEASON_PATTERN.search(name)
+        season = season.group() if season else "1"
+        return season if season == "0" else season.lstrip("0")
+
+    def add(self, item: dict):
+        parent_path = item["Path"].rpartition("/")[0]
+        item_id = item.get("ID", item["Path"])
+        if not item["IsDir"]:
+            season = self.season_folders.get(parent_path)
+            if season is not None:
+                season.episodes.append(
+                    EpisodeFile(
+                        item_id,
+                        item["Name"],
+                        item["Path"],
+                        season.id,
+                        sys.intern(item["MimeType"]),
+                        item["Size"],
+                        item["ModTime"],
+                    )
+                )
+        elif not parent_path:
+            series = SeriesFolder(
+                item_id,
+                item["Name"],
+                item["Path"],
+                None,
+                sys.intern(item["MimeType"]),
+                item["ModTime"],
+            )
+            self.series.append(series)
+            self.series_folders[item["Path"]] = series
+        elif parent_path in self.series_folders:
+            series = self.series_folders[parent_path]
+            season_number = self.season_number(item["Name"])
+            # Folders of the same season are merged into the first one
+            if season_number not in series.seasons:
+                series.seasons[season_number] = SeasonFolder(
+                    item_id,
+                    item["Name"],
+                    item["Path"],
+                    series.id,
+                    sys.intern(item["MimeType"]),
+                    item["ModTime"],
+                )
+            self.season_folders[item["Path"]] = series.seasons[season_number]
+
+    def build(self, items: Iterable[dict]) -> List[SeriesFolder]:
+        """Adds every item of a listing and returns the series"""
+        for item in items:
+            self.add(item)
+        return self.series
@@ -0,0 +1,152 @@
+import ujson as json
+from app import logger
+from pymongo import ASCENDING, InsertOne
+from pymongo.collection import Collection
+from datetime import datetime, timezone, timedelta
+from typing import Set, Dict, List, Tuple, Iterable, Iterator, Optional
+
+
+# Listing items are kept as tuples of these fields
+FIELDS: Tuple[str, ...] = ("Path", "Name", "IsDir", "MimeType", "Size", "ModTime", "ID")
+IS_DIR: int = FIELDS.index("IsDir")
+
+
+class ListingSnapshot:
+    """Directories of a category's remote as of its last listing
+
+    Every directory is stored with its ID, ModTime, child count and direct
+    children. A directory whose ModTime did not change still has the same
+    children, so the next listing reuses the children of unchanged leaf
+    directories (season and movie folders) instead of listing them again.
+    Directories holding directories are always listed, because a change
+    deeper down does not touch their own ModTime.
+    """
+
+    # Snapshots older than this are replaced by a full listing
+    max_age: timedelta = timedelta(days=7)
+    chunk_size: int = 500
+    # Children per document, large folders span several documents
+    document_size: int = 1000
+
+    def __init__(self, col: Collection, rclone_index: int, fs: str):
+        self.col = col
+        self.rclone_index = rclone_index
+        self.fs = fs
+        self.dirs: Dict[str, dict] = {}
+        self.listed_at: Optional[datetime] = None
+        self.full_at: Optional[datetime] = None
+        self.reused: int = 0
+
+    def load(self) -> bool:
+        """Loads the snapshot
+
+        Returns:
+            bool: False if there is no complete, recent snapshot of this remote
+        """
+        # Loads and saves find and replace the documents of a remote by its index
+        self.col.create_index([("rclone_index", ASCENDING)], name="rclone_index")
+        root = self.col.find_one({"_id": f"{self.rclone_index}:root"})
+        if root is None or root.get("fs") != self.fs:
+            return False
+        self.listed_at = root["listed_at"].replace(tzinfo=timezone.utc)
+        self.full_at = root["full_at"].replace(tzinfo=timezone.utc)
+        if datetime.now(timezone.utc) - self.full_at > self.max_age:
+            return False
+        for document in self.col.find(
+            {"rclone_index": self.rclone_index, "path": {"$exists": True}}
+        ):
+            cached = self.dirs.setdefault(document["path"], {"chunks": {}})
+            cached.update(
+                id=document["id"],
+                mod_time=document["mod_time"],
+                children=document["children"],
+            )
+            cached["chunks"][document.get("seq", 0)] = document["items"]
+        return True
+
+    def folder_ids(self) -> Set[str]:
+        """Returns the IDs of the snapshot's directories"""
+        return {cached["id"] for cached in self.dirs.values()}
+
+    def unchanged(self, item: dict, dirty: Set[str]) -> bool:
+        """Whether the cached children of a listed directory can be reused"""
+        cached = self.dirs.get(item["Path"])
+        return (
+            cached is not None
+            and cached["id"] == item.get("ID", item["Path"])
+            and cached["mod_time"] == item["ModTime"]
+            and cached["id"] not in dirty
+            and not any(child[IS_DIR] for child in self.children(item["Path"]))
+        )
+
+    def children(self, path: str) -> List[tuple]:
+        cached = self.dirs[path]
+        if "items" not in cached:
+            cached["items"] = [
+                child
+                for _, chunk in sorted(cached.pop("chunks").items())
+                for child in json.loads(chunk)
+            ]
+        return cached["items"]
+
+    def reuse(self, path: str) -> List[dict]:
+        """Returns the cached children of an unchanged directory"""
+        self.reused += 1
+        return [dict(zip(FIELDS, child)) for child in self.children(path)]
+
+    def record(self, items: Iterable[dict], full: bool) -> Iterator[dict]:
+        """Passes a listing through, saving it as the new snapshot once it is complete"""
+        listed_at = datetime.now(timezone.utc)
+        dirs: Dict[str, dict] = {"": {"id": "", "mod_time": "", "items": []}}
+        for item in items:
+            if item["IsDir"]:
+                dirs.setdefault(item["Path"], {"items": []}).update(
+                    id=item.get("ID", item["Path"]), mod_time=item["ModTime"]
+                )
+            parent_path = item["Path"].rpartition("/")[0]
+            dirs.setdefault(parent_path, {"items": []})["items"].append(
+                tuple(item.get(field) for field in FIELDS[:-1])
+                + (item.get("ID", item["Path"]),)
+            )
+            yield item
+        self.save(dirs, listed_at, listed_at if full else self.full_at)
+
+    def save(self, dirs: Dict[str, dict], listed_at: datetime, full_at: datetime):
+        self.col.delete_many({"rclone_index": self.rclone_index})
+        operations = [
+            InsertOne(
+                {
+                    "_id": f"{self.rclone_index}:dir:{path}:{seq}",
+                    "rclone_index": self.rclone_index,
+                    "path": path,
+                    "seq": seq,
+                    "id": entry.get("id", path),
+                    "mod_time": entry.get("mod_time", ""),
+                    "children": len(entry["items"]),
+                    "items": json.dumps(entry["items"][x : x + self.document_size]),
+                }
+            )
+            for path, entry in dirs.items()
+            # Empty folders still get a document
+            for seq, x in enumerate(
+                range(0, max(len(entry["items"]), 1), self.document_size)
+            )
+        ]
+        for x in range(0, len(operations), self.chunk_size):
+            self.col.bulk_write(operations[x : x + self.chunk_size], ordered=False)
+        # Written last, a snapshot without it is incomplete
+        self.col.insert_one(
+            {
+                "_id": f"{self.rclone_index}:root",
+                "rclone_index": self.rclone_index,
+                "fs": self.fs,
+                "listed_at": listed_at,
+                "full_at": full_at,
+            }
+        )
+        logger.info(
+            "Saved the listing snapshot of %s: %s directories, %s reused",
+            self.fs,
+            len(dirs),
+            self.reused,
+        )
@@ -1,7 +1,8 @@
 import certifi
+from typing import Optional
 from croniter import croniter
 from datetime import datetime, timezone
-from pymongo import TEXT, UpdateOne, MongoClient
+from pymongo import TEXT, ASCENDING, DESCENDING, UpdateOne, MongoClient
 
 
 class MongoDB:
@@ -29,6 +30,15 @@ class MongoDB:
         self.movies_cache_col = self.metadata["movies_cache"]
         self.series_col = self.metadata["series"]
         self.series_cache_col = self.metadata["series_cache"]
+        # Builds write into the staging collections which then replace the live ones
+        self.movies_staging_col = self.metadata["movies_staging"]
+        self.series_staging_col = self.metadata["series_staging"]
+        self.movies_previous_col = self.metadata["movies_previous"]
+        self.series_previous_col = self.metadata["series_previous"]
+        self.tmdb_cache_col = self.metadata["tmdb_cache"]
+        self.identification_cache_col = self.metadata["identification_cache"]
+        self.build_checkpoints_col = self.metadata["build_checkpoints"]
+        self.listing_snapshots_col = self.metadata["listing_snapshots"]
 
         self.config = {
             "app": {},
@@ -107,14 +117,15 @@ class MongoDB:
         self.is_series_cache_init = result["is_series_cache_init"]
         return result["is_series_cache_init"]
 
-    def get_next_build_time(self) -> datetime:
-        "Gets the next time for the cron job"
+    def get_next_build_time(self, attempted_at: Optional[datetime] = None) -> datetime:
+        "Gets the next time for the cron job, after the last build or build attempt"
         build_config = self.config_col.find_one({"build": {"$exists": True}}) or {
             "build": {"cron": "0 */8 * * *"}
         }
-        last_build_time = self.other_col.find_one(
-            {"last_build_time": {"$exists": True}}
-        ) or datetime.now(tz=timezone.utc)
+        last_build_time = self.get_last_build_time() or datetime.now(tz=timezone.utc)
+        if attempted_at is not None:
+            # Failed builds do not record a build time, they wait for the next slot
+            last_build_time = max(last_build_time, attempted_at)
         cron_expr = build_config["build"].get("cron", "0 */8 * * *")
         cron = croniter(cron_expr, last_build_time)
         return cron.get_next(datetime)
@@ -291,7 +302,12 @@ class MongoDB:
 
     def set_tmdb(self, data: dict):
         """Updates the TMDB config with one supplied by the user"""
-        update_data: dict = {"api_key": data.get("api_key", "")}
+        update_data: dict = {
+            "api_key": data.get("api_key", ""),
+            "concurrency": data.get("concurrency", 8),
+            # Requests per second allowed by TMDB
+            "rate": data.get("rate", 40),
+        }
         update_action: UpdateOne = UpdateOne(
             {"tmdb": {"$exists": True}}, {"$set": {"tmdb": update_data}}, upsert=True
         )
@@ -314,7 +330,22 @@ class MongoDB:
 
     def set_build(self, data: dict):
         """Updates the build config with one supplied by the user"""
-        update_data: dict = {"cron": data.get("cron", "0 */8 * * *")}
+        update_data: dict = {
+            "cron": data.get("cron", "0 */8 * * *"),
+            "incremental": data.get("incremental", True),
+            "batch_size": data.get("batch_size", 500),
+            # Category worker processes, 0 for one per CPU
+            "workers": data.get("workers", 0),
+            # Top-level folders of a category listed at once, 1 for one recursive listing
+            "list_concurrency": data.get("list_concurrency", 8),
+            # Only list the folders that changed since the last build
+            "incremental_listing": data.get("incremental_listing", True),
+            # Find changed Drive folders with a Drive query
+            "drive_changes": data.get("drive_changes", True),
+            # Items refreshed by the refresh scheduler every few minutes
+            "refresh_batch_size": data.get("refresh_batch_size", 50),
+            "refresh_every": data.get("refresh_every", 10),
+        }
         update_action: UpdateOne = UpdateOne(
             {"build": {"$exists": True}}, {"$set": {"build": update_data}}, upsert=True
         )
@@ -354,6 +385,168 @@ class MongoDB:
             self.is_metadata_init = is_metadata_init
         return
 
+    def create_catalog_indexes(self, movies_col, series_col):
+        """Creates the indexes used by the catalog routes, builds and refreshes"""
+        # Incremental builds replace and delete items by category and TMDB / folder ID
+        movies_col.create_index(
+            [("rclone_index", ASCENDING), ("tmdb_id", ASCENDING)], name="rclone_tmdb_id"
+        )
+        series_col.create_index(
+            [("rclone_index", ASCENDING), ("id", ASCENDING)], name="rclone_id"
+        )
+        # Refreshes update every item of a TMDB ID
+        movies_col.create_index([("tmdb_id", ASCENDING)], name="tmdb_id")
+        series_col.create_index([("tmdb_id", ASCENDING)], name="tmdb_id")
+        movies_col.create_index([("title", TEXT)], name="title")
+        series_col.create_index([("title", TEXT)], name="title")
+        series_col.create_index(
+            [("seasons.episodes.modified_time", DESCENDING)], name="modified_time"
+        )
+        movies_col.create_index([("refresh_at", ASCENDING)], name="refresh_at")
+        series_col.create_index([("refresh_at", ASCENDING)], name="refresh_at")
+
+    def stage_catalog(self, copy: bool = False):
+        """Prepares empty staging collections, or copies of the live ones, with their indexes"""
+        for live_col, staging_col in (
+            (self.movies_col, self.movies_staging_col),
+            (self.series_col, self.series_staging_col),
+        ):
+            staging_col.drop()
+            if copy:
+                live_col.aggregate([{"$match": {}}, {"$out": staging_col.name}])
+        self.create_catalog_indexes(self.movies_staging_col, self.series_staging_col)
+
+    def is_catalog_staged(self) -> bool:
+        """Whether the staging collections of an unpublished build exist"""
+        collections = self.metadata.list_collection_names()
+        return (
+            self.movies_staging_col.name in collections
+            and self.series_staging_col.name in collections
+        )
+
+    def carry_over_category(self, rclone_index: int):
+        """Replaces the staged items of a category with its live ones"""
+        for live_col, staging_col in (
+            (self.movies_col, self.movies_staging_col),
+            (self.series_col, self.series_staging_col),
+        ):
+            staging_col.delete_many({"rclone_index": rclone_index})
+            live_col.aggregate(
+                [
+                    {"$match": {"rclone_index": rclone_index}},
+                    {"$merge": {"into": staging_col.name}},
+                ]
+            )
+
+    def publish_catalog(self):
+        """Atomically replaces the live collections with the staging ones
+
+        The live collections are first copied to the previous generation,
+        which stays available for a rollback.
+        """
+        for live_col, previous_col in (
+            (self.movies_col, self.movies_previous_col),
+            (self.series_col, self.series_previous_col),
+        ):
+            live_col.aggregate([{"$match": {}}, {"$out": previous_col.name}])
+        # $out into a new collection only creates the _id index
+        self.create_catalog_indexes(self.movies_previous_col, self.series_previous_col)
+        for live_col, staging_col in (
+            (self.movies_col, self.movies_staging_col),
+            (self.series_col, self.series_staging_col),
+        ):
+            staging_col.rename(live_col.name, dropTarget=True)
+
+    def rollback_catalog(self) -> bool:
+        """Swaps the live collections with the previous generation
+
+        Returns:
+            bool: False if there is no previous generation
+        """
+        collections = self.metadata.list_collection_names()
+        if (
+            self.movies_previous_col.name not in collections
+            or self.series_previous_col.name not in collections
+        ):
+            return False
+        # Both generations get their indexes before they are swapped in
+        self.create_catalog_indexes(self.movies_previous_col, self.series_previous_col)
+        for live_col, staging_col in (
+            (self.movies_col, self.movies_staging_col),
+            (self.series_col, self.series_staging_col),
+        ):
+            live_col.aggregate([{"$match": {}}, {"$out": staging_col.name}])
+        self.create_catalog_indexes(self.movies_staging_col, self.series_staging_col)
+        for live_col, staging_col, previous_col in (
+            (self.movies_col, self.movies_staging_col, self.movies_previous_col),
+            (self.series_col, self.series_staging_col, self.series_previous_col),
+        ):
+            previous_col.rename(live_col.name, dropTarget=True)
+            staging_col.rename(previous_col.name, dropTarget=True)
+        return True
+
+    def get_export_date(self, data_type: str) -> str:
+        "Returns the date of the TMDB export the media cache was synced with"
+        key = f"{data_type}_export_date"
+        result = self.other_col.find_one({key: {"$exists": True}}) or {key: ""}
+        return result[key]
+
+    def set_export_date(self, data_type: str, date_str: str):
+        """Stores the date of the TMDB export the media cache was synced with"""
+        key = f"{data_type}_export_date"
+        self.other_col.update_one(
+            {key: {"$exists": True}}, {"$set": {key: date_str}}, upsert=True
+        )
+        return
+
+    def get_last_build_time(self) -> Optional[datetime]:
+        "Returns when the last metadata build was published"
+        result = self.other_col.find_one({"last_build_time": {"$exists": True}})
+        if result is None:
+            return None
+        return result["last_build_time"].replace(tzinfo=timezone.utc)
+
+    def set_last_build_time(self, last_build_time: datetime):
+        """Stores when the last metadata build was published"""
+        self.other_col.update_one(
+            {"last_build_time": {"$exists": True}},
+            {"$set": {"last_build_time": last_build_time}},
+            upsert=True,
+        )
+        return
+
+    def get_last_refresh_time(self) -> Optional[datetime]:
+        "Returns the end of the window of the last changes feed refresh"
+        result = self.other_col.find_one({"last_refresh_time": {"$exists": True}})
+        if result is None:
+            return None
+        return result["last_refresh_time"].replace(tzinfo=timezone.utc)
+
+    def set_last_refresh_time(self, last_refresh_time: datetime):
+        """Stores the end of the window of the last changes feed refresh"""
+        self.other_col.update_one(
+            {"last_refresh_time": {"$exists": True}},
+            {"$set": {"last_refresh_time": last_refresh_time}},
+            upsert=True,
+        )
+        return
+
+    def get_last_build_stats(self) -> dict:
+        "Returns the item counts of the last metadata build"
+        result = self.other_col.find_one({"last_build_stats": {"$exists": True}}) or {
+            "last_build_stats": {}
+        }
+        return result["last_build_stats"]
+
+    def set_last_build_stats(self, stats: dict):
+        """Stores the item counts of the last metadata build"""
+        self.other_col.update_one(
+            {"last_build_stats": {"$exists": True}},
+            {"$set": {"last_build_stats": stats}},
+            upsert=True,
+        )
+        return
+
     def set_is_movies_cache_init(self, is_movies_cache_init: bool):
         """Sets the movie cache as initialized"""
         if is_movies_cache_init != self.is_movies_cache_init:
@@ -0,0 +1,134 @@
+import regex as re
+from functools import lru_cache
+from typing import List, Iterable, Optional, NamedTuple
+
+
+SERIES_PATTERNS = tuple(
+    re.compile(exp)
+    for exp in (
+        # (2019) The Mandalorian
+        r"^[\(\[\{](?P<year>\d{4})[\)\]\}]\s(?P<title>[^.]+).*$",
+        # The Mandalorian (2019)
+        r"^(?P<title>.*)\s[\(\[\{](?P<year>\d{4})[\)\]\}].*$",
+        # The.Mandalorian.2019.1080p.WEBRip
+        r"^(?P<title>(?:(?!\.\d{4}).)*)\.(?P<year>\d{4}).*$",
+        # The Mandalorian
+        r"^(?P<year>)(?P<title>.*)$",
+    )
+)
+MOVIE_PATTERNS = tuple(
+    re.compile(exp)
+    for exp in (
+        # (2008) Iron Man.mkv
+        r"^[\(\[\{](?P<year>\d{4})[\)\]\}]\s(?P<title>[^.]+).*(?P<extention>\..*)?$",
+        # Iron Man (2008).mkv
+        r"^(?P<title>.*)\s[\(\[\{](?P<year>\d{4})[\)\]\}].*(?P<extention>\..*)?$",
+        # Iron.Man.2008.1080p.WEBRip.DDP5.1.Atmos.x264.mkv
+        r"^(?P<title>(?:(?!\.\d{4}).)*)\.(?P<year>\d{4}).*?(?P<extention>\.\w+)?$",
+        # Iron Man.mkv
+        r"^(?P<year>)(?P<title>.*).*(?P<extention>\..*?)?",
+    )
+)
+CLEAN_PATTERNS = tuple(
+    re.compile(exp)
+    for exp in (
+        r"\((?:\D.+?|.+?\D)\)|\[(?:\D.+?|.+?\D)\]",  # (2016), [2016], etc
+        r"\(?(?:240|360|480|720|1080|1440|2160)p?\)?",  # 1080p, 720p, etc
+        r"\b(?:mp4|mkv|wmv|m4v|mov|avi|flv|webm|flac|mka|m4a|aac|ogg)\b",  # file types
+        r"season ?\d+?",  # season 1, season 2, etc
+        # more stuffs
+        r"(?:S\d{1,3}|\d+?bit|dsnp|web\-dl|ddp\d+? ? \d|hevc|hdrip|\-?Vyndros)",
+        # URLs in filenames
+        r"^(?:https?:\/\/)?(?:www.)?[a-z0-9]+\.[a-z]+(?:\/[a-zA-Z0-9#]+\/?)*$",
+    )
+)
+EPISODE_PATTERNS = tuple(
+    re.compile(exp, flags=re.IGNORECASE)
+    for exp in (
+        r".+?s ?(?P<season>\d{0,2})e ?(?P<episode>\d{0,4}).+",
+        r".+?e ?(?P<episode>\d{0,2})s ?(?P<season>\d{0,4}).+",
+        r".+?e ?(?P<episode>\d{0,4})",
+    )
+)
+TMDB_ID_PATTERN = re.compile(r"{{(tmdb_id|anidb_id):(\d{1,8})}}")
+
+# Names seen by the memos, large enough for the episodes of a big library
+MEMO_SIZE: int = 1 << 16
+
+
+class ParsedName(NamedTuple):
+    title: Optional[str]
+    year: Optional[str]
+
+
+class ParsedEpisode(NamedTuple):
+    season: Optional[int]
+    episode: Optional[str]
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def clean_file_name(name: str) -> str:
+    """Removes common and unnecessary strings from file names"""
+    for pattern in CLEAN_PATTERNS:
+        name = pattern.sub("", name)
+    return name.strip().rstrip(".-_")
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def match_filename(name: str, data_type: str) -> tuple:
+    patterns = SERIES_PATTERNS if data_type == "series" else MOVIE_PATTERNS
+    for pattern in patterns:
+        if match := pattern.match(name):
+            data = match.groupdict()
+            data["title"] = data["title"].strip().replace(".", " ")
+            return tuple(data.items())
+    return ()
+
+
+def parse_filename(name: str, data_type: str) -> dict:
+    """Identifies media names and years from file name"""
+    return dict(match_filename(name, data_type))
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def parse_name(name: str, data_type: str) -> ParsedName:
+    """Cleans a file or folder name and identifies its title and year"""
+    data = dict(match_filename(clean_file_name(name), data_type))
+    return ParsedName(data.get("title"), data.get("year"))
+
+
+def parse_names(names: Iterable[str], data_type: str) -> List[ParsedName]:
+    """Cleans and parses a batch of file or folder names"""
+    return [parse_name(name, data_type) for name in names]
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def parse_episode(name: str, season_number: int) -> ParsedEpisode:
+    """Identifies the season and episode numbers from an episode's file name"""
+    for pattern in EPISODE_PATTERNS:
+        if match := pattern.match(name):
+            data = match.groupdict()
+            season = data.get("season")
+            return ParsedEpisode(
+                int(season) if season else season_number, data["episode"]
+            )
+    return ParsedEpisode(None, None)
+
+
+def parse_episode_filename(name: str, season_number: int) -> dict:
+    """Identifies the season and episode numbers from an episode's file name
+
+    Returns:
+        dict: The ``season`` and ``episode`` numbers, empty if none were found
+    """
+    parsed = parse_episode(name, season_number)
+    if parsed.season is None:
+        return {}
+    return parsed._asdict()
+
+
+def parse_episode_names(
+    names: Iterable[str], season_number: int
+) -> List[ParsedEpisode]:
+    """Parses the season and episode numbers of a batch of episode file names"""
+    return [parse_episode(name, season_number) for name in names]
@@ -0,0 +1,65 @@
+from time import monotonic
+from typing import Callable, Optional
+
+
+class BuildProgress:
+    """Tracks the phase and the item counts of the running metadata build"""
+
+    __slots__ = [
+        "phase",
+        "category",
+        "done",
+        "total",
+        "written",
+        "resumed",
+        "sink",
+        "last_report",
+    ]
+
+    def __init__(self, sink: Optional[Callable[[dict], None]] = None):
+        self.phase: str = "idle"
+        self.category: str = ""
+        self.done: int = 0
+        self.total: int = 0
+        # Documents written by the whole build so far
+        self.written: int = 0
+        # Whether the build was resumed from a checkpoint
+        self.resumed: bool = False
+        self.sink: Optional[Callable[[dict], None]] = sink
+        self.last_report: float = 0
+
+    def __json__(self) -> dict:
+        return {
+            "phase": self.phase,
+            "category": self.category,
+            "done": self.done,
+            "total": self.total,
+            "written": self.written,
+            "resumed": self.resumed,
+        }
+
+    def start_phase(self, phase: str, total: int = 0, category: Optional[str] = None):
+        """Starts a new build phase and resets the item counts"""
+        self.phase = phase
+        if category is not None:
+            self.category = category
+        self.done = 0
+        self.total = total
+        self.report(force=True)
+
+    def advance(self, count: int = 1):
+        """Marks items of the current phase as done"""
+        self.done += count
+        self.report()
+
+    def report(self, force: bool = False):
+        """Sends the progress to the sink, at most twice a second unless forced"""
+        if self.sink is None:
+            return
+        now = monotonic()
+        if force or now - self.last_report >= 0.5:
+            self.last_report = now
+            self.sink(self.__json__())
+
+
+build_progress = BuildProgress()
@@ -0,0 +1,208 @@
+import httpx
+import random
+import asyncio
+from app import logger
+from time import monotonic
+from typing import Callable, Optional, Awaitable
+
+
+class CircuitOpenError(Exception):
+    """Raised while the circuit breaker rejects requests"""
+
+
+class RateLimiter:
+    """Adaptive rate limiting, retries and circuit breaking for an HTTP API
+
+    Requests are paced by a token bucket and capped by a concurrency limit
+    that is adjusted AIMD-style: it grows by one slot per limit's worth of
+    fast responses and is cut on 429s and latency spikes. ``Retry-After``
+    pauses every request. Throttled, failed and timed out requests are
+    retried with jittered exponential backoff. After too many consecutive
+    failures the circuit opens and requests fail fast until a probe succeeds.
+    """
+
+    retries: int = 5
+    backoff: float = 0.5
+    max_backoff: float = 30
+    # Consecutive failures that open the circuit, and how long it stays open
+    failure_threshold: int = 10
+    open_time: float = 60
+    # Responses slower than this many times the fastest one count as congestion
+    latency_factor: float = 3
+    retry_statuses = frozenset((429, 500, 502, 503, 504))
+
+    def __init__(self, concurrency: int = 8, rate: float = 40):
+        self.max_limit = max(1, concurrency)
+        self.limit: float = self.max_limit
+        self.rate = max(rate, 0.1)
+        self.tokens: float = min(self.rate, self.max_limit)
+        self.refilled_at = monotonic()
+        self.in_flight: int = 0
+        self.slots = asyncio.Condition()
+        self.bucket = asyncio.Lock()
+        self.paused_until: float = 0
+        self.decreased_at: float = 0
+        self.min_latency: Optional[float] = None
+        self.failures: int = 0
+        self.opened_at: Optional[float] = None
+        self.probing: bool = False
+        # Counters
+        self.requests: int = 0
+        self.retried: int = 0
+        self.throttled: int = 0
+        self.errors: int = 0
+        self.trips: int = 0
+
+    def __json__(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retried": self.retried,
+            "throttled": self.throttled,
+            "errors": self.errors,
+            "trips": self.trips,
+            "limit": int(self.limit),
+        }
+
+    async def take_token(self):
+        """Waits for a token of the bucket and for any Retry-After pause"""
+        async with self.bucket:
+            while True:
+                now = monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(
+                    self.tokens + (now - self.refilled_at) * self.rate,
+                    max(self.rate, 1),
+                )
+                self.refilled_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        async with self.slots:
+            await self.slots.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.slots:
+            self.in_flight -= 1
+            self.slots.notify_all()
+
+    def decrease(self, factor: float):
+        """Cuts the concurrency limit, at most once per second"""
+        now = monotonic()
+        if now - self.decreased_at >= 1:
+            self.decreased_at = now
+            self.limit = max(1.0, self.limit * factor)
+
+    def on_response(self, latency: float):
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        if latency > max(1.0, self.min_latency * self.latency_factor):
+            self.decrease(0.8)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_throttle(self, response: httpx.Response):
+        self.throttled += 1
+        self.decrease(0.5)
+        try:
+            retry_after = float(response.headers.get("retry-after", 0))
+        except ValueError:
+            retry_after = 0
+        if retry_after > 0:
+            self.paused_until = max(self.paused_until, monotonic() + retry_after)
+            logger.warning("TMDB rate limit hit, pausing for %ss", retry_after)
+
+    def check_circuit(self) -> bool:
+        """Rejects the request while the circuit is open, letting one probe through after a while
+
+        Returns:
+            bool: True if the request is the probe, its caller must clear ``probing``
+        """
+        if self.opened_at is None:
+            return False
+        if monotonic() - self.opened_at < self.open_time or self.probing:
+            raise CircuitOpenError("Too many failed TMDB requests, circuit is open")
+        self.probing = True
+        return True
+
+    def on_result(self, ok: bool):
+        if ok:
+            self.failures = 0
+            if self.opened_at is not None:
+                logger.info("TMDB circuit closed")
+            self.opened_at = None
+        else:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    self.trips += 1
+                    logger.error("TMDB circuit opened after %s failures", self.failures)
+                self.opened_at = monotonic()
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    async def send(
+        self, call: Callable[[], Awaitable[httpx.Response]]
+    ) -> httpx.Response:
+        """Sends a request, retrying throttled and failed attempts
+
+        Returns:
+            httpx.Response: The first non-retryable response, or the last one
+
+        Raises:
+            CircuitOpenError: If the circuit is open
+            httpx.HTTPError: If the last attempt failed without a response
+        """
+        for attempt in range(self.retries + 1):
+            probe = self.check_circuit()
+            try:
+                await self.take_token()
+                await self.acquire()
+                start_time = monotonic()
+                try:
+                    self.requests += 1
+                    response = await call()
+                except (httpx.TimeoutException, httpx.TransportError):
+                    self.errors += 1
+                    self.decrease(0.8)
+                    self.on_result(False)
+                    if attempt == self.retries:
+                        raise
+                else:
+                    if response.status_code == 429:
+                        self.on_throttle(response)
+                    else:
+                        self.on_response(monotonic() - start_time)
+                    retry = response.status_code in self.retry_statuses
+                    if response.status_code >= 500:
+                        self.errors += 1
+                    self.on_result(response.status_code < 500)
+                    if not retry or attempt == self.retries:
+                        return response
+                finally:
+                    await self.release()
+            finally:
+                # Cancelled or failed probes must not leave the circuit stuck open
+                if probe:
+                    self.probing = False
+            self.retried += 1
+            await asyncio.sleep(self.delay(attempt))
+
+    def log_stats(self):
+        """Logs the request counters"""
+        logger.info(
+            "TMDB requests: %s sent, %s retried, %s throttled, %s errors, "
+            "%s circuit trips, concurrency limit %s",
+            self.requests,
+            self.retried,
+            self.throttled,
+            self.errors,
+            self.trips,
+            int(self.limit),
+        )
@@ -1,9 +1,15 @@
-import requests
-import regex as re
+import time
+import asyncio
 import ujson as json
-from os import path
-from typing import Optional
+from app import logger
 from app.settings import settings
+from datetime import datetime, timezone
+from typing import Set, List, Iterable, Iterator, Optional
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from app.core.listing import MovieFile, MovieTree, SeriesFolder, SeriesTree
+from app.core.listing_snapshot import ListingSnapshot
+from app.core.rclone_rc import RCloneRC, RCloneError
 
 
 def build_config(config) -> list:
@@ -74,6 +80,18 @@ def build_config(config) -> list:
 
 
 class RCloneAPI:
+    """A category's remote, reached through the rclone remote control
+
+    The blocking methods have awaitable ``*_async`` variants for the routes
+    and the build pipeline.
+    """
+
+    movies_options: dict = {"recurse": True, "filesOnly": False}
+    series_options: dict = {"recurse": True, "maxDepth": 2}
+    # Attempts of a failed folder listing in a fan-out listing
+    list_retries: int = 3
+    list_backoff: float = 1
+
     def __init__(self, data: dict, index: int, port=35530):
         self.data: dict = data
         self.index: int = index
@@ -81,6 +99,7 @@ class RCloneAPI:
         self.fs: str = "".join(c for c in self.id if c.isalnum()) + ":"
         self.provider: str = data.get("provider") or "gdrive"
         self.RCLONE_RC_URL: str = f"http://localhost:{port}"
+        self.rc: RCloneRC = RCloneRC.shared(self.RCLONE_RC_URL)
         self.RCLONE: dict = {
             "mkdir": "operations/mkdir",
             "purge": "operations/purge",
@@ -120,199 +139,291 @@ class RCloneAPI:
         }
         self.fs_conf: dict = self.rc_conf()
 
-    def rc_ls(self, options: Optional[dict] = None) -> list:
-        """Returns a recursive list of files"""
-        rc_data: dict = {
+    def ls_request(self, options: Optional[dict] = None, remote: str = "") -> dict:
+        return {
             "fs": self.fs,
-            "remote": "",
+            "remote": remote,
             "opt": options,
         }
-        result = requests.post(
-            self.RCLONE_RC_URL + "/" + self.RCLONE["getFilesList"],
-            data=json.dumps(rc_data),
-            headers={"Content-Type": "application/json"},
-        ).json()
-        return result["list"]
 
-    def rc_conf(self) -> dict:
-        """Retrieves the Rclone config of the current remote"""
-        rc_data: dict = {"name": self.fs[:-1]}
-        result = requests.post(
-            self.RCLONE_RC_URL + "/" + self.RCLONE["getConfigForRemote"],
-            data=json.dumps(rc_data),
-            headers={"Content-Type": "application/json"},
-        ).json()
+    def rc_ls(self, options: Optional[dict] = None) -> list:
+        """Returns a recursive list of files"""
+        return self.rc.call_sync(self.RCLONE["getFilesList"], self.ls_request(options))[
+            "list"
+        ]
+
+    def iter_ls(
+        self, options: Optional[dict] = None, concurrency: int = 1
+    ) -> Iterator[dict]:
+        """Streams a recursive list of files, item by item
+
+        With a ``concurrency`` above 1 the top level is listed first, then
+        that many top-level folders are listed at once.
+        """
+        if concurrency > 1:
+            return self.iter_ls_parallel(options or {}, concurrency)
+        return self.rc.iter_list(self.RCLONE["getFilesList"], self.ls_request(options))
+
+    def ls_folder(self, folder: str, options: dict) -> List[dict]:
+        """Lists a top-level folder recursively, retrying it on its own when it fails
+
+        Returns:
+            List[dict]: The items with paths relative to the remote, folders first
+        """
+        for attempt in range(self.list_retries + 1):
+            try:
+                items = list(
+                    self.rc.iter_list(
+                        self.RCLONE["getFilesList"], self.ls_request(options, folder)
+                    )
+                )
+                break
+            except RCloneError as e:
+                if attempt == self.list_retries:
+                    raise
+                logger.warning("Listing %s failed, retrying: %s", folder, e)
+                time.sleep(self.list_backoff * 2**attempt)
+        if folder:
+            for item in items:
+                item["Path"] = f"{folder}/{item['Path']}"
+        # The parsers need every folder before its contents
+        items.sort(key=lambda item: item["Path"].count("/"))
+        return items
+
+    def iter_ls_folders(
+        self, folders: Iterable[str], options: dict, concurrency: int
+    ) -> Iterator[dict]:
+        """Lists folders in parallel, yielding each one's items as soon as it finishes
+
+        At most ``concurrency`` folders are being listed or waiting to be
+        yielded at once, and a folder's items are released as they are
+        yielded, so memory is bound by the largest folders, not the category.
+        """
+        folders = iter(folders)
+        pending: Set[Future] = set()
+        with ThreadPoolExecutor(concurrency) as executor:
+            try:
+                while True:
+                    for folder in islice(folders, concurrency - len(pending)):
+                        pending.add(executor.submit(self.ls_folder, folder, options))
+                    if not pending:
+                        break
+                    future = next(as_completed(pending))
+                    pending.remove(future)
+                    items = future.result()
+                    del future
+                    items.reverse()
+                    while items:
+                        yield items.pop()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def iter_ls_parallel(self, options: dict, concurrency: int) -> Iterator[dict]:
+        """Lists the top level, then its folders in parallel, yielding them as they finish"""
+        items = self.rc.call_sync(
+            self.RCLONE["getFilesList"], self.ls_request({**options, "recurse": False})
+        )["list"]
+        yield from items
+        folders = [item["Path"] for item in items if item["IsDir"]]
+        del items
+        yield from self.iter_ls_folders(folders, options, concurrency)
+
+    def iter_ls_changed(
+        self,
+        options: dict,
+        snapshot: ListingSnapshot,
+        concurrency: int,
+        dirty: Set[str],
+    ) -> Iterator[dict]:
+        """Walks the remote level by level, reusing the snapshot for unchanged folders"""
+        folder_options = {**options, "recurse": False}
+        frontier = [""]
+        while frontier:
+            next_frontier = []
+            for item in self.iter_ls_folders(
+                frontier, folder_options, max(concurrency, 1)
+            ):
+                yield item
+                if not item["IsDir"]:
+                    continue
+                if snapshot.unchanged(item, dirty):
+                    yield from snapshot.reuse(item["Path"])
+                else:
+                    next_frontier.append(item["Path"])
+            frontier = next_frontier
+
+    def drive_changes(
+        self, since: datetime, folders: Optional[Set[str]] = None
+    ) -> Optional[Set[str]]:
+        """Returns the IDs of the Drive folders whose files changed since a time
+
+        Drive does not update the ModTime of a folder when its files change,
+        so the folders are found with a Drive query through the backend.
+        Files created since then count too, since a moved file keeps its
+        modifiedTime. A query can not be limited to the descendants of the
+        category's root, so the results are limited to the ``folders`` of its
+        listing snapshot.
+
+        Returns:
+            Optional[Set[str]]: None if the query is not supported
+        """
+        since_str = since.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        try:
+            result = self.rc.call_sync(
+                self.RCLONE["backendCommand"],
+                {
+                    "command": "query",
+                    "fs": self.fs,
+                    "arg": [
+                        "(modifiedTime > '%s' or createdTime > '%s')"
+                        % (since_str, since_str)
+                    ],
+                },
+            )
+        except RCloneError as e:
+            logger.warning("Drive changes of %s are unavailable: %s", self.fs, e)
+            return None
+        return {
+            parent
+            for item in result.get("result") or []
+            for parent in item.get("parents", [])
+            if folders is None or parent in folders
+        }
+
+    def iter_ls_incremental(
+        self,
+        options: dict,
+        snapshot: ListingSnapshot,
+        concurrency: int = 1,
+        drive_changes: bool = True,
+    ) -> Iterator[dict]:
+        """Streams a recursive list of files, only listing the folders that changed
+
+        Falls back to a full listing without a usable snapshot, and on Drive
+        without its changes, since Drive folder ModTimes miss file changes.
+        """
+        dirty: Optional[Set[str]] = set()
+        if not snapshot.load():
+            dirty = None
+        elif self.provider == "gdrive":
+            dirty = (
+                self.drive_changes(snapshot.listed_at, snapshot.folder_ids())
+                if drive_changes
+                else None
+            )
+        if dirty is None:
+            return snapshot.record(self.iter_ls(options, concurrency), full=True)
+        return snapshot.record(
+            self.iter_ls_changed(options, snapshot, concurrency, dirty), full=False
+        )
+
+    def iter_ls_category(
+        self,
+        options: dict,
+        concurrency: int = 1,
+        snapshot: Optional[ListingSnapshot] = None,
+        drive_changes: bool = True,
+    ) -> Iterator[dict]:
+        if snapshot is None:
+            return self.iter_ls(options, concurrency)
+        return self.iter_ls_incremental(options, snapshot, concurrency, drive_changes)
+
+    @staticmethod
+    def parse_conf(result: dict) -> dict:
         if result.get("token"):
             result["token"] = json.loads(result.get("token", "{}"))
         return result
 
-    def fetch_movies(self) -> list:
+    def rc_conf(self) -> dict:
+        """Retrieves the Rclone config of the current remote"""
+        return self.parse_conf(
+            self.rc.call_sync(self.RCLONE["getConfigForRemote"], {"name": self.fs[:-1]})
+        )
+
+    async def rc_conf_async(self) -> dict:
+        """Retrieves the Rclone config of the current remote"""
+        return self.parse_conf(
+            await self.rc.call(
+                self.RCLONE["getConfigForRemote"], {"name": self.fs[:-1]}
+            )
+        )
+
+    def fetch_movies(
+        self,
+        concurrency: int = 1,
+        snapshot: Optional[ListingSnapshot] = None,
+        drive_changes: bool = True,
+    ) -> list:
+        """Returns movie files, parsed from the listing as it streams in"""
+        return self.parse_movies(
+            self.iter_ls_category(
+                self.movies_options, concurrency, snapshot, drive_changes
+            )
+        )
+
+    async def fetch_movies_async(
+        self,
+        concurrency: int = 1,
+        snapshot: Optional[ListingSnapshot] = None,
+        drive_changes: bool = True,
+    ) -> list:
         """Returns movie files"""
-        rc_ls_result = self.rc_ls({"recurse": True, "filesOnly": False})
-        metadata: list = []
-        dirs: dict = {}
-        file_names: dict = {}
-        sub_index: int = 0
-        for item in rc_ls_result:
-            if item["IsDir"] is False and (
-                "video" in item["MimeType"]
-                or item["Name"]
-                .lower()
-                .endswith((".mp4", ".mkv", ".avi", ".mov", ".webm", ".flv"))
-            ):
-                parent_path = item["Path"].replace("/" + item["Name"], "")
-                parent = dirs.get(parent_path)
-                curr_metadata = {
-                    "id": item.get("ID", item["Path"]),
-                    "name": item["Name"],
-                    "path": item["Path"],
-                    "parent": parent,
-                    "mime_type": item["MimeType"],
-                    "size": item["Size"],
-                    "subtitles": [],
-                    "modified_time": item["ModTime"],
-                }
-                path_without_extension = path.splitext(item["Path"])[0]
-                file_name = file_names.get(path_without_extension)
-                if file_name:
-                    curr_metadata["subtitles"] = file_name["subtitles"]
-                    file_names[path_without_extension]["found"] = True
-                    file_names[path_without_extension]["index"] = sub_index
-                else:
-                    file_names[path_without_extension] = {
-                        "found": True,
-                        "index": sub_index,
-                        "subtitles": [],
-                    }
-                metadata.append(curr_metadata)
-                sub_index += 1
-            elif item["IsDir"] is True:
-                dirs[item["Path"]] = {
-                    "id": item.get("ID", item["Path"]),
-                    "name": item["Name"],
-                    "path": item["Path"],
-                }
-            elif item["IsDir"] is False and item["Name"].endswith(
-                (".vtt", ".srt", ".ass", ".ssa")
-            ):
-                path_without_extension = path.splitext(item["Path"])[0]
-                if path_without_extension[-3] == ".":
-                    path_without_extension = path_without_extension[:-3]
-                elif path_without_extension[-4] == ".":
-                    path_without_extension = path_without_extension[:-4]
-                sub_metadata = {
-                    "id": item.get("ID", item["Path"]),
-                    "name": item["Name"],
-                    "path": item["Path"],
-                }
-                file_name = file_names.get(path_without_extension)
-                if file_name:
-                    if file_name["found"] is True:
-                        metadata[file_name["index"]]["subtitles"].append(sub_metadata)
-                    else:
-                        file_names[path_without_extension]["subtitles"].append(
-                            sub_metadata
-                        )
-                else:
-                    file_names[path_without_extension] = {
-                        "found": False,
-                        "index": None,
-                        "subtitles": [sub_metadata],
-                    }
+        return await asyncio.to_thread(
+            self.fetch_movies, concurrency, snapshot, drive_changes
+        )
+
+    def parse_movies(self, rc_ls_result: Iterable[dict]) -> List[MovieFile]:
+        """Matches the video files of a listing with their subtitles"""
+        return MovieTree().build(rc_ls_result)
 
-        return metadata
+    def fetch_series(
+        self,
+        concurrency: int = 1,
+        snapshot: Optional[ListingSnapshot] = None,
+        drive_changes: bool = True,
+    ) -> list:
+        """Returns series files, parsed from the listing as it streams in"""
+        return self.parse_series(
+            self.iter_ls_category(
+                self.series_options, concurrency, snapshot, drive_changes
+            )
+        )
 
-    def fetch_series(self) -> list:
+    async def fetch_series_async(
+        self,
+        concurrency: int = 1,
+        snapshot: Optional[ListingSnapshot] = None,
+        drive_changes: bool = True,
+    ) -> list:
         """Returns series files"""
-        rc_ls_result = self.rc_ls({"recurse": True, "maxDepth": 2})
-        metadata: list = []
-        parent_dirs: dict = {
-            "": {
-                "path": "",
-                "depth": 0,
-                "json_path": "",
-            }
-        }
-        for item in rc_ls_result:
-            if len(item["Path"].split("/")) == 1:
-                parent_path = ""
-            else:
-                parent_path = item["Path"].replace("/" + item["Name"], "")
-            parent = parent_dirs[parent_path]
-            if item["IsDir"] is False:
-                if parent["depth"] == 2:
-                    season_metadata = eval("metadata" + parent["json_path"])
-                    season_metadata["episodes"].append(
-                        {
-                            "id": item.get("ID", item["Path"]),
-                            "name": item["Name"],
-                            "path": item["Path"],
-                            "parent": parent,
-                            "mime_type": item["MimeType"],
-                            "size": item["Size"],
-                            "modified_time": item["ModTime"],
-                        }
-                    )
-            else:
-                parent_dirs[item["Path"]] = {
-                    "id": item.get("ID", item["Path"]),
-                    "name": item["Name"],
-                    "path": item["Path"],
-                    "depth": parent["depth"] + 1,
-                }
-                if parent["depth"] == 0:
-                    metadata.append(
-                        {
-                            "id": item.get("ID", item["Path"]),
-                            "name": item["Name"],
-                            "path": item["Path"],
-                            "parent": parent,
-                            "mime_type": item["MimeType"],
-                            "modified_time": item["ModTime"],
-                            "seasons": {},
-                            "json_path": f"[{len(metadata)}]",
-                        }
-                    )
-                    parent_dirs[item["Path"]]["json_path"] = f"[{len(metadata) - 1}]"
-                elif parent["depth"] == 1:
-                    series_metadata = eval("metadata" + parent["json_path"])
-                    season = re.search(
-                        r"(?<=Season.|season.|S|s)\d{1,3}|^\d{1,3}$", item["Name"]
-                    )
-                    season = season.group() if season else "1"
-                    if season != "0":
-                        season = season.lstrip("0")
-                    series_metadata["seasons"][season] = {
-                        "id": item.get("ID", item["Path"]),
-                        "name": item["Name"],
-                        "path": item["Path"],
-                        "parent": parent,
-                        "mime_type": item["MimeType"],
-                        "modified_time": item["ModTime"],
-                        "episodes": [],
-                        "json_path": parent["json_path"] + f'["{season}"]',
-                    }
-                    parent_dirs[item["Path"]]["json_path"] = (
-                        parent["json_path"] + f'["seasons"]["{season}"]'
-                    )
-        return metadata
+        return await asyncio.to_thread(
+            self.fetch_series, concurrency, snapshot, drive_changes
+        )
 
-    def size(self, path: str) -> int:
-        """Retrieves the size of a folder or file"""
+    def parse_series(self, rc_ls_result: Iterable[dict]) -> List[SeriesFolder]:
+        """Groups the episode files of a listing by series and season"""
+        return SeriesTree().build(rc_ls_result)
+
+    def size_request(self, path: str) -> dict:
         options = {
             "no-modtime": True,
             "no-mimetype": True,
         }
-        rc_data: dict = {
+        return {
             "fs": self.fs,
             "remote": path,
             "opt": options,
         }
-        result = requests.post(
-            "%s/%s" % (self.RCLONE_RC_URL, self.RCLONE["getFileInfo"]),
-            data=json.dumps(rc_data),
-            headers={"Content-Type": "application/json"},
-        ).json()
+
+    def size(self, path: str) -> int:
+        """Retrieves the size of a folder or file"""
+        result = self.rc.call_sync(self.RCLONE["getFileInfo"], self.size_request(path))
+        return result["item"]["Size"]
+
+    async def size_async(self, path: str) -> int:
+        """Retrieves the size of a folder or file"""
+        result = await self.rc.call(self.RCLONE["getFileInfo"], self.size_request(path))
         return result["item"]["Size"]
 
     def stream(self, path: str):
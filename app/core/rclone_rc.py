@@ -0,0 +1,153 @@
+import httpx
+import asyncio
+import requests
+import ujson as json
+from app import logger
+from app.core.listing import iter_list
+from typing import Dict, Iterator, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class RCloneError(Exception):
+    """Raised when the rclone remote control returns an error"""
+
+
+class RCloneRC:
+    """Pooled client of the rclone remote control (rcd)
+
+    Calls reuse keep-alive connections and are retried with backoff when the
+    rcd is unreachable, as it is while being restarted. Listings are streamed
+    and parsed as they arrive. Every method has a blocking variant for code
+    that does not run in an event loop.
+    """
+
+    retries: int = 5
+    backoff: float = 0.5
+    connect_timeout: float = 5
+    # The rcd only starts answering a listing once the whole remote is listed
+    list_timeout: float = 3600
+    chunk_size: int = 256 * 1024
+    retry_errors = (httpx.ConnectError, httpx.RemoteProtocolError, httpx.ReadError)
+    instances: Dict[str, "RCloneRC"] = {}
+
+    def __init__(self, url: str, timeout: float = 120, connections: int = 10):
+        self.url = url
+        self.timeout = timeout
+        self.connections = connections
+        self.client: Optional[httpx.AsyncClient] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=connections,
+            max_retries=Retry(
+                total=self.retries,
+                read=self.retries,
+                status=0,
+                backoff_factor=self.backoff,
+                allowed_methods=None,
+            ),
+        )
+        self.session.mount("http://", adapter)
+
+    @classmethod
+    def shared(cls, url: str) -> "RCloneRC":
+        """Returns the client of an rcd, shared by every remote of this process"""
+        if url not in cls.instances:
+            cls.instances[url] = cls(url)
+        return cls.instances[url]
+
+    def async_client(self) -> httpx.AsyncClient:
+        """Returns the connection pool of the running event loop
+
+        Pools are bound to the loop they were opened in, and build workers run
+        a fresh loop per category.
+        """
+        loop = asyncio.get_running_loop()
+        if self.client is None or self.loop is not loop:
+            self.client = httpx.AsyncClient(
+                base_url=self.url,
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.connections,
+                    max_keepalive_connections=self.connections,
+                ),
+            )
+            self.loop = loop
+        return self.client
+
+    async def aclose(self):
+        """Closes the connection pool of the running event loop"""
+        if self.client is not None and self.loop is asyncio.get_running_loop():
+            await self.client.aclose()
+            self.client = None
+
+    @staticmethod
+    def result(command: str, response) -> dict:
+        try:
+            result = json.loads(response.content)
+        except ValueError:
+            result = {}
+        if response.status_code != 200:
+            raise RCloneError(
+                f"{command} failed with {response.status_code}: "
+                f"{result.get('error') or response.text}"
+            )
+        return result
+
+    async def call(self, command: str, data: Optional[dict] = None) -> dict:
+        """Sends a command to the rcd
+
+        Raises:
+            RCloneError: If the command failed or the rcd stayed unreachable
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.async_client().post(
+                    f"/{command}",
+                    content=json.dumps(data or {}),
+                    headers={"Content-Type": "application/json"},
+                )
+                return self.result(command, response)
+            except self.retry_errors as e:
+                if attempt == self.retries:
+                    raise RCloneError(f"{command} failed: {e!r}") from e
+                logger.warning("rclone is unreachable, retrying %s", command)
+                await asyncio.sleep(self.backoff * 2**attempt)
+            except httpx.HTTPError as e:
+                raise RCloneError(f"{command} failed: {e!r}") from e
+
+    def iter_list(self, command: str, data: Optional[dict] = None) -> Iterator[dict]:
+        """Streams the ``list`` array of a listing command, item by item
+
+        The response is parsed as it arrives instead of being loaded whole.
+
+        Raises:
+            RCloneError: If the command failed or the response was cut short
+        """
+        try:
+            with self.session.post(
+                f"{self.url}/{command}",
+                data=json.dumps(data or {}),
+                headers={"Content-Type": "application/json"},
+                timeout=(self.connect_timeout, self.list_timeout),
+                stream=True,
+            ) as response:
+                if response.status_code != 200:
+                    self.result(command, response)
+                yield from iter_list(response.iter_content(self.chunk_size))
+        except (requests.RequestException, ValueError) as e:
+            raise RCloneError(f"{command} failed: {e!r}") from e
+
+    def call_sync(self, command: str, data: Optional[dict] = None) -> dict:
+        """Blocking variant of ``call``"""
+        try:
+            response = self.session.post(
+                f"{self.url}/{command}",
+                data=json.dumps(data or {}),
+                headers={"Content-Type": "application/json"},
+                timeout=(self.connect_timeout, self.timeout),
+            )
+        except requests.RequestException as e:
+            raise RCloneError(f"{command} failed: {e!r}") from e
+        return self.result(command, response)
@@ -0,0 +1,183 @@
+import random
+import asyncio
+from app import logger
+from app.core.tmdb import TMDB
+from app.models import Movie, Series
+from app.apis import mongo, builder
+from app.core.writer import BulkWriter
+from pymongo import UpdateMany, UpdateOne
+from typing import Dict, List, Optional
+from datetime import datetime, timezone, timedelta
+
+
+class RefreshScheduler:
+    """Refreshes the TMDB fields of catalog items in small rolling batches
+
+    Every item gets a ``refresh_at`` time from the tier it falls in: series
+    with an episode airing soon are refreshed within hours, running series
+    daily, popular items every few days and ended series or old movies monthly.
+    Each tick refreshes the items that are due, oldest first, so the TMDB
+    load is spread over time instead of hitting it all at once.
+    """
+
+    # Popularity above which an item is refreshed more often
+    popular: float = 50
+    tiers: Dict[str, timedelta] = {
+        "airing": timedelta(hours=6),
+        "running": timedelta(days=1),
+        "popular": timedelta(days=3),
+        "default": timedelta(days=14),
+        "ended": timedelta(days=30),
+    }
+    # Share of the TMDB concurrency and rate left to the refreshes, builds keep the rest
+    share: float = 0.25
+
+    def __init__(self):
+        self.refreshed: int = 0
+        self.last_tick: Optional[datetime] = None
+
+    @classmethod
+    def tier(cls, document: dict, data_type: str, now: datetime) -> str:
+        """Returns the refresh tier of a stored movie / series"""
+        popular = (document.get("popularity") or 0) >= cls.popular
+        if data_type == "series":
+            next_episode = document.get("next_episode_to_air") or {}
+            if next_episode.get("air_date"):
+                air_date = datetime.strptime(next_episode["air_date"], "%Y-%m-%d")
+                if air_date.replace(tzinfo=timezone.utc) - now < timedelta(days=7):
+                    return "airing"
+            if document.get("status") in ("Returning Series", "In Production"):
+                return "running"
+            ended = document.get("status") in ("Ended", "Canceled")
+        else:
+            release_date = document.get("release_date") or datetime(1900, 1, 1)
+            age = now - release_date.replace(tzinfo=timezone.utc)
+            # Ratings of recent releases still move a lot
+            if age < timedelta(days=90):
+                return "running"
+            ended = age > timedelta(days=365)
+        if popular:
+            return "popular"
+        return "ended" if ended else "default"
+
+    @classmethod
+    def next_refresh(
+        cls, document: dict, data_type: str, now: datetime, spread: bool = False
+    ) -> datetime:
+        """Returns when an item is due, anywhere within its interval when spreading"""
+        interval = cls.tiers[cls.tier(document, data_type, now)]
+        return now + (interval * random.random() if spread else interval)
+
+    async def assign(self, data_type: str, col) -> int:
+        """Gives a refresh time to the items that have none, like freshly built ones"""
+        now = datetime.now(timezone.utc)
+        documents = await asyncio.to_thread(
+            lambda: list(
+                col.find(
+                    {"refresh_at": {"$exists": False}},
+                    {
+                        "_id": 1,
+                        "status": 1,
+                        "popularity": 1,
+                        "release_date": 1,
+                        "next_episode_to_air": 1,
+                    },
+                )
+            )
+        )
+        writer = BulkWriter(col)
+        for document in documents:
+            await writer.add(
+                UpdateOne(
+                    {"_id": document["_id"]},
+                    {
+                        "$set": {
+                            "refresh_at": self.next_refresh(
+                                document, data_type, now, spread=True
+                            )
+                        }
+                    },
+                )
+            )
+        await writer.flush()
+        return len(documents)
+
+    async def refresh(self, tmdb: TMDB, data_type: str, col, batch_size: int) -> int:
+        """Refreshes the items that are due, the most overdue first"""
+        now = datetime.now(timezone.utc)
+        due: List[int] = await asyncio.to_thread(
+            lambda: list(
+                dict.fromkeys(
+                    document["tmdb_id"]
+                    for document in col.find(
+                        {"refresh_at": {"$lte": now}}, {"_id": 0, "tmdb_id": 1}
+                    )
+                    .sort("refresh_at", 1)
+                    .limit(batch_size)
+                )
+            )
+        )
+        model = Series if data_type == "series" else Movie
+
+        async def fetch(tmdb_id: int):
+            return tmdb_id, await tmdb.get_details(tmdb_id, data_type, fresh=True)
+
+        writer = BulkWriter(col)
+        for task in asyncio.as_completed([fetch(tmdb_id) for tmdb_id in due]):
+            tmdb_id, details = await task
+            try:
+                media_info = model.media_info(details)
+                media_info["refresh_at"] = self.next_refresh(media_info, data_type, now)
+            except (KeyError, TypeError, ValueError):
+                # Retried once its tier would have come around again
+                logger.warning("Could not refresh %s %s", data_type, tmdb_id)
+                media_info = {"refresh_at": now + self.tiers["default"]}
+            await writer.add(UpdateMany({"tmdb_id": tmdb_id}, {"$set": media_info}))
+        await writer.flush()
+        return len(due)
+
+    async def tick(self):
+        """Assigns refresh times to new items and refreshes one batch of due ones"""
+        batch_size = mongo.config["build"].get("refresh_batch_size", 50)
+        tmdb = TMDB(
+            api_key=mongo.config["tmdb"]["api_key"],
+            concurrency=max(
+                1, int(mongo.config["tmdb"].get("concurrency", 8) * self.share)
+            ),
+            rate=mongo.config["tmdb"].get("rate", 40) * self.share,
+        )
+        try:
+            await tmdb.start()
+            for data_type, col in (
+                ("movies", mongo.movies_col),
+                ("series", mongo.series_col),
+            ):
+                if builder.is_running():
+                    logger.info("Refresh scheduler: a build started, stopping")
+                    break
+                assigned = await self.assign(data_type, col)
+                refreshed = await self.refresh(tmdb, data_type, col, batch_size)
+                self.refreshed += refreshed
+                if assigned or refreshed:
+                    logger.info(
+                        "Refresh scheduler: %s %s scheduled, %s refreshed",
+                        assigned,
+                        data_type,
+                        refreshed,
+                    )
+        finally:
+            await tmdb.close()
+        self.last_tick = datetime.now(timezone.utc)
+
+    async def run(self):
+        """Runs a tick every few minutes, skipping them while a build is running"""
+        while True:
+            await asyncio.sleep(
+                mongo.config.get("build", {}).get("refresh_every", 10) * 60
+            )
+            if not mongo.is_metadata_init or builder.is_running():
+                continue
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error("Refresh scheduler tick failed: %s", repr(e))
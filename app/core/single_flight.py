@@ -0,0 +1,31 @@
+import asyncio
+import inspect
+from functools import wraps
+from typing import Callable
+
+
+def single_flight(method: Callable) -> Callable:
+    """Makes concurrent calls of an async method with the same arguments share one call
+
+    The instance needs a ``flights`` dict for the pending calls and a
+    ``coalesced`` counter of the calls that were saved. Every caller gets
+    the same result, or the same exception, and cancelling one caller does
+    not cancel the call for the others.
+    """
+    signature = inspect.signature(method)
+
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = f"{method.__name__}{tuple(bound.arguments.values())[1:]!r}"
+        task = self.flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(method(self, *args, **kwargs))
+            self.flights[key] = task
+            task.add_done_callback(lambda _: self.flights.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    return wrapper
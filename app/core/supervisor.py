@@ -0,0 +1,258 @@
+import os
+import shlex
+import asyncio
+import regex as re
+from shutil import which
+from sys import platform
+from time import perf_counter
+from app import logger, rclone_logger
+from datetime import datetime, timezone
+from subprocess import PIPE, STDOUT, DEVNULL, run
+from typing import List, Callable, Optional, Awaitable
+from app.core.rclone_rc import RCloneRC, RCloneError
+
+
+LOG_PATTERN = re.compile(
+    r"(?:[\d\/])+ (?:[\d:]+) (?P<level>\w+) ? ? :? (?P<message>.*)$", flags=re.I
+)
+LOG_LEVELS = {
+    "CRITICAL": 50,
+    "FATAL": 50,
+    "ERROR": 40,
+    "WARNING": 30,
+    "WARN": 30,
+    "NOTICE": 20,
+    "INFO": 20,
+    "DEBUG": 10,
+}
+
+
+class RCloneSupervisor:
+    """Owns the rclone rcd process and keeps it serving
+
+    The rcd is probed with ``rc/noop`` every few seconds and its latency is
+    tracked. When it exits or fails consecutive probes it is restarted, with
+    exponential backoff while it keeps failing to come up, and the ``on_ready``
+    callbacks run after every start so the remotes are registered again.
+    """
+
+    probe_interval: float = 5
+    probe_timeout: float = 3
+    # Consecutive failed probes that trigger a restart
+    failure_threshold: int = 2
+    start_timeout: float = 30
+    backoff: float = 1
+    max_backoff: float = 60
+
+    def __init__(self, port: int, config_path: str = "rclone.conf"):
+        self.port = port
+        self.config_path = config_path
+        self.rc = RCloneRC(f"http://localhost:{port}", timeout=self.probe_timeout)
+        self.rc.retries = 0
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.on_ready: List[Callable[[], Awaitable]] = []
+        self.task: Optional[asyncio.Task] = None
+        self.ready: bool = False
+        self.failures: int = 0
+        self.restarts: int = 0
+        self.latency: Optional[float] = None
+        self.average_latency: Optional[float] = None
+        self.started_at: Optional[datetime] = None
+        self.probed_at: Optional[datetime] = None
+        self.last_error: str = ""
+
+    def __json__(self) -> dict:
+        return {
+            "ready": self.ready,
+            "pid": self.process.pid if self.process else None,
+            "restarts": self.restarts,
+            "failures": self.failures,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency else None,
+            "average_latency_ms": round(self.average_latency * 1000, 1)
+            if self.average_latency
+            else None,
+            "started_at": self.started_at,
+            "probed_at": self.probed_at,
+            "last_error": self.last_error,
+        }
+
+    @staticmethod
+    def binary() -> Optional[str]:
+        """Returns the rclone executable, downloading it if there is none"""
+        if not os.path.isdir("bin"):
+            os.mkdir("bin")
+        rclone_bin = (
+            f"bin/rclone{'.exe' if platform in ('win32', 'cygwin', 'msys') else ''}"
+        )
+        if not os.path.exists(rclone_bin):
+            rclone_bin = which("rclone")
+        if not rclone_bin:
+            from scripts.install_rclone import download_rclone
+
+            rclone_bin = download_rclone()
+        return rclone_bin
+
+    def free_port(self):
+        """Force closes whatever else listens on the rcd port"""
+        if platform in ("win32", "cygwin", "msys"):
+            command = [
+                "powershell.exe",
+                "Stop-Process",
+                "-Id",
+                f"(Get-NetTCPConnection -LocalPort {self.port}).OwningProcess",
+                "-Force",
+            ]
+        else:
+            command = ["sh", "-c", f"kill $(lsof -t -i:{self.port}) 2>/dev/null"]
+        run(command, check=False, stdout=DEVNULL, stderr=STDOUT)
+
+    async def spawn(self) -> bool:
+        """Starts the rcd and waits until it answers
+
+        Returns:
+            bool: False if it did not come up within ``start_timeout``
+        """
+        rclone_bin = self.binary()
+        if not rclone_bin:
+            logger.error("Couldn't find rclone executable")
+            logger.error(
+                "Please download a suitable executable of rclone from 'rclone.org' and move it to the 'bin' folder."
+            )
+            return False
+        await asyncio.to_thread(self.free_port)
+        arguments = shlex.split(
+            f"{rclone_bin} rcd --rc-no-auth --rc-serve --rc-addr localhost:{self.port} --config {self.config_path} --log-level INFO",
+            posix=(platform not in ("win32", "cygwin", "msys")),
+        )
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *arguments, stdout=PIPE, stderr=STDOUT
+            )
+        except PermissionError:
+            await (
+                await asyncio.create_subprocess_exec("chmod", "+x", rclone_bin)
+            ).communicate()
+            self.process = await asyncio.create_subprocess_exec(
+                *arguments, stdout=PIPE, stderr=STDOUT
+            )
+        asyncio.get_event_loop().create_task(self.log_output(self.process))
+        deadline = perf_counter() + self.start_timeout
+        while perf_counter() < deadline and self.process.returncode is None:
+            if await self.probe():
+                return True
+            await asyncio.sleep(0.5)
+        self.last_error = f"rclone did not start, exit code {self.process.returncode}"
+        logger.error(self.last_error)
+        await self.stop()
+        return False
+
+    async def log_output(self, process: asyncio.subprocess.Process):
+        """Forwards the output of an rcd process to the rclone logger"""
+        while True:
+            out_line = await process.stdout.readline()
+            if out_line == b"":
+                break
+            line = out_line.decode(errors="replace").rstrip()
+            match = LOG_PATTERN.match(line)
+            if match:
+                rclone_logger.log(
+                    LOG_LEVELS.get(match.group("level").upper(), 20),
+                    match.group("message"),
+                )
+            elif line:
+                rclone_logger.info(line)
+        await process.wait()
+        if process is self.process:
+            logger.warning("rclone exited with code %s", process.returncode)
+
+    async def stop(self):
+        """Terminates the rcd process"""
+        self.ready = False
+        process, self.process = self.process, None
+        if process is None or process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), 10)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+    async def probe(self) -> bool:
+        """Sends an rc/noop and records its latency"""
+        start_time = perf_counter()
+        try:
+            await self.rc.call("rc/noop")
+        except RCloneError as e:
+            self.last_error = str(e)
+            return False
+        finally:
+            self.probed_at = datetime.now(timezone.utc)
+        self.latency = perf_counter() - start_time
+        self.average_latency = (
+            self.latency
+            if self.average_latency is None
+            else 0.8 * self.average_latency + 0.2 * self.latency
+        )
+        return True
+
+    async def restart(self):
+        """Restarts the rcd until it comes up, then runs the ``on_ready`` callbacks"""
+        await self.stop()
+        attempt = 0
+        while not await self.spawn():
+            delay = min(self.max_backoff, self.backoff * 2**attempt)
+            logger.warning("Restarting rclone in %ss", delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+        self.started_at = datetime.now(timezone.utc)
+        self.failures = 0
+        for callback in self.on_ready:
+            try:
+                await callback()
+            except Exception as e:
+                logger.error("rclone ready callback failed: %s", repr(e))
+        self.ready = True
+        logger.info("Started rclone")
+
+    async def start(self):
+        """Starts the rcd, then keeps supervising it in the background"""
+        await self.restart()
+        self.task = asyncio.get_event_loop().create_task(self.supervise())
+
+    async def supervise(self):
+        """Probes the rcd and restarts it when it exits or stops answering"""
+        while self.process is not None:
+            process = self.process
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(process.wait()), self.probe_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            if process.returncode is not None:
+                self.last_error = f"rclone exited with code {process.returncode}"
+            elif await self.probe():
+                self.failures = 0
+                self.ready = True
+                continue
+            else:
+                self.failures += 1
+                self.ready = False
+                logger.warning(
+                    "rclone health probe failed (%s/%s): %s",
+                    self.failures,
+                    self.failure_threshold,
+                    self.last_error,
+                )
+                if self.failures < self.failure_threshold:
+                    continue
+            self.restarts += 1
+            logger.error("rclone is down, restarting it: %s", self.last_error)
+            await self.restart()
+
+    async def shutdown(self):
+        """Stops supervising and terminates the rcd"""
+        if self.task is not None:
+            self.task.cancel()
+        await self.stop()
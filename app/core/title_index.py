@@ -0,0 +1,347 @@
+import os
+import mmap
+import zlib
+import struct
+import shutil
+import tempfile
+import regex as re
+from math import log1p
+from app import logger
+from array import array
+from heapq import merge, nlargest
+from bisect import bisect_left
+from time import perf_counter
+from collections import Counter
+from operator import itemgetter
+from typing import List, Callable, Iterable, Iterator, Optional
+
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def normalize_title(title: str) -> str:
+    """Lowercases a title and reduces it to words separated by single spaces"""
+    return " ".join(WORD_PATTERN.findall(title.lower()))
+
+
+def trigrams(text: str) -> set:
+    """Returns the hashed character trigrams of a normalized title"""
+    padded = f" {text} "
+    return {
+        zlib.crc32(padded[x : x + 3].encode("utf-8")) for x in range(len(padded) - 2)
+    }
+
+
+def sort_array(values: array, run: int = 1 << 16) -> array:
+    """Sorts an array in runs merged back together, without a list of the whole array"""
+    runs = [
+        array(values.typecode, sorted(values[x : x + run]))
+        for x in range(0, len(values), run)
+    ]
+    return array(values.typecode, merge(*runs))
+
+
+class TitleIndex:
+    """Memory-mapped trigram index of the titles in a TMDB daily ID export
+
+    Titles are numbered by descending popularity. The file holds their IDs,
+    popularity, trigram counts and adult flags, the sorted trigram hashes with
+    their posting lists, a sorted table of whole-title hashes for exact
+    matches and the UTF-8 titles themselves. Lookups never touch MongoDB.
+    """
+
+    magic: bytes = b"DTI1"
+    header = struct.Struct("<4sIIIIf")
+    # Titles sharing the most trigrams that get scored
+    candidates: int = 50
+    # Postings scanned per lookup, the two rarest trigrams are always scanned
+    max_postings: int = 20000
+    threshold: float = 0.75
+    popularity_weight: float = 0.05
+    # Trigram postings are spilled to this many files, split by their top bits
+    buckets: int = 256
+    buffer_size: int = 4096
+
+    def __init__(
+        self, data_type: str, export_dir: str = os.path.join("cache", "exports")
+    ):
+        self.data_type = data_type
+        self.path = os.path.join(export_dir, f"{data_type}_titles.idx")
+        self.file = None
+        self.map: Optional[mmap.mmap] = None
+
+    def iter_titles(self, items: Iterable[dict]) -> Iterator[tuple]:
+        """Yields the ID, popularity, adult flag and normalized title of the items"""
+        title_key = "original_name" if self.data_type == "series" else "original_title"
+        for item in items:
+            title = normalize_title(item.get(title_key) or "")
+            if title:
+                yield item["id"], item.get("popularity") or 0.0, item.get(
+                    "adult"
+                ), title
+
+    def build(self, items: Callable[[], Iterable[dict]]):
+        """Builds the index from an export and swaps it in atomically
+
+        The export is read twice, first to number the titles by popularity,
+        then to index them. Titles and trigram postings are spilled to
+        temporary files, and the postings are sorted one bucket at a time, so
+        memory stays under a hundred bytes per title.
+
+        Args:
+            items (Callable): Returns a new iterator over the items of the export
+        """
+        start_time = perf_counter()
+        # Titles by descending popularity, equal ones keep their export order
+        order = array("Q")
+        for _, item_popularity, _, _ in self.iter_titles(items()):
+            bits = struct.unpack("<I", struct.pack("<f", max(item_popularity, 0.0)))[0]
+            order.append((0xFFFFFFFF - bits) << 32 | len(order))
+        order = sort_array(order)
+        count = len(order)
+        ranks = array("I", bytes(4 * count))
+        for index, key in enumerate(order):
+            ranks[key & 0xFFFFFFFF] = index
+        positions = array("I", (key & 0xFFFFFFFF for key in order))
+        del order
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(self.path)) as tmp:
+            ids = array("I", bytes(4 * count))
+            popularity = array("f", bytes(4 * count))
+            gram_counts = array("I", bytes(4 * count))
+            flags = bytearray(count)
+            exact = array("Q")
+            # Title offsets in export order
+            offsets = array("I", [0])
+            buffers = [array("Q") for _ in range(self.buckets)]
+            bucket_files = [
+                open(os.path.join(tmp, f"{bucket}.bin"), "w+b")
+                for bucket in range(self.buckets)
+            ]
+            shift = 32 - (self.buckets - 1).bit_length()
+            titles = open(os.path.join(tmp, "titles.bin"), "w+b")
+            try:
+                for position, (tmdb_id, item_popularity, adult, title) in enumerate(
+                    self.iter_titles(items())
+                ):
+                    index = ranks[position]
+                    ids[index] = tmdb_id
+                    popularity[index] = item_popularity
+                    flags[index] = 1 if adult else 0
+                    grams = trigrams(title)
+                    gram_counts[index] = len(grams)
+                    for gram in grams:
+                        buffer = buffers[gram >> shift]
+                        buffer.append(gram << 32 | index)
+                        if len(buffer) == self.buffer_size:
+                            buffer.tofile(bucket_files[gram >> shift])
+                            del buffer[:]
+                    encoded = title.encode("utf-8")
+                    titles.write(encoded)
+                    offsets.append(offsets[-1] + len(encoded))
+                    exact.append(zlib.crc32(encoded) << 32 | index)
+                del ranks
+                # Equal hashes keep the most popular title first
+                exact = sort_array(exact)
+
+                keys, key_offsets = array("I"), array("I")
+                postings_path = os.path.join(tmp, "postings.bin")
+                total = 0
+                with open(postings_path, "wb") as w:
+                    for buffer, bucket_file in zip(buffers, bucket_files):
+                        bucket_file.seek(0)
+                        buffer.frombytes(bucket_file.read())
+                        bucket_file.truncate(0)
+                        chunk = array("I")
+                        for pair in sorted(buffer):
+                            gram = pair >> 32
+                            if not keys or keys[-1] != gram:
+                                keys.append(gram)
+                                key_offsets.append(total + len(chunk))
+                            chunk.append(pair & 0xFFFFFFFF)
+                        del buffer[:]
+                        chunk.tofile(w)
+                        total += len(chunk)
+                key_offsets.append(total)
+
+                title_offsets = array("I", [0])
+                for position in positions:
+                    title_offsets.append(
+                        title_offsets[-1] + offsets[position + 1] - offsets[position]
+                    )
+                titles.flush()
+                with open(self.path + ".new", "wb") as w:
+                    w.write(
+                        self.header.pack(
+                            self.magic,
+                            count,
+                            len(keys),
+                            total,
+                            title_offsets[-1],
+                            popularity[0] if count else 0.0,
+                        )
+                    )
+                    for section in (
+                        ids,
+                        popularity,
+                        gram_counts,
+                        title_offsets,
+                        keys,
+                        key_offsets,
+                    ):
+                        section.tofile(w)
+                    with open(postings_path, "rb") as r:
+                        shutil.copyfileobj(r, w)
+                    for section in (
+                        array("I", (value >> 32 for value in exact)),
+                        array("I", (value & 0xFFFFFFFF for value in exact)),
+                    ):
+                        section.tofile(w)
+                    w.write(flags)
+                    if title_offsets[-1]:
+                        with mmap.mmap(
+                            titles.fileno(), 0, access=mmap.ACCESS_READ
+                        ) as blob:
+                            for position in positions:
+                                w.write(blob[offsets[position] : offsets[position + 1]])
+            finally:
+                titles.close()
+                for bucket_file in bucket_files:
+                    bucket_file.close()
+        self.close()
+        os.replace(self.path + ".new", self.path)
+        logger.info(
+            "Built the %s title index: %s titles, %s trigrams in %.1fs",
+            self.data_type,
+            count,
+            len(keys),
+            perf_counter() - start_time,
+        )
+
+    def open(self) -> bool:
+        """Maps the index file into memory
+
+        Returns:
+            bool: False if the index has not been built
+        """
+        if self.map is not None:
+            return True
+        if not os.path.exists(self.path):
+            return False
+        self.file = open(self.path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, titles, keys, postings, _, max_popularity = self.header.unpack_from(
+            self.map
+        )
+        if magic != self.magic:
+            self.close()
+            return False
+        self.view = view = memoryview(self.map)
+        offset = self.header.size
+
+        def section(count: int, fmt: str = "I") -> memoryview:
+            nonlocal offset
+            data = view[offset : offset + count * 4].cast(fmt)
+            offset += count * 4
+            return data
+
+        self.titles = titles
+        self.max_popularity = log1p(max(max_popularity, 0))
+        self.ids = section(titles)
+        self.popularity = section(titles, "f")
+        self.gram_counts = section(titles)
+        self.title_offsets = section(titles + 1)
+        self.keys = section(keys)
+        self.key_offsets = section(keys + 1)
+        self.postings = section(postings)
+        self.exact_hashes = section(titles)
+        self.exact_titles = section(titles)
+        self.flags = view[offset : offset + titles]
+        self.blob = view[offset + titles :]
+        return True
+
+    def close(self):
+        if self.map is not None:
+            for name in (
+                "ids",
+                "popularity",
+                "gram_counts",
+                "title_offsets",
+                "keys",
+                "key_offsets",
+                "postings",
+                "exact_hashes",
+                "exact_titles",
+                "flags",
+                "blob",
+                "view",
+            ):
+                getattr(self, name).release()
+            self.map.close()
+            self.file.close()
+            self.map = None
+
+    def title(self, index: int) -> str:
+        start, end = self.title_offsets[index], self.title_offsets[index + 1]
+        return bytes(self.blob[start:end]).decode("utf-8")
+
+    def match(self, title: str, adult: bool = False) -> Optional[int]:
+        """Returns the TMDB ID of the best matching title
+
+        Exact matches resolve to the most popular title. Otherwise the titles
+        sharing the most trigrams are scored by their trigram similarity,
+        with a small popularity bonus, and the best one above the threshold wins.
+        """
+        if not self.open():
+            return None
+        text = normalize_title(title)
+        if not text:
+            return None
+
+        title_hash = zlib.crc32(text.encode("utf-8"))
+        x = bisect_left(self.exact_hashes, title_hash)
+        while x < self.titles and self.exact_hashes[x] == title_hash:
+            index = self.exact_titles[x]
+            if (adult or not self.flags[index]) and self.title(index) == text:
+                return self.ids[index]
+            x += 1
+
+        grams = trigrams(text)
+        found = []
+        for gram in grams:
+            x = bisect_left(self.keys, gram)
+            if x < len(self.keys) and self.keys[x] == gram:
+                start, end = self.key_offsets[x], self.key_offsets[x + 1]
+                found.append((end - start, start, end))
+        found.sort()
+        counts: Counter = Counter()
+        scanned = 0
+        for rank, (length, start, end) in enumerate(found):
+            scanned += length
+            if rank >= 2 and scanned > self.max_postings:
+                break
+            counts.update(self.postings[start:end])
+
+        best_score, best_id = 0.0, None
+        for index, _ in nlargest(self.candidates, counts.items(), key=itemgetter(1)):
+            if self.flags[index] and not adult:
+                continue
+            candidate = trigrams(self.title(index))
+            similarity = 2 * len(grams & candidate) / (len(grams) + len(candidate))
+            if similarity < self.threshold:
+                continue
+            score = similarity + self.popularity_weight * (
+                log1p(max(self.popularity[index], 0)) / self.max_popularity
+                if self.max_popularity
+                else 0
+            )
+            if score > best_score:
+                best_score, best_id = score, self.ids[index]
+        return best_id
+
+    def match_many(
+        self, titles: Iterable[str], adult: bool = False
+    ) -> List[Optional[int]]:
+        """Matches a batch of titles"""
+        return [self.match(title, adult) for title in titles]
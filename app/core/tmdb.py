@@ -1,74 +1,138 @@
-import gzip
 import httpx
+import asyncio
 import ujson as json
-from math import ceil
 from app import logger
+from app.core.parser import clean_file_name
 from app.apis import mongo
-from typing import Optional
-from pymongo import InsertOne
-from difflib import SequenceMatcher
-from datetime import datetime, timezone, timedelta
+from typing import Set, Dict, List, Optional
+from datetime import datetime, timedelta
+from app.core.tmdb_cache import TMDBCache
+from app.core.single_flight import single_flight
+from app.core.rate_limit import RateLimiter, CircuitOpenError
+from app.core.title_index import TitleIndex
+from app.core.identification_cache import IdentificationCache
+
+
+class TMDBError(Exception):
+    """Raised when the TMDB API returns an error"""
 
 
 class TMDB:
-    def __init__(self, api_key: str):
-        if mongo.is_series_cache_init is False:
-            mongo.series_cache_col.delete_many({})
-            self.export_data("series")
-        if mongo.is_movies_cache_init is False:
-            mongo.movies_cache_col.delete_many({})
-            self.export_data("movies")
-        self.client = httpx.Client(params={"api_key": api_key})
-        self.config = self.get_server_config()
+    """Async TMDB client that runs at most ``concurrency`` requests at once
+
+    Requests go through a ``RateLimiter``, which paces them to ``rate`` per
+    second, adapts the concurrency to throttling and retries transient errors.
+    Concurrent identical lookups share a single call.
+    """
+
+    def __init__(self, api_key: str, concurrency: int = 8, rate: float = 40):
+        self.concurrency = max(1, concurrency)
+        self.limiter = RateLimiter(self.concurrency, rate)
+        self.client = httpx.AsyncClient(
+            params={"api_key": api_key},
+            limits=httpx.Limits(max_connections=self.concurrency),
+            timeout=30,
+        )
+        self.cache = TMDBCache(mongo.tmdb_cache_col)
+        self.id_cache = IdentificationCache(mongo.identification_cache_col)
+        self.title_indexes = {
+            "movies": TitleIndex("movies"),
+            "series": TitleIndex("series"),
+        }
+        self.config: dict = {}
+        self.image_base_url: str = ""
+        # Identical requests in flight, and the calls they saved
+        self.flights: Dict[str, asyncio.Future] = {}
+        self.coalesced: int = 0
+
+    async def start(self):
+        """Retrieves the server config, must be awaited before use"""
+        await self.cache.create_indexes()
+        self.config = await self.get_server_config()
         self.image_base_url = self.config["images"]["secure_base_url"]
 
-    def get_server_config(self) -> dict:
+    async def close(self):
+        """Closes the underlying HTTP connections and the title indexes"""
+        await self.client.aclose()
+        for title_index in self.title_indexes.values():
+            title_index.close()
+
+    def log_stats(self):
+        """Logs the request, cache and coalescing counters"""
+        self.limiter.log_stats()
+        self.cache.log_stats()
+        self.id_cache.log_stats()
+        logger.info("TMDB single-flight: %s calls saved", self.coalesced)
+
+    def __json__(self) -> dict:
+        return {**self.limiter.__json__(), "coalesced": self.coalesced}
+
+    async def request(
+        self, url: str, params: Optional[dict] = None, headers: Optional[dict] = None
+    ) -> httpx.Response:
+        """Sends a GET request through the rate limiter
+
+        Raises:
+            TMDBError: If the request kept failing or the circuit is open
+        """
+        try:
+            return await self.limiter.send(
+                lambda: self.client.get(url, params=params, headers=headers)
+            )
+        except (CircuitOpenError, httpx.HTTPError) as e:
+            raise TMDBError(f"Request to {url} failed: {e!r}") from e
+
+    @single_flight
+    async def request_cached(
+        self, kind: str, url: str, params: Optional[dict] = None, fresh: bool = False
+    ) -> dict:
+        """Sends a GET request through the persistent response cache
+
+        Fresh entries are served without a network call, expired ones are
+        revalidated with a conditional request.
+
+        Args:
+            kind (str): The kind of the response, which decides its TTL
+            url (str): The URL of the endpoint
+            params (dict, optional): The query parameters
+            fresh (bool, optional): Skip the cache and store the new response
+
+        Returns:
+            dict: The response body, client errors are returned but never cached
+
+        Raises:
+            TMDBError: If the request failed, or was still throttled after the retries
+        """
+        key = self.cache.key(kind, url, params)
+        entry = None if fresh else await self.cache.get(key)
+        if entry and self.cache.is_fresh(entry):
+            self.cache.hits += 1
+            return json.loads(entry["body"])
+        response = await self.request(url, params, self.cache.validators(entry))
+        if response.status_code == 304 and entry:
+            self.cache.revalidated += 1
+            await self.cache.refresh(key, kind)
+            return json.loads(entry["body"])
+        if response.status_code in self.limiter.retry_statuses:
+            raise TMDBError(
+                f"Request to {url} failed with status code {response.status_code}"
+            )
+        self.cache.misses += 1
+        body = response.json()
+        if response.status_code == 200:
+            await self.cache.put(key, kind, body, response.headers)
+        return body
+
+    async def get_server_config(self) -> dict:
         """Get the server config from the API
 
         Returns:
             dict: The server config
         """
         url = "https://api.themoviedb.org/3/configuration"
-        response = self.client.get(url)
-        return response.json()
-
-    @staticmethod
-    def export_data(data_type: str):
-        """Generates media cache for MongoDB"""
+        return await self.request_cached("config", url)
 
-        date_str = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%m_%d_%Y")
-        type_name = "tv_series" if data_type == "series" else "movie"
-        export_url = (
-            f"http://files.tmdb.org/p/exports/{type_name}_ids_{date_str}.json.gz"
-        )
-        lines = (
-            gzip.decompress(httpx.get(export_url).content).decode("utf-8").splitlines()
-        )
-        bulk_action = []
-        chunks = [lines[i : i + 100000] for i in range(0, len(lines), 100000)]
-        total_chunks = len(chunks)
-        x = 1
-        logger.debug("Splitting %s items into chunks of 100,000 items", len(lines))
-        for chunk in chunks:
-            for line in chunk:
-                try:
-                    bulk_action.append(InsertOne(json.loads(line)))
-                except BaseException:
-                    pass
-            if data_type == "series":
-                mongo.series_cache_col.bulk_write(bulk_action)
-            else:
-                mongo.movies_cache_col.bulk_write(bulk_action)
-            logger.debug("Chunk %s/%s", x, total_chunks)
-            chunks[x - 1] = None
-            x += 1
-            bulk_action = []
-        if data_type == "series":
-            mongo.set_is_series_cache_init(True)
-        else:
-            mongo.set_is_movies_cache_init(True)
-
-    def get_episode_details(
+    async def get_episode_details(
         self, tmdb_id: int, episode_number: int, season_number: int = 1
     ) -> dict:
         """Get the details of a specific episode from the API
@@ -82,10 +146,50 @@ class TMDB:
             dict: The episode details
         """
         url = f"https://api.themoviedb.org/3/tv/{tmdb_id}/season/{season_number}/episode/{episode_number}"
-        response = self.client.get(url)
-        return response.json() if response.status_code == 200 else {}
+        response = await self.request_cached("episode", url)
+        # Error responses carry TMDB's own status code
+        return {} if "status_code" in response else response
 
-    def find_media_id(
+    @single_flight
+    async def identify(
+        self,
+        title: str,
+        data_type: str,
+        year: Optional[str] = None,
+        adult: bool = False,
+        language: str = "en",
+    ) -> Optional[int]:
+        """Gets the TMDB ID for a title through the identification cache
+
+        Uncached titles are searched with the API first, then with the
+        local title index, and the outcome is cached even when nothing was found.
+
+        Returns:
+            Optional[int]
+
+        Raises:
+            TMDBError: If the API search failed, so the title is not dropped as unknown
+        """
+        if not title or not self.id_cache.normalize_title(title):
+            return None
+        key = self.id_cache.key(title, data_type, year, language, adult)
+        if entry := await self.id_cache.get(key):
+            return entry["tmdb_id"]
+        # Failed searches raise before anything is cached
+        tmdb_id = await self.find_media_id(
+            title, data_type, year=year, adult=adult, language=language
+        )
+        source = "api"
+        if not tmdb_id:
+            logger.debug("Advanced search identifying: %s", title)
+            tmdb_id = await self.find_media_id(
+                title, data_type, use_api=False, year=year, adult=adult
+            )
+            source = "index"
+        await self.id_cache.put(key, tmdb_id or None, source)
+        return tmdb_id
+
+    async def find_media_id(
         self,
         title: str,
         data_type: str,
@@ -101,15 +205,16 @@ class TMDB:
         Args:
             title (str): The title of the movie / series
             data_type (str): The type of the title
-            use_api (bool): Use API calls to get info
+            use_api (bool): Use API calls to get info, or else the local title index
             year (int): Release Year of the media
             adult (bool): If the media is under adult category or not
 
         Returns:
             Optional[int]
-        """
-        from app.utils.data import clean_file_name
 
+        Raises:
+            TMDBError: If the API search failed
+        """
         title = title.lower().strip()
         original_title = title
         title = clean_file_name(title)
@@ -120,7 +225,7 @@ class TMDB:
         if use_api:
             logger.debug("Trying search using API for '%s'", title)
             type_name = "tv" if data_type == "series" else "movie"
-            resp = self.client.get(
+            resp = await self.request(
                 f"https://api.themoviedb.org/3/search/{type_name}",
                 params={
                     "query": title,
@@ -134,48 +239,25 @@ class TMDB:
                 if data := resp.json()["results"]:
                     return data[0]["id"]
             else:
-                logger.warning(
-                    "API search failed for '%s' - The API said '{resp.json()['errors']}' with status code %s",
-                    title,
-                    resp.status_code,
+                raise TMDBError(
+                    f"API search failed for '{title}' with status code {resp.status_code}"
                 )
-                return
         else:
-            logger.debug("Trying search using key-value search for '%s'", title)
-            if data_type == "series":
-                cache_col = mongo.series_cache_col
-            else:
-                cache_col = mongo.movies_cache_col
-            result = cache_col.aggregate(
-                [
-                    {"$match": {"$text": {"$search": title}}},
-                    {"$sort": {"score": {"$meta": "textScore"}, "popularity": -1}},
-                    {"$limit": 20},
-                ]
-            )
-            for each in result:
-                if title == each.get("original_title", "").lower().strip():
-                    return each["id"]
-            max_ratio, match = 0, None
-            matcher = SequenceMatcher(b=title)
-            for each in result:
-                matcher.set_seq1(each.get("original_title", "").lower().strip())
-                ratio = matcher.ratio()
-                if ratio > 0.99:
-                    return each
-                if ratio > max_ratio and ratio >= 0.85:
-                    max_ratio = ratio
-                    match = each
-            if match:
-                return match["id"]
-            logger.debug("Advanced difflib search failed for '%s'", title)
-
-    def get_details(self, tmdb_id: int, data_type: str) -> dict:
+            logger.debug("Trying search using the title index for '%s'", title)
+            if tmdb_id := self.title_indexes[data_type].match(title, adult):
+                return tmdb_id
+            logger.debug("Title index search failed for '%s'", title)
+
+    @single_flight
+    async def get_details(
+        self, tmdb_id: int, data_type: str, fresh: bool = False
+    ) -> dict:
         """Get the details of a movie / series from the API
 
         Args:
             tmdb_id (int): The TMDB ID of the movie / series
             data_type (str): The type of the title
+            fresh (bool, optional): Skip the cached details, seasons keep their own rules
 
         Returns:
             dict: The details of the movie / series
@@ -186,33 +268,135 @@ class TMDB:
             "include_image_language": "en",
             "append_to_response": "credits,images,external_ids,videos,reviews",
         }
-        response = self.client.get(url, params=params).json()
-        length = len(response.get("seasons", []))
-        append_seasons = []
-        n_of_appends = ceil(length / 20)
-        x = 0
-        while x < n_of_appends:
-            append_seasons.append("")
-            for n in range((x * 20), ((x + 1) * 20)):
-                append_seasons[x] = append_seasons[x] + "season/" + str(n) + ","
-            append_seasons[x] = append_seasons[x][:-1]
-            x += 1
+        response = await self.request_cached("details", url, params, fresh)
         if type_name == "tv":
-            for n, append_season in enumerate(append_seasons):
-                params = {"append_to_response": append_season}
-                tmp_response = self.client.get(url, params=params).json()
-                season_keys = [k for k in tmp_response.keys() if "season/" in k]
-                for k in season_keys:
-                    response[k] = tmp_response[k]
-        else:
-            response = self.client.get(
-                url,
-                params={
-                    "include_image_language": "en",
-                    "append_to_response": "credits,images,external_ids,videos,reviews",
-                },
-            ).json()
-        # This limits the number of seasons to 17 seasons
-        # More requests need to be made in the event of additional seasons
-        # The data from those requests need to then be merged and returned
+            response.update(await self.get_seasons(url, response.get("seasons", [])))
         return response
+
+    async def get_changes(
+        self, data_type: str, since: datetime, until: datetime
+    ) -> Set[int]:
+        """Get the IDs of the movies / series that changed on TMDB in a time window
+
+        The changes feed covers at most 14 days per request, so longer windows
+        are split, and every page of every window is fetched concurrently.
+
+        Args:
+            data_type (str): The type of the titles
+            since (datetime): The start of the window
+            until (datetime): The end of the window
+
+        Returns:
+            set: The changed TMDB IDs
+
+        Raises:
+            TMDBError: If the changes feed could not be read
+        """
+        type_name = "tv" if data_type == "series" else "movie"
+        url = f"https://api.themoviedb.org/3/{type_name}/changes"
+
+        async def get_page(start: datetime, end: datetime, page: int) -> dict:
+            params = {
+                "start_date": start.strftime("%Y-%m-%d"),
+                "end_date": end.strftime("%Y-%m-%d"),
+                "page": page,
+            }
+            response = await self.request(url, params)
+            if response.status_code != 200:
+                raise TMDBError(
+                    f"Changes feed request failed with status code {response.status_code}"
+                )
+            return response.json()
+
+        async def get_window(start: datetime, end: datetime) -> Set[int]:
+            first = await get_page(start, end, 1)
+            pages = [first] + await asyncio.gather(
+                *(
+                    get_page(start, end, page)
+                    for page in range(2, first.get("total_pages", 1) + 1)
+                )
+            )
+            return {item["id"] for page in pages for item in page.get("results", [])}
+
+        windows = []
+        while since < until:
+            windows.append((since, min(since + timedelta(days=14), until)))
+            since = windows[-1][1]
+        changed: Set[int] = set()
+        for ids in await asyncio.gather(*(get_window(*window) for window in windows)):
+            changed.update(ids)
+        return changed
+
+    async def get_seasons(self, url: str, seasons: List[dict]) -> dict:
+        """Gets the season payloads of a series through the per-season cache
+
+        Seasons that finished airing are served from the cache for good, unless
+        their episode count changed. The others are fetched concurrently in
+        chunks of 20 appended seasons, the most TMDB allows per request.
+
+        Args:
+            url (str): The URL of the series
+            seasons (list): The season list of the series details
+
+        Returns:
+            dict: The season payloads, keyed like appended responses
+        """
+        keys = {
+            season["season_number"]: self.cache.key(
+                "season", f"{url}/season/{season['season_number']}"
+            )
+            for season in seasons
+        }
+        episode_counts = {
+            season["season_number"]: season.get("episode_count") for season in seasons
+        }
+        entries = await self.cache.get_many(list(keys.values()))
+        result, missing = {}, []
+        for number, key in keys.items():
+            entry = entries.get(key)
+            if (
+                entry
+                and self.cache.is_fresh(entry)
+                and entry.get("episode_count") == episode_counts[number]
+            ):
+                self.cache.hits += 1
+                result[f"season/{number}"] = json.loads(entry["body"])
+            else:
+                missing.append(number)
+
+        chunks = [missing[x : x + 20] for x in range(0, len(missing), 20)]
+        responses = await asyncio.gather(
+            *(
+                self.request(
+                    url,
+                    {"append_to_response": ",".join(f"season/{n}" for n in chunk)},
+                )
+                for chunk in chunks
+            )
+        )
+        updates = []
+        for chunk, response in zip(chunks, responses):
+            if response.status_code in self.limiter.retry_statuses:
+                # Missing seasons would silently drop their episodes
+                raise TMDBError(
+                    f"Could not get seasons of {url}, status code {response.status_code}"
+                )
+            if response.status_code != 200:
+                logger.warning(
+                    "Could not get seasons of %s, status code %s",
+                    url,
+                    response.status_code,
+                )
+                continue
+            body = response.json()
+            for number in chunk:
+                if (season := body.get(f"season/{number}")) is not None:
+                    self.cache.misses += 1
+                    result[f"season/{number}"] = season
+                    updates.append(
+                        self.cache.put_season(
+                            keys[number], season, episode_counts[number]
+                        )
+                    )
+        await asyncio.gather(*updates)
+        return result
@@ -0,0 +1,151 @@
+import asyncio
+import ujson as json
+from app import logger
+from typing import Dict, List, Optional
+from urllib.parse import urlencode
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+from datetime import datetime, timezone, timedelta
+
+
+class TMDBCache:
+    """Persistent TMDB response cache stored in MongoDB
+
+    Entries are fresh for a TTL that depends on their kind. Expired entries are
+    revalidated with their ETag / Last-Modified headers before being refetched.
+    Seasons are cached one by one and never expire once they have finished airing.
+    """
+
+    ttl: Dict[str, timedelta] = {
+        "config": timedelta(days=7),
+        "details": timedelta(days=3),
+        "season": timedelta(days=1),
+        "episode": timedelta(days=7),
+    }
+    # Entries that have not been validated for this long are dropped by MongoDB
+    retention: timedelta = timedelta(days=30)
+    # Seasons whose last episode aired this long ago are considered finished
+    season_settled: timedelta = timedelta(days=30)
+
+    def __init__(self, col: Collection):
+        self.col = col
+        self.hits: int = 0
+        self.misses: int = 0
+        self.revalidated: int = 0
+
+    async def create_indexes(self):
+        await asyncio.to_thread(
+            self.col.create_index,
+            [("validated_at", ASCENDING)],
+            expireAfterSeconds=int(self.retention.total_seconds()),
+            name="validated_at",
+        )
+
+    @staticmethod
+    def key(kind: str, url: str, params: Optional[dict] = None) -> str:
+        """Builds a cache key from the endpoint, its path and its query parameters"""
+        params = dict(params or {})
+        if "append_to_response" in params:
+            params["append_to_response"] = ",".join(
+                sorted(params["append_to_response"].split(","))
+            )
+        path = url.removeprefix("https://api.themoviedb.org/3")
+        return f"{kind}:{path}?{urlencode(sorted(params.items()))}"
+
+    async def get(self, key: str) -> Optional[dict]:
+        """Returns a cache entry, fresh or not"""
+        return await asyncio.to_thread(self.col.find_one, {"_id": key})
+
+    async def get_many(self, keys: List[str]) -> Dict[str, dict]:
+        """Returns the cache entries of several keys, fresh or not"""
+        entries = await asyncio.to_thread(
+            lambda: list(self.col.find({"_id": {"$in": keys}}))
+        )
+        return {entry["_id"]: entry for entry in entries}
+
+    @staticmethod
+    def is_fresh(entry: dict) -> bool:
+        expires_at: Optional[datetime] = entry["expires_at"]
+        return expires_at is None or expires_at > datetime.now(timezone.utc).replace(
+            tzinfo=None
+        )
+
+    @staticmethod
+    def validators(entry: Optional[dict]) -> dict:
+        """Returns the conditional request headers of a cache entry"""
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    async def put(self, key: str, kind: str, body: dict, headers) -> None:
+        """Stores a response body with its validators"""
+        now = datetime.now(timezone.utc)
+        await asyncio.to_thread(
+            self.col.replace_one,
+            {"_id": key},
+            {
+                "kind": kind,
+                "body": json.dumps(body),
+                "etag": headers.get("etag"),
+                "last_modified": headers.get("last-modified"),
+                "expires_at": now + self.ttl[kind],
+                "validated_at": now,
+            },
+            upsert=True,
+        )
+
+    @classmethod
+    def season_expiry(cls, season: dict) -> Optional[datetime]:
+        """Returns when a season payload expires, None once the season has finished airing"""
+        now = datetime.now(timezone.utc)
+        air_dates = [
+            episode["air_date"]
+            for episode in season.get("episodes", [])
+            if episode.get("air_date")
+        ]
+        if air_dates:
+            latest = datetime.strptime(max(air_dates), "%Y-%m-%d")
+            if latest.replace(tzinfo=timezone.utc) + cls.season_settled < now:
+                return None
+        return now + cls.ttl["season"]
+
+    async def put_season(self, key: str, season: dict, episode_count: int) -> None:
+        """Stores a season payload with the episode count of the series' season list
+
+        Finished seasons have no ``validated_at``, so MongoDB never drops them.
+        """
+        expires_at = self.season_expiry(season)
+        document = {
+            "kind": "season",
+            "body": json.dumps(season),
+            "episode_count": episode_count,
+            "expires_at": expires_at,
+        }
+        if expires_at is not None:
+            document["validated_at"] = datetime.now(timezone.utc)
+        await asyncio.to_thread(
+            self.col.replace_one, {"_id": key}, document, upsert=True
+        )
+
+    async def refresh(self, key: str, kind: str) -> None:
+        """Extends the lifetime of an entry that the server revalidated"""
+        now = datetime.now(timezone.utc)
+        await asyncio.to_thread(
+            self.col.update_one,
+            {"_id": key},
+            {"$set": {"expires_at": now + self.ttl[kind], "validated_at": now}},
+        )
+
+    def log_stats(self):
+        """Logs the hit / miss counters"""
+        total = self.hits + self.misses + self.revalidated
+        logger.info(
+            "TMDB cache: %s hits, %s revalidated, %s misses (%.1f%% served from cache)",
+            self.hits,
+            self.revalidated,
+            self.misses,
+            (self.hits + self.revalidated) / total * 100 if total else 0,
+        )
@@ -0,0 +1,208 @@
+import os
+import gzip
+import zlib
+import httpx
+import ujson as json
+from app import logger
+from array import array
+from app.apis import mongo
+from time import perf_counter
+from typing import Iterator
+from datetime import datetime, timezone, timedelta
+from app.core.title_index import TitleIndex
+from pymongo import ASCENDING, InsertOne, UpdateOne, DeleteMany
+
+
+class TMDBExport:
+    """Keeps a media cache collection in sync with the TMDB daily ID exports
+
+    The last ingested export is kept compressed on disk. Refreshing diffs it
+    against the new day's export and only applies the added, removed and
+    changed IDs, so the collection and its text index are never rebuilt.
+    The title index used for offline matching is rebuilt from each new export.
+    """
+
+    export_dir: str = os.path.join("cache", "exports")
+
+    def __init__(self, data_type: str, batch_size: int = 10000):
+        self.data_type = data_type
+        self.batch_size = batch_size
+        self.type_name = "tv_series" if data_type == "series" else "movie"
+        if data_type == "series":
+            self.col = mongo.series_cache_col
+        else:
+            self.col = mongo.movies_cache_col
+        self.path = os.path.join(self.export_dir, f"{self.type_name}_ids.json.gz")
+        self.title_index = TitleIndex(data_type, self.export_dir)
+
+    @staticmethod
+    def export_date() -> str:
+        """Returns the date of the latest available export"""
+        return (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%m_%d_%Y")
+
+    def export_url(self, date_str: str) -> str:
+        return (
+            f"http://files.tmdb.org/p/exports/{self.type_name}_ids_{date_str}.json.gz"
+        )
+
+    def sync(self):
+        """Loads the export when the cache is empty, or refreshes it once a day"""
+        date_str = self.export_date()
+        if self.data_type == "series":
+            is_init = mongo.is_series_cache_init
+        else:
+            is_init = mongo.is_movies_cache_init
+        try:
+            if not is_init:
+                self.col.delete_many({})
+                self.load(date_str)
+            elif mongo.get_export_date(self.data_type) != date_str:
+                self.refresh(date_str)
+            elif not os.path.exists(self.title_index.path) and os.path.exists(
+                self.path
+            ):
+                self.title_index.build(lambda: self.iter_export(self.path))
+        except httpx.HTTPError as e:
+            # The key-value search falls back to the previous export
+            logger.warning("Could not sync the %s export: %s", self.data_type, e)
+
+    def download(self, date_str: str) -> str:
+        """Streams an export to disk without decompressing it"""
+        os.makedirs(self.export_dir, exist_ok=True)
+        path = self.path + ".new"
+        with httpx.stream("GET", self.export_url(date_str), timeout=60) as response:
+            response.raise_for_status()
+            with open(path, "wb") as w:
+                for chunk in response.iter_bytes(1 << 16):
+                    w.write(chunk)
+        return path
+
+    @staticmethod
+    def iter_export(path: str) -> Iterator[dict]:
+        """Decompresses and parses an export line by line"""
+        with gzip.open(path, "rb") as r:
+            for line in r:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    pass
+
+    @staticmethod
+    def fingerprint(item: dict) -> int:
+        """Packs an ID and a checksum of its popularity, title and adult flag"""
+        title = item.get("original_title", item.get("original_name"))
+        checksum = zlib.crc32(
+            f"{item.get('popularity')}|{title}|{item.get('adult')}".encode("utf-8")
+        )
+        return (item["id"] << 32) | checksum
+
+    def fingerprints(self, items) -> array:
+        """Returns the sorted fingerprints of an export or of the collection"""
+        return array("Q", sorted(self.fingerprint(item) for item in items))
+
+    def load(self, date_str: str):
+        """Ingests a whole export into unordered bulk writes of fixed size"""
+        path = self.download(date_str)
+        logger.debug("Ingesting %s", self.export_url(date_str))
+        start_time = perf_counter()
+        rows = 0
+        bulk_action = []
+        for item in self.iter_export(path):
+            bulk_action.append(InsertOne(item))
+            if len(bulk_action) == self.batch_size:
+                self.col.bulk_write(bulk_action, ordered=False)
+                rows += len(bulk_action)
+                bulk_action = []
+                logger.debug(
+                    "%s rows ingested (%d rows/s)",
+                    rows,
+                    rows / (perf_counter() - start_time),
+                )
+        if len(bulk_action) > 0:
+            self.col.bulk_write(bulk_action, ordered=False)
+            rows += len(bulk_action)
+        elapsed = perf_counter() - start_time
+        logger.info(
+            "Ingested %s %s export rows in %.1fs (%d rows/s)",
+            rows,
+            self.data_type,
+            elapsed,
+            rows / elapsed if elapsed else 0,
+        )
+        os.replace(path, self.path)
+        self.title_index.build(lambda: self.iter_export(self.path))
+        self.col.create_index([("id", ASCENDING)], background=True, name="id")
+        mongo.set_export_date(self.data_type, date_str)
+        if self.data_type == "series":
+            mongo.set_is_series_cache_init(True)
+        else:
+            mongo.set_is_movies_cache_init(True)
+
+    def refresh(self, date_str: str):
+        """Applies the difference between the previous and the new export"""
+        start_time = perf_counter()
+        # Caches loaded by older versions have no index on id, creating it is a no-op otherwise
+        self.col.create_index([("id", ASCENDING)], background=True, name="id")
+        path = self.download(date_str)
+        if os.path.exists(self.path):
+            old = self.fingerprints(self.iter_export(self.path))
+        else:
+            # No previous export on disk, diff against the collection instead
+            old = self.fingerprints(
+                self.col.find(
+                    {},
+                    {
+                        "_id": 0,
+                        "id": 1,
+                        "popularity": 1,
+                        "original_title": 1,
+                        "original_name": 1,
+                        "adult": 1,
+                    },
+                )
+            )
+        new = self.fingerprints(self.iter_export(path))
+
+        upserts, removed = set(), []
+        i = j = 0
+        while i < len(old) or j < len(new):
+            old_id = old[i] >> 32 if i < len(old) else None
+            new_id = new[j] >> 32 if j < len(new) else None
+            if new_id is None or (old_id is not None and old_id < new_id):
+                removed.append(old_id)
+                i += 1
+            elif old_id is None or new_id < old_id:
+                upserts.add(new_id)
+                j += 1
+            else:
+                if old[i] != new[j]:
+                    upserts.add(new_id)
+                i += 1
+                j += 1
+        del old, new
+
+        bulk_action: list = []
+        for item in self.iter_export(path):
+            if item["id"] in upserts:
+                bulk_action.append(
+                    UpdateOne({"id": item["id"]}, {"$set": item}, upsert=True)
+                )
+                if len(bulk_action) == self.batch_size:
+                    self.col.bulk_write(bulk_action, ordered=False)
+                    bulk_action = []
+        for x in range(0, len(removed), self.batch_size):
+            bulk_action.append(
+                DeleteMany({"id": {"$in": removed[x : x + self.batch_size]}})
+            )
+        if len(bulk_action) > 0:
+            self.col.bulk_write(bulk_action, ordered=False)
+        os.replace(path, self.path)
+        self.title_index.build(lambda: self.iter_export(self.path))
+        mongo.set_export_date(self.data_type, date_str)
+        logger.info(
+            "Refreshed %s export cache in %.1fs: %s upserted, %s removed",
+            self.data_type,
+            perf_counter() - start_time,
+            len(upserts),
+            len(removed),
+        )
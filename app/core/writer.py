@@ -0,0 +1,45 @@
+import asyncio
+from typing import List, Callable, Optional, Awaitable
+from pymongo.collection import Collection
+from app.core.progress import build_progress
+
+
+class BulkWriter:
+    """Flushes write operations to a collection in unordered batches as they are produced"""
+
+    def __init__(
+        self,
+        col: Collection,
+        batch_size: int = 500,
+        on_flush: Optional[Callable[[List], Awaitable]] = None,
+    ):
+        self.col = col
+        self.batch_size = max(1, batch_size)
+        self.on_flush = on_flush
+        self.operations: List = []
+        self.keys: List = []
+        self.written: int = 0
+
+    async def add(self, operation, key=None):
+        """Queues an operation and flushes the batch once it is full
+
+        The keys of the operations of every written batch are passed to ``on_flush``.
+        """
+        self.operations.append(operation)
+        if key is not None:
+            self.keys.append(key)
+        if len(self.operations) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """Writes the queued operations without blocking the event loop"""
+        if len(self.operations) == 0:
+            return
+        operations, self.operations = self.operations, []
+        keys, self.keys = self.keys, []
+        await asyncio.to_thread(self.col.bulk_write, operations, ordered=False)
+        self.written += len(operations)
+        build_progress.written += len(operations)
+        build_progress.report()
+        if self.on_flush is not None and len(keys) > 0:
+            await self.on_flush(keys)
@@ -1,7 +1,8 @@
-import regex as re
 from app import logger
+from app.core.parser import parse_episode_filename
 from datetime import datetime
 from dateutil.parser import isoparse
+from app.core.listing import EpisodeFile
 
 
 class Episode:
@@ -40,14 +41,14 @@ class Episode:
             "thumbnail_path": self.thumbnail_path,
         }
 
-    def __init__(self, file_metadata, media_metadata, index):
+    def __init__(self, file_metadata: EpisodeFile, media_metadata, index):
         # File Info
-        self.id: str = file_metadata["id"]
-        self.file_name: str = file_metadata["name"]
-        self.path: str = file_metadata["path"]
-        self.parent: dict = file_metadata["parent"]
-        self.modified_time: datetime = isoparse(file_metadata["modified_time"])
-        self.size: int = file_metadata["size"]
+        self.id: str = file_metadata.id
+        self.file_name: str = file_metadata.name
+        self.path: str = file_metadata.path
+        self.parent: str = file_metadata.parent
+        self.modified_time: datetime = isoparse(file_metadata.modified_time)
+        self.size: int = file_metadata.size
 
         parsed_data: dict = self.parse_episode_filename(
             self.file_name, media_metadata["season_number"]
@@ -91,18 +92,7 @@ class Episode:
         # Media Resources
         self.thumbnail_path: str = episode_metadata["still_path"]
 
-    def parse_episode_filename(self, name: str, season_number: int) -> dict:
+    @staticmethod
+    def parse_episode_filename(name: str, season_number: int) -> dict:
         """Identifies the season and episode numbers from an episode's file name"""
-        reg_exps = [
-            r".+?s ?(?P<season>\d{0,2})e ?(?P<episode>\d{0,4}).+",
-            r".+?e ?(?P<episode>\d{0,2})s ?(?P<season>\d{0,4}).+",
-            r".+?e ?(?P<episode>\d{0,4})",
-        ]
-        for exp in reg_exps:
-            if match := re.match(exp, name, flags=2):
-                data = match.groupdict()
-                if not data.get("season"):
-                    data["season"] = season_number
-                data["season"] = int(data["season"])
-                return data
-        return {}
+        return parse_episode_filename(name, season_number)
@@ -1,7 +1,8 @@
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, List, Tuple, Optional
 from app.settings import settings
 from dateutil.parser import isoparse
+from app.core.listing import MovieFile
 
 
 class Movie:
@@ -43,6 +44,32 @@ class Movie:
         "reviews",
     ]
 
+    media_fields: Tuple[str, ...] = (
+        "tmdb_id",
+        "title",
+        "original_title",
+        "status",
+        "popularity",
+        "revenue",
+        "rating",
+        "release_date",
+        "year",
+        "tagline",
+        "description",
+        "runtime",
+        "cast",
+        "crew",
+        "studios",
+        "genres",
+        "external_ids",
+        "logo_path",
+        "homepage",
+        "backdrop_path",
+        "poster_path",
+        "videos",
+        "reviews",
+    )
+
     def __json__(self) -> dict:
         return {
             "id": self.id,
@@ -80,18 +107,33 @@ class Movie:
             "reviews": self.reviews,
         }
 
-    def __init__(self, file_metadata, media_metadata, rclone_index):
+    def __init__(self, file_metadata: MovieFile, media_metadata, rclone_index):
         # File Info
-        self.id: List[str] = [file_metadata["id"]]
-        self.file_name: List[str] = [file_metadata["name"]]
-        self.path: List[str] = [file_metadata["path"]]
-        self.parent: List[dict] = [file_metadata["parent"]]
-        self.modified_time: List[datetime] = [isoparse(file_metadata["modified_time"])]
+        self.id: List[str] = [file_metadata.id]
+        self.file_name: List[str] = [file_metadata.name]
+        self.path: List[str] = [file_metadata.path]
+        self.parent: List[Optional[dict]] = [self.get_parent(file_metadata)]
+        self.modified_time: List[datetime] = [isoparse(file_metadata.modified_time)]
         self.number_of_files: int = 1
         self.rclone_index: int = rclone_index
-        self.size: List[int] = [file_metadata["size"]]
-        self.subtitles: List[dict] = file_metadata["subtitles"]
+        self.size: List[int] = [file_metadata.size]
+        self.subtitles: List[dict] = [
+            subtitle.__json__() for subtitle in file_metadata.subtitles
+        ]
+        self.thumbnail_path: str = (
+            f"{settings.API_V1_STR}/assets/thumbnail/{rclone_index}/{self.id}"
+        )
+        self.set_media_info(media_metadata)
 
+    @classmethod
+    def media_info(cls, media_metadata: dict) -> dict:
+        """Returns the fields that come from TMDB, to update a stored movie in place"""
+        movie = cls.__new__(cls)
+        movie.set_media_info(media_metadata)
+        return {field: getattr(movie, field) for field in cls.media_fields}
+
+    def set_media_info(self, media_metadata: dict):
+        """Sets the fields that come from TMDB"""
         # Media Info
         self.tmdb_id: int = media_metadata["id"]
         self.title: str = media_metadata["title"]
@@ -115,24 +157,27 @@ class Movie:
         # Media Resources
         self.logo_path: str = self.get_logo(media_metadata)
         self.homepage: str = media_metadata["homepage"]
-        self.thumbnail_path: str = (
-            f"{settings.API_V1_STR}/assets/thumbnail/{rclone_index}/{self.id}"
-        )
         self.backdrop_path: str = media_metadata["backdrop_path"]
         self.poster_path: str = media_metadata["poster_path"]
         self.videos: List[dict] = media_metadata["videos"]["results"][:10]
         self.reviews: List[dict] = media_metadata["reviews"]["results"][:10]
 
-    def append_file(self, file_metadata):
+    def append_file(self, file_metadata: MovieFile):
         """Pushes a new file to the class"""
-        self.id.append(file_metadata["id"])
-        self.file_name.append(file_metadata["name"])
-        self.path.append(file_metadata["path"])
-        self.parent.append(file_metadata["parent"])
-        self.modified_time.append(isoparse(file_metadata["modified_time"]))
+        self.id.append(file_metadata.id)
+        self.file_name.append(file_metadata.name)
+        self.path.append(file_metadata.path)
+        self.parent.append(self.get_parent(file_metadata))
+        self.modified_time.append(isoparse(file_metadata.modified_time))
         self.number_of_files += 1
-        self.size.append(file_metadata["size"])
-        self.subtitles.extend(file_metadata["subtitles"])
+        self.size.append(file_metadata.size)
+        self.subtitles.extend(
+            subtitle.__json__() for subtitle in file_metadata.subtitles
+        )
+
+    @staticmethod
+    def get_parent(file_metadata: MovieFile) -> Optional[dict]:
+        return file_metadata.parent.__json__() if file_metadata.parent else None
 
     def get_logo(self, media_metadata: dict) -> str:
         """Returns the movie logo URL if available"""
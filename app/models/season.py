@@ -2,6 +2,7 @@ from typing import List
 from datetime import datetime
 from app.models import Episode
 from dateutil.parser import isoparse
+from app.core.listing import SeasonFolder
 
 
 class Season:
@@ -42,13 +43,13 @@ class Season:
             "episodes": self.episodes,
         }
 
-    def __init__(self, file_metadata, media_metadata):
+    def __init__(self, file_metadata: SeasonFolder, media_metadata):
         # File Info
-        self.id: str = file_metadata["id"]
-        self.file_name: str = file_metadata["name"]
-        self.path: str = file_metadata["path"]
-        self.parent: dict = file_metadata["parent"]
-        self.modified_time: datetime = isoparse(file_metadata["modified_time"])
+        self.id: str = file_metadata.id
+        self.file_name: str = file_metadata.name
+        self.path: str = file_metadata.path
+        self.parent: str = file_metadata.parent
+        self.modified_time: datetime = isoparse(file_metadata.modified_time)
         self.size: int = 0
 
         # Media Info
@@ -64,9 +65,9 @@ class Season:
         self.poster_path: str = media_metadata["poster_path"]
 
         # Episodes
-        index: int = len(file_metadata["episodes"])
+        index: int = len(file_metadata.episodes)
         episodes: List[dict] = []
-        for episode in file_metadata["episodes"]:
+        for episode in file_metadata.episodes:
             episode_meta: Episode = Episode(episode, media_metadata, index)
             episodes.append(episode_meta.__json__())
             self.size += episode_meta.size
@@ -1,7 +1,9 @@
-from typing import List
+from hashlib import sha1
+from typing import List, Tuple, Optional
 from app.models import Season
 from datetime import datetime
 from dateutil.parser import isoparse
+from app.core.listing import SeriesFolder
 
 
 class Series:
@@ -41,8 +43,38 @@ class Series:
         "videos",
         "reviews",
         "seasons",
+        "fingerprint",
     ]
 
+    media_fields: Tuple[str, ...] = (
+        "tmdb_id",
+        "title",
+        "original_title",
+        "status",
+        "popularity",
+        "rating",
+        "release_date",
+        "year",
+        "tagline",
+        "description",
+        "runtime",
+        "cast",
+        "crew",
+        "studios",
+        "genres",
+        "external_ids",
+        "total_episodes",
+        "total_seasons",
+        "last_episode_to_air",
+        "next_episode_to_air",
+        "logo_path",
+        "homepage",
+        "backdrop_path",
+        "poster_path",
+        "videos",
+        "reviews",
+    )
+
     def __json__(self):
         return {
             "id": self.id,
@@ -79,18 +111,43 @@ class Series:
             "videos": self.videos,
             "reviews": self.reviews,
             "seasons": self.seasons,
+            "fingerprint": self.fingerprint,
         }
 
-    def __init__(self, file_metadata, media_metadata, rclone_index):
+    def __init__(self, file_metadata: SeriesFolder, media_metadata, rclone_index):
         # File Info
-        self.id: str = file_metadata["id"]
-        self.file_name: str = file_metadata["name"]
-        self.path: str = file_metadata["path"]
-        self.parent: dict = file_metadata["parent"]
-        self.modified_time: datetime = isoparse(file_metadata["modified_time"])
+        self.id: str = file_metadata.id
+        self.file_name: str = file_metadata.name
+        self.path: str = file_metadata.path
+        self.parent: Optional[str] = file_metadata.parent
+        self.modified_time: datetime = isoparse(file_metadata.modified_time)
         self.rclone_index: int = rclone_index
         self.size: int = 0
+        self.set_media_info(media_metadata)
+
+        # Seasons
+        seasons: List[dict] = []
+        for key, season in file_metadata.seasons.items():
+            if f"season/{key}" in media_metadata:
+                season_meta: Season = Season(season, media_metadata[f"season/{key}"])
+                seasons.append(season_meta.__json__())
+                self.size += season_meta.size
+        self.seasons: List[dict] = sorted(seasons, key=lambda d: d["season_number"])
+        del seasons
+        self.fingerprint: str = self.get_fingerprint(file_metadata)
 
+    @classmethod
+    def media_info(cls, media_metadata: dict) -> dict:
+        """Returns the fields that come from TMDB, to update a stored series in place
+
+        Seasons and episodes are left out, they are rebuilt with the files.
+        """
+        series = cls.__new__(cls)
+        series.set_media_info(media_metadata)
+        return {field: getattr(series, field) for field in cls.media_fields}
+
+    def set_media_info(self, media_metadata: dict):
+        """Sets the fields that come from TMDB"""
         # Media Info
         self.tmdb_id: int = media_metadata["id"]
         self.title: str = media_metadata["name"]
@@ -128,15 +185,15 @@ class Series:
         self.videos: List[dict] = media_metadata["videos"]["results"][:10]
         self.reviews: List[dict] = media_metadata["reviews"]["results"][:10]
 
-        # Seasons
-        seasons: List[dict] = []
-        for key, season in file_metadata["seasons"].items():
-            if f"season/{key}" in media_metadata:
-                season_meta: Season = Season(season, media_metadata[f"season/{key}"])
-                seasons.append(season_meta.__json__())
-                self.size += season_meta.size
-        self.seasons: List[dict] = sorted(seasons, key=lambda d: d["season_number"])
-        del seasons
+    @staticmethod
+    def get_fingerprint(file_metadata: SeriesFolder) -> str:
+        """Returns a hash of a series folder's name, episode files and their modified times"""
+        files: List[str] = sorted(
+            f"{episode.id}:{episode.modified_time}"
+            for season in file_metadata.seasons.values()
+            for episode in season.episodes
+        )
+        return sha1("|".join([file_metadata.name, *files]).encode("utf-8")).hexdigest()
 
     def get_logo(self, media_metadata: dict) -> str:
         """Returns the series logo URL if available"""
@@ -1,4 +1,5 @@
 from .time_formatter import time_formatter
+from app.core.parser import (
+    parse_filename, clean_file_name, parse_name, parse_names)
 from .data import (
-    parse_filename, clean_file_name, generate_movie_metadata,
-    generate_series_metadata)
+    identify_media, is_overridden, identify_movie_files, build_movies, build_series)
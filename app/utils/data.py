@@ -1,78 +1,71 @@
-import regex as re
+import asyncio
 from app import logger
-from pymongo import InsertOne
-from typing import Dict, List
 from app.models import Movie, Series
+from app.core.progress import build_progress
+from app.core.listing import MovieFile, SeriesFolder
+from app.core.parser import TMDB_ID_PATTERN, parse_name
+from app.core.identification_cache import IdentificationCache
+from typing import Dict, List, Tuple, Optional, AsyncIterator
 
 
-def parse_filename(name: str, data_type: str):
-    """Identifies media names and years from file name"""
-    reg_exps = (
-        [
-            # (2019) The Mandalorian
-            r"^[\(\[\{](?P<year>\d{4})[\)\]\}]\s(?P<title>[^.]+).*$",
-            # The Mandalorian (2019)
-            r"^(?P<title>.*)\s[\(\[\{](?P<year>\d{4})[\)\]\}].*$",
-            # The.Mandalorian.2019.1080p.WEBRip
-            r"^(?P<title>(?:(?!\.\d{4}).)*)\.(?P<year>\d{4}).*$",
-            # The Mandalorian
-            r"^(?P<year>)(?P<title>.*)$",
-        ]
-        if data_type == "series"
-        else [
-            # (2008) Iron Man.mkv
-            r"^[\(\[\{](?P<year>\d{4})[\)\]\}]\s(?P<title>[^.]+).*(?P<extention>\..*)?$",
-            # Iron Man (2008).mkv
-            r"^(?P<title>.*)\s[\(\[\{](?P<year>\d{4})[\)\]\}].*(?P<extention>\..*)?$",
-            # Iron.Man.2008.1080p.WEBRip.DDP5.1.Atmos.x264.mkv
-            # r"^(?P<title>(?:(?!\.\d{4}).)*)\.(?P<year>\d{4}).*(?P<extention>\..*)?$",
-            r"^(?P<title>(?:(?!\.\d{4}).)*)\.(?P<year>\d{4}).*?(?P<extention>\.\w+)?$",
-            # Iron Man.mkv
-            r"^(?P<year>)(?P<title>.*).*(?P<extention>\..*?)?",
-        ]
+async def identify_media(
+    tmdb,
+    original_name: str,
+    data_type: str,
+    language: str = "en",
+    adult: bool = False,
+) -> Tuple[Optional[int], str, str]:
+    """Identifies a media's TMDB ID from its file or folder name"""
+    match = TMDB_ID_PATTERN.search(original_name)
+    if match:
+        return int(match.group(2)), original_name, ""
+    name, year = parse_name(original_name, data_type)
+    tmdb_id = await tmdb.identify(
+        name, data_type, year=year, adult=adult, language=language
     )
-    for exp in reg_exps:
-        if match := re.match(exp, name):
-            data = match.groupdict()
-            data["title"] = data["title"].strip().replace(".", " ")
-            return data
-    return {}
-
-
-def clean_file_name(name: str) -> str:
-    """Removes common and unnecessary strings from file names"""
-    reg_exps = [
-        r"\((?:\D.+?|.+?\D)\)|\[(?:\D.+?|.+?\D)\]",  # (2016), [2016], etc
-        r"\(?(?:240|360|480|720|1080|1440|2160)p?\)?",  # 1080p, 720p, etc
-        r"\b(?:mp4|mkv|wmv|m4v|mov|avi|flv|webm|flac|mka|m4a|aac|ogg)\b",  # file types
-        r"season ?\d+?",  # season 1, season 2, etc
-        # more stuffs
-        r"(?:S\d{1,3}|\d+?bit|dsnp|web\-dl|ddp\d+? ? \d|hevc|hdrip|\-?Vyndros)",
-        # URLs in filenames
-        r"^(?:https?:\/\/)?(?:www.)?[a-z0-9]+\.[a-z]+(?:\/[a-zA-Z0-9#]+\/?)*$",
-    ]
-    for reg in reg_exps:
-        name = re.sub(reg, "", name)
-    return name.strip().rstrip(".-_")
-
-
-def generate_movie_metadata(tmdb, data: dict, rclone_index: int) -> List[InsertOne]:
-    """Matches and identifies movies by file names and returns a list of MongoDB insert tasks"""
-    advanced_search_list = []
-    identified_list: Dict[int, Movie] = {}
-    for drive_meta in data:
-        original_name = drive_meta["name"]
-        match = re.search(r"{{(tmdb_id|anidb_id):(\d{1,8})}}", original_name)
-        if match:
-            tmdb_id = match.group(2)
-        else:
-            cleaned_title = clean_file_name(original_name)
-            name_year = parse_filename(cleaned_title, "movies")
-            name = name_year.get("title")
-            year = name_year.get("year")
-            tmdb_id = tmdb.find_media_id(name, "movies", year=year)
+    return tmdb_id, name, year
+
+
+def is_overridden(
+    overrides: Dict[str, Optional[int]],
+    tmdb_id: int,
+    original_name: str,
+    data_type: str,
+    language: str = "en",
+    adult: bool = False,
+) -> bool:
+    """Whether a manual override now identifies a name as something else"""
+    if not overrides or TMDB_ID_PATTERN.search(original_name):
+        return False
+    name, year = parse_name(original_name, data_type)
+    key = IdentificationCache.key(name, data_type, year, language, adult)
+    return key in overrides and overrides[key] != tmdb_id
+
+
+async def identify_movie_files(
+    tmdb,
+    data: List[MovieFile],
+    details: Optional[Dict[int, asyncio.Task]] = None,
+    language: str = "en",
+    adult: bool = False,
+) -> Dict[str, int]:
+    """Matches movie files by file names and returns a map of file IDs to TMDB IDs
+
+    Files are identified concurrently and handled in completion order. When a
+    ``details`` map is given, the details of every newly identified movie start
+    being fetched right away and the pending tasks are stored in it.
+    """
+
+    async def identify(drive_meta: MovieFile):
+        return drive_meta, await identify_media(
+            tmdb, drive_meta.name, "movies", language, adult
+        )
+
+    identified: Dict[str, int] = {}
+    for task in asyncio.as_completed([identify(drive_meta) for drive_meta in data]):
+        drive_meta, (tmdb_id, name, year) = await task
+        build_progress.advance()
         if not tmdb_id:
-            advanced_search_list.append((name, year))
             logger.info("Could not identify: %s", name)
             continue
         logger.info(
@@ -81,58 +74,79 @@ def generate_movie_metadata(tmdb, data: dict, rclone_index: int) -> List[InsertO
             year if year else "",
             tmdb_id,
         )
-        identified_match = identified_list.get(tmdb_id)
-        if identified_match:
-            identified_match.append_file(drive_meta)
-        else:
-            movie_info = tmdb.get_details(tmdb_id, "movies")
-            curr_metadata: Movie = Movie(drive_meta, movie_info, rclone_index)
-            identified_list[tmdb_id] = curr_metadata
-    for name, year in advanced_search_list:
-        logger.debug("Advanced search identifying: %s", cleaned_title)
-        tmdb_id = tmdb.find_media_id(name, "movies", year=year, use_api=False)
-        if not tmdb_id:
-            logger.info("Advanced search could not identify: %s", name)
-            continue
-        identified_match = identified_list.get(tmdb_id)
-        if identified_match:
-            identified_match.append_file(drive_meta)
-        else:
-            movie_info = tmdb.get_details(tmdb_id, "movies")
-            logger.info(
-                "Successfully identified: %s    ID: %s", movie_info["title"], tmdb_id
-            )
-            curr_metadata: Movie = Movie(drive_meta, movie_info, rclone_index)
-            identified_list[tmdb_id] = curr_metadata
-    metadata: List[InsertOne] = []
-    for item in identified_list.values():
-        metadata.append(InsertOne(item.__json__()))
-    return metadata
+        identified[drive_meta.id] = tmdb_id
+        if details is not None and tmdb_id not in details:
+            details[tmdb_id] = asyncio.create_task(tmdb.get_details(tmdb_id, "movies"))
+    return identified
+
 
+async def build_movies(
+    tmdb,
+    data: List[MovieFile],
+    rclone_index: int,
+    identified: Dict[str, int],
+    details: Optional[Dict[int, asyncio.Task]] = None,
+) -> AsyncIterator[Movie]:
+    """Groups identified movie files by TMDB ID and yields their metadata as it is fetched
 
-def generate_series_metadata(tmdb, data: dict, rclone_index: int) -> List[InsertOne]:
-    """Matches and identifies series by folder names and returns a list of MongoDB insert tasks"""
-    metadata: List[InsertOne] = []
+    Details are fetched concurrently, reusing the tasks already started in ``details``.
+    """
+    details = {} if details is None else details
+    files: Dict[int, List[MovieFile]] = {}
     for drive_meta in data:
-        original_name = drive_meta["name"]
-        match = re.search(r"{{(tmdb_id|anidb_id):(\d{1,8})}}", original_name)
-        if match:
-            tmdb_id = match.group(2)
-        else:
-            cleaned_title = clean_file_name(original_name)
-            name_year = parse_filename(cleaned_title, "series")
-            name = name_year.get("title")
-            year = name_year.get("year")
-            tmdb_id = tmdb.find_media_id(name, "series", year=year)
+        tmdb_id = identified.get(drive_meta.id)
+        if tmdb_id:
+            files.setdefault(tmdb_id, []).append(drive_meta)
+    for tmdb_id in files:
+        if tmdb_id not in details:
+            details[tmdb_id] = asyncio.create_task(tmdb.get_details(tmdb_id, "movies"))
+
+    async def fetch(tmdb_id: int):
+        return tmdb_id, await details[tmdb_id]
+
+    for task in asyncio.as_completed([fetch(tmdb_id) for tmdb_id in files]):
+        tmdb_id, movie_info = await task
+        movie_files = files.pop(tmdb_id)
+        del details[tmdb_id]
+        movie = Movie(movie_files[0], movie_info, rclone_index)
+        for drive_meta in movie_files[1:]:
+            movie.append_file(drive_meta)
+        build_progress.advance(len(movie_files))
+        yield movie
+
+
+async def build_series(
+    tmdb,
+    data: List[SeriesFolder],
+    rclone_index: int,
+    known_ids: Optional[Dict[str, int]] = None,
+    language: str = "en",
+    adult: bool = False,
+) -> AsyncIterator[Series]:
+    """Matches and identifies series by folder names and yields their metadata
+
+    Folders are identified and fetched concurrently and yielded in completion order.
+    Folders found in ``known_ids`` reuse their TMDB ID instead of being searched again.
+    """
+    known_ids = known_ids or {}
+
+    async def identify(drive_meta: SeriesFolder) -> Optional[Series]:
+        tmdb_id = known_ids.get(drive_meta.id)
         if not tmdb_id:
-            tmdb_id = tmdb.find_media_id(name, "series", year=year, use_api=False)
+            tmdb_id, name, _ = await identify_media(
+                tmdb, drive_meta.name, "series", language, adult
+            )
             if not tmdb_id:
                 logger.info("Could not identify: %s", name)
-                continue
-        series_info = tmdb.get_details(tmdb_id, "series")
+                return None
+        series_info = await tmdb.get_details(tmdb_id, "series")
         logger.info(
             "Successfully identified: %s    ID: %s", series_info["name"], tmdb_id
         )
-        curr_metadata: Series = Series(drive_meta, series_info, rclone_index)
-        metadata.append(InsertOne(curr_metadata.__json__()))
-    return metadata
+        return Series(drive_meta, series_info, rclone_index)
+
+    for task in asyncio.as_completed([identify(drive_meta) for drive_meta in data]):
+        result = await task
+        build_progress.advance()
+        if result is not None:
+            yield result
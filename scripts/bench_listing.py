@@ -0,0 +1,152 @@
+"""Benchmarks the series tree builder against the previous eval-based implementation
+
+Usage: python -m scripts.bench_listing [entries] [repeats]
+"""
+import sys
+import regex as re
+from time import perf_counter
+
+
+def legacy_parse_series(rc_ls_result: list) -> list:
+    metadata: list = []
+    parent_dirs: dict = {
+        "": {
+            "path": "",
+            "depth": 0,
+            "json_path": "",
+        }
+    }
+    for item in rc_ls_result:
+        if len(item["Path"].split("/")) == 1:
+            parent_path = ""
+        else:
+            parent_path = item["Path"].replace("/" + item["Name"], "")
+        parent = parent_dirs[parent_path]
+        if item["IsDir"] is False:
+            if parent["depth"] == 2:
+                season_metadata = eval("metadata" + parent["json_path"])
+                season_metadata["episodes"].append(
+                    {
+                        "id": item.get("ID", item["Path"]),
+                        "name": item["Name"],
+                        "path": item["Path"],
+                        "parent": parent,
+                        "mime_type": item["MimeType"],
+                        "size": item["Size"],
+                        "modified_time": item["ModTime"],
+                    }
+                )
+        else:
+            parent_dirs[item["Path"]] = {
+                "id": item.get("ID", item["Path"]),
+                "name": item["Name"],
+                "path": item["Path"],
+                "depth": parent["depth"] + 1,
+            }
+            if parent["depth"] == 0:
+                metadata.append(
+                    {
+                        "id": item.get("ID", item["Path"]),
+                        "name": item["Name"],
+                        "path": item["Path"],
+                        "parent": parent,
+                        "mime_type": item["MimeType"],
+                        "modified_time": item["ModTime"],
+                        "seasons": {},
+                        "json_path": f"[{len(metadata)}]",
+                    }
+                )
+                parent_dirs[item["Path"]]["json_path"] = f"[{len(metadata) - 1}]"
+            elif parent["depth"] == 1:
+                series_metadata = eval("metadata" + parent["json_path"])
+                season = re.search(
+                    r"(?<=Season.|season.|S|s)\d{1,3}|^\d{1,3}$", item["Name"]
+                )
+                season = season.group() if season else "1"
+                if season != "0":
+                    season = season.lstrip("0")
+                series_metadata["seasons"][season] = {
+                    "id": item.get("ID", item["Path"]),
+                    "name": item["Name"],
+                    "path": item["Path"],
+                    "parent": parent,
+                    "mime_type": item["MimeType"],
+                    "modified_time": item["ModTime"],
+                    "episodes": [],
+                    "json_path": parent["json_path"] + f'["{season}"]',
+                }
+                parent_dirs[item["Path"]]["json_path"] = (
+                    parent["json_path"] + f'["seasons"]["{season}"]'
+                )
+    return metadata
+
+
+def listing(size: int, seasons: int = 5, episodes: int = 20) -> list:
+    """Generates a series listing of about ``size`` entries, folders first"""
+    items = []
+
+    def entry(path: str, name: str, is_dir: bool) -> dict:
+        return {
+            "Path": path,
+            "Name": name,
+            "Size": -1 if is_dir else 1 << 30,
+            "MimeType": "inode/directory" if is_dir else "video/x-matroska",
+            "ModTime": "2022-06-01T12:00:00.000Z",
+            "IsDir": is_dir,
+            "ID": f"id{len(items)}",
+        }
+
+    x = 0
+    while len(items) < size:
+        series = f"Show {x} (2020)"
+        items.append(entry(series, series, True))
+        for season in range(1, seasons + 1):
+            folder = f"{series}/Season {season:02d}"
+            items.append(entry(folder, f"Season {season:02d}", True))
+            for episode in range(1, episodes + 1):
+                name = f"Show {x} S{season:02d}E{episode:02d} 1080p.mkv"
+                items.append(entry(f"{folder}/{name}", name, False))
+        x += 1
+    return items
+
+
+def shape(metadata: list) -> list:
+    return [
+        (
+            series["id"],
+            {
+                key: [episode["id"] for episode in season["episodes"]]
+                for key, season in series["seasons"].items()
+            },
+        )
+        for series in metadata
+    ]
+
+
+def bench(label: str, func, items: list, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start_time = perf_counter()
+        func(items)
+        best = min(best, perf_counter() - start_time)
+    print(f"{label:<24} {best:>8.2f}s {len(items) / best:>12,.0f} entries/s")
+    return best
+
+
+def main():
+    from app.core.listing import SeriesTree
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    items = listing(size)
+    built = [series.__json__() for series in SeriesTree().build(items)]
+    assert shape(built) == shape(legacy_parse_series(items))
+
+    print(f"{len(items)} entries")
+    legacy = bench("eval json paths", legacy_parse_series, items, repeats)
+    tree = bench("series tree", lambda n: SeriesTree().build(n), items, repeats)
+    print(f"{legacy / tree:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
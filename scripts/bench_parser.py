@@ -0,0 +1,159 @@
+"""Benchmarks the filename parser against the previous per-call regex implementation
+
+Usage: python -m scripts.bench_parser [names] [repeats]
+"""
+import sys
+import random
+import regex as re
+from time import perf_counter
+
+
+MOVIE_EXPS = [
+    r"^[\(\[\{](?P<year>\d{4})[\)\]\}]\s(?P<title>[^.]+).*(?P<extention>\..*)?$",
+    r"^(?P<title>.*)\s[\(\[\{](?P<year>\d{4})[\)\]\}].*(?P<extention>\..*)?$",
+    r"^(?P<title>(?:(?!\.\d{4}).)*)\.(?P<year>\d{4}).*?(?P<extention>\.\w+)?$",
+    r"^(?P<year>)(?P<title>.*).*(?P<extention>\..*?)?",
+]
+CLEAN_EXPS = [
+    r"\((?:\D.+?|.+?\D)\)|\[(?:\D.+?|.+?\D)\]",
+    r"\(?(?:240|360|480|720|1080|1440|2160)p?\)?",
+    r"\b(?:mp4|mkv|wmv|m4v|mov|avi|flv|webm|flac|mka|m4a|aac|ogg)\b",
+    r"season ?\d+?",
+    r"(?:S\d{1,3}|\d+?bit|dsnp|web\-dl|ddp\d+? ? \d|hevc|hdrip|\-?Vyndros)",
+    r"^(?:https?:\/\/)?(?:www.)?[a-z0-9]+\.[a-z]+(?:\/[a-zA-Z0-9#]+\/?)*$",
+]
+EPISODE_EXPS = [
+    r".+?s ?(?P<season>\d{0,2})e ?(?P<episode>\d{0,4}).+",
+    r".+?e ?(?P<episode>\d{0,2})s ?(?P<season>\d{0,4}).+",
+    r".+?e ?(?P<episode>\d{0,4})",
+]
+TITLES = [
+    "Iron Man",
+    "The Dark Knight",
+    "Spirited Away",
+    "Blade Runner 2049",
+    "The Lord of the Rings The Two Towers",
+    "Mad Max Fury Road",
+    "Parasite",
+    "Everything Everywhere All at Once",
+]
+TAGS = ["1080p", "720p", "2160p", "WEBRip", "BluRay", "x264", "HEVC", "10bit", "DDP5 1"]
+
+
+def legacy_parse(name: str) -> tuple:
+    for reg in CLEAN_EXPS:
+        name = re.sub(reg, "", name)
+    name = name.strip().rstrip(".-_")
+    for exp in MOVIE_EXPS:
+        if match := re.match(exp, name):
+            data = match.groupdict()
+            return data["title"].strip().replace(".", " "), data.get("year")
+    return None, None
+
+
+def legacy_parse_episode(name: str, season_number: int) -> dict:
+    for exp in EPISODE_EXPS:
+        if match := re.match(exp, name, flags=2):
+            data = match.groupdict()
+            if not data.get("season"):
+                data["season"] = season_number
+            data["season"] = int(data["season"])
+            return data
+    return {}
+
+
+def movie_corpus(size: int, unique: float = 0.5) -> list:
+    """Generates movie file names, a share of which are repeated"""
+    rng = random.Random(42)
+    names = []
+    for x in range(int(size * unique)):
+        title = rng.choice(TITLES) + (f" {x}" if x >= len(TITLES) else "")
+        year = rng.randint(1950, 2023)
+        tags = " ".join(rng.sample(TAGS, 3))
+        names.append(
+            rng.choice(
+                (
+                    f"{title} ({year}) {tags}.mkv",
+                    f"{title.replace(' ', '.')}.{year}.{tags.replace(' ', '.')}.mkv",
+                    f"({year}) {title}.mp4",
+                    f"{title} [{tags}].mkv",
+                )
+            )
+        )
+    return [rng.choice(names) for _ in range(size)]
+
+
+def episode_corpus(size: int) -> list:
+    return [
+        f"Show {x % 500} S{x % 12 + 1:02d}E{x % 24 + 1:02d} 1080p WEB-DL.mkv"
+        for x in range(size)
+    ]
+
+
+def bench(label: str, func, names: list, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start_time = perf_counter()
+        func(names)
+        best = min(best, perf_counter() - start_time)
+    print(f"{label:<32} {len(names) / best:>12,.0f} names/s")
+    return best
+
+
+def main():
+    from app.core import parser
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    movies = movie_corpus(size)
+    episodes = episode_corpus(size)
+
+    for name in set(movies):
+        assert tuple(parser.parse_name(name, "movies")) == legacy_parse(name), name
+    for name in set(episodes):
+        assert parser.parse_episode_filename(name, 1) == legacy_parse_episode(name, 1)
+
+    def clear():
+        for func in (
+            parser.clean_file_name,
+            parser.match_filename,
+            parser.parse_name,
+            parser.parse_episode,
+        ):
+            func.cache_clear()
+
+    print(f"{size} names, {len(set(movies))} unique movie names")
+    bench(
+        "movies, per-call patterns",
+        lambda n: [legacy_parse(x) for x in n],
+        movies,
+        repeats,
+    )
+    bench(
+        "movies, compiled (cold memo)",
+        lambda n: (clear(), parser.parse_names(n, "movies")),
+        movies,
+        repeats,
+    )
+    bench(
+        "movies, compiled (warm memo)",
+        lambda n: parser.parse_names(n, "movies"),
+        movies,
+        repeats,
+    )
+    bench(
+        "episodes, per-call patterns",
+        lambda n: [legacy_parse_episode(x, 1) for x in n],
+        episodes,
+        repeats,
+    )
+    bench(
+        "episodes, compiled (cold memo)",
+        lambda n: (clear(), parser.parse_episode_names(n, 1)),
+        episodes,
+        repeats,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Measures the peak RSS of parsing a synthetic movie listing into dicts and into records
+
+Each representation is parsed in a fresh interpreter, from a listing that is
+generated lazily as a streamed response would be.
+
+Usage: python -m scripts.bench_records [entries]
+"""
+import sys
+import resource
+import subprocess
+from os import path
+from time import perf_counter
+
+
+def legacy_parse_movies(rc_ls_result) -> list:
+    metadata: list = []
+    dirs: dict = {}
+    file_names: dict = {}
+    sub_index: int = 0
+    for item in rc_ls_result:
+        if item["IsDir"] is False and (
+            "video" in item["MimeType"]
+            or item["Name"]
+            .lower()
+            .endswith((".mp4", ".mkv", ".avi", ".mov", ".webm", ".flv"))
+        ):
+            parent_path = item["Path"].replace("/" + item["Name"], "")
+            parent = dirs.get(parent_path)
+            curr_metadata = {
+                "id": item.get("ID", item["Path"]),
+                "name": item["Name"],
+                "path": item["Path"],
+                "parent": parent,
+                "mime_type": item["MimeType"],
+                "size": item["Size"],
+                "subtitles": [],
+                "modified_time": item["ModTime"],
+            }
+            path_without_extension = path.splitext(item["Path"])[0]
+            file_name = file_names.get(path_without_extension)
+            if file_name:
+                curr_metadata["subtitles"] = file_name["subtitles"]
+                file_names[path_without_extension]["found"] = True
+                file_names[path_without_extension]["index"] = sub_index
+            else:
+                file_names[path_without_extension] = {
+                    "found": True,
+                    "index": sub_index,
+                    "subtitles": [],
+                }
+            metadata.append(curr_metadata)
+            sub_index += 1
+        elif item["IsDir"] is True:
+            dirs[item["Path"]] = {
+                "id": item.get("ID", item["Path"]),
+                "name": item["Name"],
+                "path": item["Path"],
+            }
+        elif item["IsDir"] is False and item["Name"].endswith(
+            (".vtt", ".srt", ".ass", ".ssa")
+        ):
+            path_without_extension = path.splitext(item["Path"])[0]
+            if path_without_extension[-3] == ".":
+                path_without_extension = path_without_extension[:-3]
+            elif path_without_extension[-4] == ".":
+                path_without_extension = path_without_extension[:-4]
+            sub_metadata = {
+                "id": item.get("ID", item["Path"]),
+                "name": item["Name"],
+                "path": item["Path"],
+            }
+            file_name = file_names.get(path_without_extension)
+            if file_name:
+                if file_name["found"] is True:
+                    metadata[file_name["index"]]["subtitles"].append(sub_metadata)
+                else:
+                    file_names[path_without_extension]["subtitles"].append(sub_metadata)
+            else:
+                file_names[path_without_extension] = {
+                    "found": False,
+                    "index": None,
+                    "subtitles": [sub_metadata],
+                }
+
+    return metadata
+
+
+def listing(size: int):
+    """Yields movie folders holding a video and, for every other one, a subtitle"""
+    for x in range(size // 3):
+        folder = f"Movie {x} (2020)"
+        yield {
+            "Path": folder,
+            "Name": folder,
+            "Size": -1,
+            "MimeType": "inode/directory",
+            "ModTime": "2022-06-01T12:00:00.000Z",
+            "IsDir": True,
+            "ID": f"1a{x:030d}",
+        }
+        name = f"Movie {x} (2020) 1080p BluRay x264"
+        yield {
+            "Path": f"{folder}/{name}.mkv",
+            "Name": f"{name}.mkv",
+            "Size": 1 << 31,
+            "MimeType": "video/x-matroska",
+            "ModTime": "2022-06-01T12:00:00.000Z",
+            "IsDir": False,
+            "ID": f"1b{x:030d}",
+        }
+        if x % 2:
+            yield {
+                "Path": f"{folder}/{name}.en.srt",
+                "Name": f"{name}.en.srt",
+                "Size": 1 << 16,
+                "MimeType": "application/x-subrip",
+                "ModTime": "2022-06-01T12:00:00.000Z",
+                "IsDir": False,
+                "ID": f"1c{x:030d}",
+            }
+
+
+def measure(mode: str, size: int):
+    from app.core.listing import MovieTree
+
+    start_time = perf_counter()
+    if mode == "dicts":
+        movies = legacy_parse_movies(listing(size))
+    else:
+        movies = MovieTree().build(listing(size))
+    elapsed = perf_counter() - start_time
+    # Kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak / 1024 if sys.platform != "darwin" else peak / 1024**2
+    print(
+        f"{mode:<8} {len(movies):>9} files {peak:>9,.0f} MB peak RSS {elapsed:>6.2f}s"
+    )
+
+
+def main():
+    from app.core.listing import MovieTree
+
+    if len(sys.argv) > 2:
+        return measure(sys.argv[2], int(sys.argv[1]))
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    sample = list(listing(3000))
+    legacy = legacy_parse_movies(sample)
+    records = MovieTree().build(sample)
+    assert [
+        dict(movie, subtitles=[dict(s) for s in movie["subtitles"]]) for movie in legacy
+    ] == [movie.__json__() for movie in records]
+    print(f"{size} entries")
+    for mode in ("dicts", "records"):
+        subprocess.run(
+            [sys.executable, "-m", "scripts.bench_records", str(size), mode],
+            check=True,
+            cwd=path.dirname(path.dirname(path.abspath(__file__))),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""Tests of the TMDB changes feed and the in-place refresh, against a stub TMDB API
+
+The MongoDB client in ``app.apis`` connects on import, so a stand-in module
+with in-memory collections replaces it before the app modules are imported.
+"""
+import sys
+import types
+import unittest
+from unittest import mock
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+
+import httpx
+
+
+class StubCollection:
+    """In-memory stand-in for the few collection methods used here"""
+
+    def __init__(self, tmdb_ids=()):
+        self.tmdb_ids = list(tmdb_ids)
+        self.operations = []
+
+    def distinct(self, key):
+        return self.tmdb_ids
+
+    def bulk_write(self, operations, ordered=True):
+        self.operations.extend(operations)
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def find_one(self, *args, **kwargs):
+        return None
+
+    def find(self, *args, **kwargs):
+        return []
+
+    def replace_one(self, *args, **kwargs):
+        pass
+
+    def update_one(self, *args, **kwargs):
+        pass
+
+
+class StubMongo:
+    def __init__(self):
+        self.config = {"tmdb": {"api_key": "key", "concurrency": 4, "rate": 1000}}
+        self.tmdb_cache_col = StubCollection()
+        self.identification_cache_col = StubCollection()
+        self.movies_col = StubCollection()
+        self.movies_staging_col = StubCollection()
+        self.series_col = StubCollection()
+        self.series_staging_col = StubCollection()
+        self.last_refresh_time = None
+        self.last_build_time = None
+
+    def get_last_refresh_time(self):
+        return self.last_refresh_time
+
+    def get_last_build_time(self):
+        return self.last_build_time
+
+    def set_last_refresh_time(self, last_refresh_time):
+        self.last_refresh_time = last_refresh_time
+
+
+apis = types.ModuleType("app.apis")
+apis.mongo = StubMongo()
+apis.rclone = {}
+sys.modules["app.apis"] = apis
+
+from app.core import cron  # noqa: E402
+from app.core.tmdb import TMDB  # noqa: E402
+
+
+class StubAPI:
+    """Serves the changes feeds page by page, and the details of any title"""
+
+    def __init__(self, feeds):
+        # {(type, start_date, end_date): [[ids of page 1], [ids of page 2], ...]}
+        self.feeds = feeds
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix("/3/")
+        params = {
+            key: values[0]
+            for key, values in parse_qs(request.url.query.decode()).items()
+        }
+        self.requests.append((path, params))
+        if path == "configuration":
+            return httpx.Response(200, json={"images": {"secure_base_url": "/"}})
+        type_name, _, endpoint = path.partition("/")
+        if endpoint == "changes":
+            pages = self.feeds.get(
+                (type_name, params["start_date"], params["end_date"]), [[]]
+            )
+            page = int(params["page"])
+            return httpx.Response(
+                200,
+                json={
+                    "page": page,
+                    "total_pages": len(pages),
+                    "results": [{"id": tmdb_id} for tmdb_id in pages[page - 1]],
+                },
+            )
+        return httpx.Response(200, json={"id": int(endpoint), "name": f"{endpoint}"})
+
+    def fetched(self, type_name):
+        return sorted(
+            int(path.partition("/")[2])
+            for path, _ in self.requests
+            if path.startswith(f"{type_name}/") and not path.endswith("changes")
+        )
+
+
+class StubModel:
+    @classmethod
+    def media_info(cls, media_metadata):
+        return {"title": media_metadata["name"]}
+
+
+def stub_tmdb(api: StubAPI) -> TMDB:
+    tmdb = TMDB(api_key="key", concurrency=4, rate=1000)
+    tmdb.client = httpx.AsyncClient(
+        params={"api_key": "key"}, transport=httpx.MockTransport(api)
+    )
+    return tmdb
+
+
+def day(date: str) -> datetime:
+    return datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+
+class GetChangesTest(unittest.IsolatedAsyncioTestCase):
+    async def test_splits_long_windows(self):
+        api = StubAPI(
+            {
+                ("movie", "2022-01-01", "2022-01-15"): [[1]],
+                ("movie", "2022-01-15", "2022-01-29"): [[2]],
+                ("movie", "2022-01-29", "2022-02-01"): [[3]],
+            }
+        )
+        tmdb = stub_tmdb(api)
+        try:
+            changed = await tmdb.get_changes(
+                "movies", day("2022-01-01"), day("2022-02-01")
+            )
+        finally:
+            await tmdb.close()
+        self.assertEqual(changed, {1, 2, 3})
+        self.assertEqual(
+            sorted(
+                (params["start_date"], params["end_date"]) for _, params in api.requests
+            ),
+            [
+                ("2022-01-01", "2022-01-15"),
+                ("2022-01-15", "2022-01-29"),
+                ("2022-01-29", "2022-02-01"),
+            ],
+        )
+
+    async def test_fetches_every_page(self):
+        api = StubAPI({("tv", "2022-01-01", "2022-01-03"): [[1, 2], [3], [2, 4]]})
+        tmdb = stub_tmdb(api)
+        try:
+            changed = await tmdb.get_changes(
+                "series", day("2022-01-01"), day("2022-01-03")
+            )
+        finally:
+            await tmdb.close()
+        self.assertEqual(changed, {1, 2, 3, 4})
+        self.assertEqual(
+            sorted(int(params["page"]) for _, params in api.requests), [1, 2, 3]
+        )
+
+    async def test_empty_window(self):
+        api = StubAPI({})
+        tmdb = stub_tmdb(api)
+        try:
+            changed = await tmdb.get_changes(
+                "movies", day("2022-01-01"), day("2022-01-01")
+            )
+        finally:
+            await tmdb.close()
+        self.assertEqual(changed, set())
+        self.assertEqual(api.requests, [])
+
+
+class RefreshChangedTest(unittest.IsolatedAsyncioTestCase):
+    async def test_refreshes_changed_catalog_items_only(self):
+        api = StubAPI(
+            {
+                ("movie", "2022-01-01", "2022-01-15"): [[1, 2, 100], [101]],
+                ("movie", "2022-01-15", "2022-01-20"): [[3, 102]],
+                ("tv", "2022-01-01", "2022-01-15"): [[10, 200]],
+                ("tv", "2022-01-15", "2022-01-20"): [[]],
+            }
+        )
+        mongo = StubMongo()
+        mongo.last_build_time = day("2022-01-01")
+        mongo.movies_col.tmdb_ids = [1, 3, 4]
+        mongo.series_col.tmdb_ids = [10, 11]
+        with mock.patch.object(cron, "mongo", mongo), mock.patch.object(
+            cron, "TMDB", lambda **kwargs: stub_tmdb(api)
+        ), mock.patch.object(cron, "Movie", StubModel), mock.patch.object(
+            cron, "Series", StubModel
+        ):
+            stats = await cron.refresh_changed(until=day("2022-01-20"))
+
+        self.assertEqual(stats, {"movies": 2, "series": 1})
+        self.assertEqual(api.fetched("movie"), [1, 3])
+        self.assertEqual(api.fetched("tv"), [10])
+        # The live and the staging catalog are both updated
+        for col, tmdb_ids in (
+            (mongo.movies_col, [1, 3]),
+            (mongo.movies_staging_col, [1, 3]),
+            (mongo.series_col, [10]),
+            (mongo.series_staging_col, [10]),
+        ):
+            self.assertEqual(
+                sorted(operation._filter["tmdb_id"] for operation in col.operations),
+                tmdb_ids,
+            )
+        self.assertEqual(mongo.last_refresh_time, day("2022-01-20"))
+
+
+if __name__ == "__main__":
+    unittest.main()